@@ -0,0 +1,64 @@
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from nptyping import Float32, NDArray, Shape
+
+from oaf_vision_3d._stereo_data_reader import StereoData
+from oaf_vision_3d.block_matching import block_matching
+from oaf_vision_3d.cost_precision import CostPrecision
+
+BAD_PIXEL_THRESHOLD = 2.0
+
+
+@dataclass
+class AccuracyResult:
+    name: str
+    parameters: dict[str, Any]
+    mean_absolute_error: float
+    bad_pixel_fraction: float
+    valid_fraction: float
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def disparity_accuracy(
+    name: str,
+    parameters: dict[str, Any],
+    disparity: NDArray[Shape["H, W"], Float32],
+    ground_truth_disparity: NDArray[Shape["H, W"], Float32],
+) -> AccuracyResult:
+    # Only pixels with ground truth are scored, unmatched pixels count as bad
+    has_ground_truth = np.isfinite(ground_truth_disparity)
+    error = np.abs(disparity - ground_truth_disparity)[has_ground_truth]
+    is_valid = np.isfinite(error)
+    return AccuracyResult(
+        name=name,
+        parameters=parameters,
+        mean_absolute_error=float(error[is_valid].mean()),
+        bad_pixel_fraction=float(np.mean(~(error <= BAD_PIXEL_THRESHOLD))),
+        valid_fraction=float(is_valid.mean()),
+    )
+
+
+def cost_precision_accuracy(data_name: str, data_dir: Path) -> list[AccuracyResult]:
+    stereo_data = StereoData.from_path(data_dir).load()
+    if stereo_data.ground_truth_disparity is None:
+        return []
+
+    return [
+        disparity_accuracy(
+            name="block_matching",
+            parameters={"data": data_name, "precision": precision.name.lower()},
+            disparity=block_matching(
+                image_0=stereo_data.image_0,
+                image_1=stereo_data.image_1,
+                disparity_range=stereo_data.expected_disparity,
+                precision=precision,
+            ),
+            ground_truth_disparity=stereo_data.ground_truth_disparity,
+        )
+        for precision in CostPrecision
+    ]
@@ -0,0 +1,334 @@
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import numpy as np
+from nptyping import Float32, NDArray, Shape
+from scipy.ndimage import gaussian_filter
+
+from oaf_vision_3d._stereo_data_reader import StereoData
+from oaf_vision_3d._test_data_paths import TestDataPaths
+from oaf_vision_3d.block_matching import block_matching
+from oaf_vision_3d.cost_precision import CostPrecision
+from oaf_vision_3d.lens_model import (
+    CameraMatrix,
+    DistortionCoefficients,
+    LensModel,
+    _undistort_pixels,
+)
+from oaf_vision_3d.plane_sweeping import plane_sweeping
+from oaf_vision_3d.transformation_matrix import TransformationMatrix
+from oaf_vision_3d.triangulation import triangulate_disparity
+
+QUICK_RESOLUTIONS = ((320, 240),)
+FULL_RESOLUTIONS = ((320, 240), (640, 480), (1280, 720))
+QUICK_DISPARITY_COUNTS = (32,)
+FULL_DISPARITY_COUNTS = (32, 64, 128)
+QUICK_PLANE_COUNTS = (16,)
+FULL_PLANE_COUNTS = (16, 32)
+REDUCED_PRECISIONS = (CostPrecision.FLOAT16, CostPrecision.UINT16)
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+@dataclass
+class BenchmarkCase:
+    name: str
+    parameters: dict[str, Any]
+    work_unit: str
+    work: int
+    # Inputs are created by setup right before the case runs, so only one case at a
+    # time holds its data in memory
+    setup: Callable[[], Callable[[], object]]
+
+
+@dataclass
+class _Rig:
+    lens_model_0: LensModel
+    lens_model_1: LensModel
+    transformation_matrix: TransformationMatrix
+
+
+def _synthetic_rig(width: int, height: int) -> _Rig:
+    lens_model = LensModel(
+        camera_matrix=CameraMatrix(fx=width, fy=width, cx=width / 2, cy=height / 2),
+        distortion_coefficients=DistortionCoefficients(
+            k1=-0.1, k2=0.2, p1=-0.001, p2=0.0005
+        ),
+    )
+    return _Rig(
+        lens_model_0=lens_model,
+        lens_model_1=lens_model,
+        transformation_matrix=TransformationMatrix(
+            translation=np.array([1.0, 0.0, 0.0], dtype=np.float32)
+        ),
+    )
+
+
+def _synthetic_stereo_pair(
+    width: int, height: int, disparity: int, seed: int = 0
+) -> tuple[NDArray[Shape["H, W, 3"], Float32], NDArray[Shape["H, W, 3"], Float32]]:
+    random = np.random.default_rng(seed)
+    texture = gaussian_filter(
+        random.random((height, width + disparity, 3), dtype=np.float32),
+        sigma=(1.5, 1.5, 0),
+    ).astype(np.float32, copy=False)
+    return texture[:, :width], texture[:, disparity:]
+
+
+def _precision_parameters(precision: CostPrecision) -> dict[str, str]:
+    # The default precision is left out, so the keys match results from before
+    if precision == CostPrecision.FLOAT32:
+        return {}
+    return {"precision": precision.name.lower()}
+
+
+def _synthetic_block_matching(
+    width: int,
+    height: int,
+    number_of_disparities: int,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+) -> Callable[[], object]:
+    image_0, image_1 = _synthetic_stereo_pair(
+        width=width, height=height, disparity=number_of_disparities // 2
+    )
+    return partial(
+        block_matching,
+        image_0=image_0,
+        image_1=image_1,
+        disparity_range=np.array([0, number_of_disparities], dtype=np.float32),
+        precision=precision,
+    )
+
+
+def _synthetic_plane_sweeping(
+    width: int, height: int, number_of_planes: int
+) -> Callable[[], object]:
+    rig = _synthetic_rig(width=width, height=height)
+    image_0, image_1 = _synthetic_stereo_pair(width=width, height=height, disparity=8)
+    return partial(
+        plane_sweeping,
+        image=image_0,
+        lens_model=rig.lens_model_0,
+        secondary_images=[image_1],
+        secondary_lens_models=[rig.lens_model_1],
+        secondary_transformation_matrices=[rig.transformation_matrix],
+        depth_range=np.array([50.0, 50.0 + number_of_planes - 1], dtype=np.float32),
+        step_size=1.0,
+    )
+
+
+def _normalized_pixels(
+    lens_model: LensModel, width: int, height: int
+) -> NDArray[Shape["H, W, 2"], Float32]:
+    pixels = np.indices((height, width), dtype=np.float32)[::-1].transpose((1, 2, 0))
+    return lens_model.normalize_pixels(pixels=pixels)
+
+
+def _undistort(lens_model: LensModel, width: int, height: int) -> Callable[[], object]:
+    return partial(
+        _undistort_pixels,
+        normalized_pixels=_normalized_pixels(
+            lens_model=lens_model, width=width, height=height
+        ),
+        distortion_coefficients=lens_model.distortion_coefficients,
+    )
+
+
+def _triangulate(rig: _Rig, width: int, height: int) -> Callable[[], object]:
+    random = np.random.default_rng(0)
+    disparity = random.uniform(20.0, 40.0, size=(height, width)).astype(np.float32)
+    return partial(
+        triangulate_disparity,
+        disparity=disparity,
+        lens_model_0=rig.lens_model_0,
+        lens_model_1=rig.lens_model_1,
+        transformation_matrix=rig.transformation_matrix,
+    )
+
+
+def synthetic_cases(quick: bool = False) -> Iterator[BenchmarkCase]:
+    resolutions = QUICK_RESOLUTIONS if quick else FULL_RESOLUTIONS
+    disparity_counts = QUICK_DISPARITY_COUNTS if quick else FULL_DISPARITY_COUNTS
+    plane_counts = QUICK_PLANE_COUNTS if quick else FULL_PLANE_COUNTS
+
+    for width, height in resolutions:
+        size = {"data": "synthetic", "width": width, "height": height}
+        for number_of_disparities in disparity_counts:
+            for precision in (CostPrecision.FLOAT32, *REDUCED_PRECISIONS):
+                yield BenchmarkCase(
+                    name="block_matching",
+                    parameters={
+                        **size,
+                        "disparities": number_of_disparities,
+                        **_precision_parameters(precision),
+                    },
+                    work_unit="pixel_disparities",
+                    work=width * height * number_of_disparities,
+                    setup=partial(
+                        _synthetic_block_matching,
+                        width=width,
+                        height=height,
+                        number_of_disparities=number_of_disparities,
+                        precision=precision,
+                    ),
+                )
+        for number_of_planes in plane_counts:
+            yield BenchmarkCase(
+                name="plane_sweeping",
+                parameters={**size, "planes": number_of_planes},
+                work_unit="pixel_planes",
+                work=width * height * number_of_planes,
+                setup=partial(
+                    _synthetic_plane_sweeping,
+                    width=width,
+                    height=height,
+                    number_of_planes=number_of_planes,
+                ),
+            )
+        rig = _synthetic_rig(width=width, height=height)
+        yield BenchmarkCase(
+            name="undistort_pixels",
+            parameters=size,
+            work_unit="pixels",
+            work=width * height,
+            setup=partial(
+                _undistort, lens_model=rig.lens_model_0, width=width, height=height
+            ),
+        )
+        yield BenchmarkCase(
+            name="triangulate_disparity",
+            parameters=size,
+            work_unit="pixels",
+            work=width * height,
+            setup=partial(_triangulate, rig=rig, width=width, height=height),
+        )
+
+
+def _load_stereo_data(data_dir: Path) -> StereoData:
+    return StereoData.from_path(data_dir).load()
+
+
+def _test_data_block_matching(
+    data_dir: Path, precision: CostPrecision = CostPrecision.FLOAT32
+) -> Callable[[], object]:
+    stereo_data = _load_stereo_data(data_dir)
+    return partial(
+        block_matching,
+        image_0=stereo_data.image_0,
+        image_1=stereo_data.image_1,
+        disparity_range=stereo_data.expected_disparity,
+        precision=precision,
+    )
+
+
+def _test_data_plane_sweeping() -> Callable[[], object]:
+    # Same setup as the multiple image plane sweeping in workshop 8
+    stereo_data_0 = _load_stereo_data(TestDataPaths.stereo_data_0_dir)
+    stereo_data_1 = _load_stereo_data(TestDataPaths.stereo_data_1_dir)
+    return partial(
+        plane_sweeping,
+        image=stereo_data_0.image_0,
+        lens_model=stereo_data_0.lens_model_0,
+        secondary_images=[stereo_data_0.image_1, stereo_data_1.image_1],
+        secondary_lens_models=[stereo_data_0.lens_model_1, stereo_data_1.lens_model_1],
+        secondary_transformation_matrices=[
+            stereo_data_0.transformation_matrix,
+            stereo_data_1.transformation_matrix,
+        ],
+        depth_range=np.array([135.0, 142.0], dtype=np.float32),
+        step_size=0.5,
+    )
+
+
+def _is_available(data_dir: Path) -> bool:
+    # Without git lfs the images are small pointer files instead of PNG files
+    for file_name in ("image_0.png", "im0.png"):
+        file_path = data_dir / file_name
+        if file_path.exists():
+            with open(file_path, "rb") as f:
+                return f.read(8) == _PNG_SIGNATURE
+    return False
+
+
+def test_data_cases() -> tuple[list[BenchmarkCase], list[str]]:
+    data_dirs = {
+        "traproom1": TestDataPaths.traproom1_dir,
+        "stereo_data_0": TestDataPaths.stereo_data_0_dir,
+        "stereo_data_1": TestDataPaths.stereo_data_1_dir,
+    }
+    available = {name: _is_available(path) for name, path in data_dirs.items()}
+
+    cases = []
+    for name, data_dir in data_dirs.items():
+        if not available[name]:
+            continue
+        stereo_data = StereoData.from_path(data_dir)
+        width, height = stereo_data.width, stereo_data.height
+        rig = _Rig(
+            lens_model_0=stereo_data.lens_model_0,
+            lens_model_1=stereo_data.lens_model_1,
+            transformation_matrix=stereo_data.transformation_matrix,
+        )
+        parameters = {"data": name, "width": width, "height": height}
+        number_of_disparities = int(np.ptp(stereo_data.expected_disparity))
+
+        cases += [
+            BenchmarkCase(
+                name="block_matching",
+                parameters={
+                    **parameters,
+                    "disparities": number_of_disparities,
+                    **_precision_parameters(precision),
+                },
+                work_unit="pixel_disparities",
+                work=width * height * number_of_disparities,
+                setup=partial(
+                    _test_data_block_matching, data_dir=data_dir, precision=precision
+                ),
+            )
+            for precision in (CostPrecision.FLOAT32, *REDUCED_PRECISIONS)
+        ]
+        cases += [
+            BenchmarkCase(
+                name="undistort_pixels",
+                parameters=parameters,
+                work_unit="pixels",
+                work=width * height,
+                setup=partial(
+                    _undistort,
+                    lens_model=stereo_data.lens_model_0,
+                    width=width,
+                    height=height,
+                ),
+            ),
+            BenchmarkCase(
+                name="triangulate_disparity",
+                parameters=parameters,
+                work_unit="pixels",
+                work=width * height,
+                setup=partial(_triangulate, rig=rig, width=width, height=height),
+            ),
+        ]
+
+    if available["stereo_data_0"] and available["stereo_data_1"]:
+        stereo_data = StereoData.from_path(TestDataPaths.stereo_data_0_dir)
+        number_of_planes = 15
+        cases.append(
+            BenchmarkCase(
+                name="plane_sweeping",
+                parameters={
+                    "data": "stereo_data_0+stereo_data_1",
+                    "width": stereo_data.width,
+                    "height": stereo_data.height,
+                    "planes": number_of_planes,
+                },
+                work_unit="pixel_planes",
+                work=stereo_data.width * stereo_data.height * number_of_planes,
+                setup=_test_data_plane_sweeping,
+            )
+        )
+
+    skipped = [name for name, is_available in available.items() if not is_available]
+    return cases, skipped
@@ -0,0 +1,76 @@
+import json
+import platform
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import scipy
+
+from ci_tools.benchmarks.accuracy import AccuracyResult
+from ci_tools.benchmarks.measure import BenchmarkResult
+
+
+def results_to_json(
+    results: list[BenchmarkResult],
+    skipped: list[str],
+    accuracy: Optional[list[AccuracyResult]] = None,
+) -> dict:
+    return {
+        "metadata": {
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "scipy": scipy.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+        },
+        "skipped_test_data": skipped,
+        "results": [result.to_dict() for result in results],
+        "accuracy": [result.to_dict() for result in accuracy or []],
+    }
+
+
+def write_results(
+    file_path: Path,
+    results: list[BenchmarkResult],
+    skipped: list[str],
+    accuracy: Optional[list[AccuracyResult]] = None,
+) -> None:
+    with file_path.open("w", encoding="utf-8") as file:
+        json.dump(
+            results_to_json(results=results, skipped=skipped, accuracy=accuracy),
+            file,
+            indent=4,
+        )
+
+
+def read_results(file_path: Path) -> dict[str, dict]:
+    with file_path.open("r", encoding="utf-8") as file:
+        data = json.load(file)
+    return {result["key"]: result for result in data["results"]}
+
+
+def compare_to_baseline(
+    results: list[BenchmarkResult], baseline: dict[str, dict], tolerance: float
+) -> list[str]:
+    regressions = []
+    for result in results:
+        if result.key not in baseline:
+            continue
+        reference = baseline[result.key]
+
+        time_ratio = result.median_wall_time_s / reference["median_wall_time_s"]
+        if time_ratio > 1 + tolerance:
+            regressions.append(
+                f"{result.key}: wall time {result.median_wall_time_s:.4f} s is "
+                f"{time_ratio:.2f}x the baseline {reference['median_wall_time_s']:.4f} s"
+            )
+
+        memory_ratio = result.peak_traced_bytes / max(reference["peak_traced_bytes"], 1)
+        if memory_ratio > 1 + tolerance:
+            regressions.append(
+                f"{result.key}: peak memory {result.peak_traced_bytes} B is "
+                f"{memory_ratio:.2f}x the baseline {reference['peak_traced_bytes']} B"
+            )
+    return regressions
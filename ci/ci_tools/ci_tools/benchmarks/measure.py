@@ -0,0 +1,108 @@
+import gc
+import resource
+import statistics
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+_PROC_STATUS = Path("/proc/self/status")
+_PROC_CLEAR_REFS = Path("/proc/self/clear_refs")
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    parameters: dict[str, Any]
+    work_unit: str
+    work: int
+    wall_times_s: list[float]
+    peak_traced_bytes: int
+    peak_rss_bytes: Optional[int]
+    throughput: float = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.throughput = self.work / self.median_wall_time_s
+
+    @property
+    def key(self) -> str:
+        parameters = ",".join(
+            f"{name}={value}" for name, value in sorted(self.parameters.items())
+        )
+        return f"{self.name}[{parameters}]"
+
+    @property
+    def median_wall_time_s(self) -> float:
+        return statistics.median(self.wall_times_s)
+
+    def to_dict(self) -> dict:
+        return {
+            **asdict(self),
+            "key": self.key,
+            "median_wall_time_s": self.median_wall_time_s,
+        }
+
+
+def _reset_peak_rss() -> bool:
+    # Writing 5 to clear_refs resets the peak RSS of the process on Linux
+    try:
+        _PROC_CLEAR_REFS.write_text("5", encoding="ascii")
+    except OSError:
+        return False
+    return True
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    try:
+        lines = _PROC_STATUS.read_text(encoding="ascii").splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def measure(
+    name: str,
+    parameters: dict[str, Any],
+    work_unit: str,
+    work: int,
+    function: Callable[[], object],
+    repeat: int = 3,
+) -> BenchmarkResult:
+    # Warm up caches and lazy imports before timing
+    function()
+
+    wall_times_s = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        wall_times_s.append(time.perf_counter() - start)
+
+    # Memory is measured in a separate run, as tracing slows down allocations
+    gc.collect()
+    rss_reset = _reset_peak_rss()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_traced_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    peak_rss_bytes = (
+        _peak_rss_bytes()
+        if rss_reset
+        else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    )
+
+    return BenchmarkResult(
+        name=name,
+        parameters=parameters,
+        work_unit=work_unit,
+        work=work,
+        wall_times_s=wall_times_s,
+        peak_traced_bytes=peak_traced_bytes,
+        peak_rss_bytes=peak_rss_bytes,
+    )
@@ -0,0 +1,61 @@
+import pkgutil
+import subprocess
+import sys
+from dataclasses import dataclass
+
+HEAVY_MODULES = ("matplotlib", "open3d", "scipy.signal", "scipy.spatial")
+PLOTTING_MODULES = ("_notebook_tools", "point_cloud_visualization")
+
+
+@dataclass
+class ImportResult:
+    module: str
+    import_time_s: float
+    heavy_modules: list[str]
+
+
+def package_modules(package: str) -> list[str]:
+    return [
+        f"{package}.{module.name}"
+        for module in pkgutil.iter_modules(__import__(package).__path__)  # type: ignore
+        if module.name not in PLOTTING_MODULES
+    ]
+
+
+def _parse_import_times(output: str) -> dict[str, float]:
+    # Lines are "import time: <self us> | <cumulative us> | <indented module>"
+    import_times = {}
+    for line in output.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        import_times[fields[2].strip()] = int(fields[1]) * 1e-6
+    return import_times
+
+
+def measure_import(module: str, repeat: int = 3) -> ImportResult:
+    import_times_s = []
+    import_times: dict[str, float] = {}
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stderr
+        import_times = _parse_import_times(output)
+        import_times_s.append(import_times[module])
+
+    heavy_modules = sorted(
+        heavy_module
+        for heavy_module in HEAVY_MODULES
+        if any(
+            name == heavy_module or name.startswith(f"{heavy_module}.")
+            for name in import_times
+        )
+    )
+    return ImportResult(
+        module=module,
+        import_time_s=min(import_times_s),
+        heavy_modules=heavy_modules,
+    )
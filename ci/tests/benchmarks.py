@@ -0,0 +1,128 @@
+import argparse
+from pathlib import Path
+
+from ci_tools.benchmarks.accuracy import AccuracyResult, cost_precision_accuracy
+from ci_tools.benchmarks.cases import BenchmarkCase, synthetic_cases, test_data_cases
+from ci_tools.benchmarks.compare import (
+    compare_to_baseline,
+    read_results,
+    write_results,
+)
+from ci_tools.benchmarks.measure import BenchmarkResult, measure
+from oaf_vision_3d._test_data_paths import TestDataPaths
+
+
+def _args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmarks")
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="Path to write the results to as JSON.",
+        required=False,
+        default=Path("benchmark_results.json"),
+    )
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        help="Path to a JSON file from an earlier run to compare against.",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        help="Allowed relative increase in wall time and peak memory.",
+        required=False,
+        default=0.2,
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        help="Number of timed runs per benchmark.",
+        required=False,
+        default=3,
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="Only run the smallest synthetic benchmarks.",
+        required=False,
+        default=False,
+    )
+    parser.add_argument(
+        "--filter",
+        type=str,
+        help="Only run benchmarks with this text in the name.",
+        required=False,
+        default=None,
+    )
+    return parser.parse_args()
+
+
+def _run_case(case: BenchmarkCase, repeat: int) -> BenchmarkResult:
+    result = measure(
+        name=case.name,
+        parameters=case.parameters,
+        work_unit=case.work_unit,
+        work=case.work,
+        function=case.setup(),
+        repeat=repeat,
+    )
+    print(
+        f"    {result.key}: {result.median_wall_time_s:.4f} s, "
+        f"{result.throughput:.3g} {result.work_unit}/s, "
+        f"{result.peak_traced_bytes / 2**20:.1f} MiB traced peak"
+    )
+    return result
+
+
+def _print_accuracy(accuracy: list[AccuracyResult]) -> None:
+    print("Accuracy against the ground truth disparity:")
+    for result in accuracy:
+        print(
+            f"    {result.name}[{result.parameters['precision']}]: "
+            f"{result.mean_absolute_error:.3f} px mean absolute error, "
+            f"{result.bad_pixel_fraction:.2%} bad pixels, "
+            f"{result.valid_fraction:.2%} valid"
+        )
+
+
+def _main() -> None:
+    args = _args()
+    cases = list(synthetic_cases(quick=args.quick))
+    skipped: list[str] = []
+    if not args.quick:
+        data_cases, skipped = test_data_cases()
+        cases += data_cases
+    if args.filter is not None:
+        cases = [case for case in cases if args.filter in case.name]
+
+    print("Benchmark results:")
+    for name in skipped:
+        print(f"    Skipping {name}, the test data is not available (git lfs)")
+    results = [_run_case(case=case, repeat=args.repeat) for case in cases]
+
+    accuracy: list[AccuracyResult] = []
+    if not args.quick and "traproom1" not in skipped:
+        accuracy = cost_precision_accuracy(
+            data_name="traproom1", data_dir=TestDataPaths.traproom1_dir
+        )
+        _print_accuracy(accuracy)
+    write_results(
+        file_path=args.output, results=results, skipped=skipped, accuracy=accuracy
+    )
+
+    if args.baseline is not None:
+        regressions = compare_to_baseline(
+            results=results,
+            baseline=read_results(args.baseline),
+            tolerance=args.tolerance,
+        )
+        print("Regressions compared to the baseline:")
+        for regression in regressions:
+            print(f"    {regression}")
+        assert not regressions
+
+
+if __name__ == "__main__":
+    _main()
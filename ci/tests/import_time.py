@@ -0,0 +1,65 @@
+import argparse
+
+from ci_tools.import_time.measure import ImportResult, measure_import, package_modules
+
+
+def _args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Import time")
+    parser.add_argument(
+        "--budget",
+        type=float,
+        help="Allowed import time in seconds for every module, in a fresh process.",
+        required=False,
+        default=1.0,
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        help="Number of imports per module, the fastest one is used.",
+        required=False,
+        default=3,
+    )
+    parser.add_argument(
+        "--modules",
+        nargs="+",
+        help="Modules to check. If not provided, all modules of oaf_vision_3d are checked.",
+        required=False,
+        default=None,
+    )
+    return parser.parse_args()
+
+
+def _problems(result: ImportResult, budget: float) -> list[str]:
+    problems = []
+    if result.import_time_s > budget:
+        problems.append(
+            f"{result.module} takes {result.import_time_s:.3f} s to import, "
+            f"the budget is {budget:.3f} s"
+        )
+    if result.heavy_modules:
+        problems.append(
+            f"{result.module} imports {', '.join(result.heavy_modules)}, "
+            "import them in the function that needs them"
+        )
+    return problems
+
+
+def _main() -> None:
+    args = _args()
+    modules = package_modules("oaf_vision_3d") if args.modules is None else args.modules
+
+    print("Import times:")
+    problems = []
+    for module in modules:
+        result = measure_import(module=module, repeat=args.repeat)
+        print(f"    {result.module}: {result.import_time_s:.3f} s")
+        problems += _problems(result=result, budget=args.budget)
+
+    print("Problems:")
+    for problem in problems:
+        print(f"    {problem}")
+    assert not problems
+
+
+if __name__ == "__main__":
+    _main()
@@ -1,41 +1,172 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import json
+import os
+import struct
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Iterator, Optional, Union, cast, overload
 
 import numpy as np
-from matplotlib import pyplot as plt
 from nptyping import Float32, NDArray, Shape
 
 from oaf_vision_3d.lens_model import CameraMatrix, LensModel
+from oaf_vision_3d.pfm import read_pfm
 from oaf_vision_3d.transformation_matrix import TransformationMatrix
 
+_CACHE_FILE_NAME = ".stereo_data_cache"
+_CACHE_MAGIC = b"OAFSD001"
+_CACHE_ALIGNMENT = 64
 
-@dataclass
+_CUSTOM_SOURCE_FILES = (
+    "image_0.png",
+    "image_1.png",
+    "lens_model_0.json",
+    "lens_model_1.json",
+    "transformation_matrix.json",
+    "expected_disparity.npy",
+)
+_MOBILE_SOURCE_FILES = ("im0.png", "im1.png", "disp0.pfm", "calib.txt")
+_DATASET_MARKER_FILES = ("image_0.png", "im0.png")
+
+
+class _LazyAttribute:  # pylint: disable=too-few-public-methods
+    def __init__(self) -> None:
+        self._attribute_name = ""
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self._attribute_name = f"_{name}"
+
+    def _resolve(self, instance: object) -> object:
+        value = getattr(instance, self._attribute_name)
+        if callable(value):
+            value = value()
+            setattr(instance, self._attribute_name, value)
+        return value
+
+
+class _LazyArray(_LazyAttribute):
+    @overload
+    def __get__(self, instance: None, owner: type) -> _LazyArray: ...
+
+    @overload
+    def __get__(self, instance: object, owner: type) -> NDArray: ...
+
+    def __get__(
+        self, instance: Optional[object], owner: type
+    ) -> Union[_LazyArray, NDArray]:
+        if instance is None:
+            # No class level default, the field is required in __init__
+            raise AttributeError(self._attribute_name)
+        return cast(NDArray, self._resolve(instance))
+
+    def __set__(
+        self, instance: object, value: Union[NDArray, Callable[[], NDArray]]
+    ) -> None:
+        setattr(instance, self._attribute_name, value)
+
+
+class _LazyOptionalArray(_LazyAttribute):
+    @overload
+    def __get__(self, instance: None, owner: type) -> None: ...
+
+    @overload
+    def __get__(self, instance: object, owner: type) -> Optional[NDArray]: ...
+
+    def __get__(self, instance: Optional[object], owner: type) -> Optional[NDArray]:
+        if instance is None:
+            return None
+        return cast(Optional[NDArray], self._resolve(instance))
+
+    def __set__(
+        self,
+        instance: object,
+        value: Union[Optional[NDArray], Callable[[], Optional[NDArray]]],
+    ) -> None:
+        setattr(instance, self._attribute_name, value)
+
+
+# Keyword only, the lazy images have a class level descriptor and would otherwise have
+# to follow the fields without a default
+@dataclass(kw_only=True)
 class StereoData:
-    image_0: NDArray[Shape["H, W, 3"], Float32]
-    image_1: NDArray[Shape["H, W, 3"], Float32]
+    image_0: _LazyArray = _LazyArray()
+    image_1: _LazyArray = _LazyArray()
     lens_model_0: LensModel
     lens_model_1: LensModel
     transformation_matrix: TransformationMatrix
     expected_disparity: NDArray[Shape["2"], Float32]
     width: int
     height: int
-    ground_truth_disparity: Optional[NDArray[Shape["H, W"], Float32]] = None
+    ground_truth_disparity: _LazyOptionalArray = _LazyOptionalArray()
 
     @staticmethod
-    def from_path(data_dir: Path) -> StereoData:
+    def from_path(
+        data_dir: Path, lazy: bool = True, use_cache: bool = False
+    ) -> StereoData:
+        if use_cache:
+            cached_stereo_data = _read_cache(data_dir)
+            if cached_stereo_data is not None:
+                return cached_stereo_data
+
         if (data_dir / "image_0.png").exists():
-            return _parse_dataset_custom(data_dir)
-        if (data_dir / "im0.png").exists():
-            return _parse_dataset_mobile(data_dir)
-        raise NotImplementedError("Unknown dataset format.")
+            stereo_data = _parse_dataset_custom(data_dir)
+        elif (data_dir / "im0.png").exists():
+            stereo_data = _parse_dataset_mobile(data_dir)
+        else:
+            raise NotImplementedError("Unknown dataset format.")
+
+        if use_cache:
+            try:
+                write_cache(stereo_data=stereo_data, data_dir=data_dir)
+            except OSError:
+                # Read-only datasets are still usable, just without a cache
+                pass
+            else:
+                cached_stereo_data = _read_cache(data_dir)
+                if cached_stereo_data is not None:
+                    return cached_stereo_data
+
+        if not lazy:
+            stereo_data.load()
+        return stereo_data
+
+    def load(self) -> StereoData:
+        for name in ("image_0", "image_1", "ground_truth_disparity"):
+            getattr(self, name)
+        return self
+
+
+def _read_image(file_path: Path) -> NDArray[Shape["H, W, 3"], Float32]:
+    # OpenCV decodes faster than matplotlib and imports in a fraction of the time,
+    # it is imported with the first image so reading only the calibration stays fast
+    # pylint: disable=import-outside-toplevel
+    import cv2
+
+    image = cv2.imread(str(file_path), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not read image: {file_path}")
+    if image.ndim == 2:
+        image = np.repeat(image[..., None], 3, axis=-1)
+    # Same scaling as plt.imread, from the full integer range to [0, 1]
+    scale = 2**16 - 1 if image.dtype == np.uint16 else 2**8 - 1
+    return np.divide(image[..., 2::-1], scale, dtype=np.float32)
+
+
+def _read_png_size(file_path: Path) -> tuple[int, int]:
+    with open(file_path, "rb") as f:
+        header = f.read(24)
+    if header[:8] != b"\x89PNG\r\n\x1a\n" or header[12:16] != b"IHDR":
+        raise ValueError(f"Not a valid PNG file: {file_path}")
+    width, height = struct.unpack(">II", header[16:24])
+    return width, height
 
 
 def _parse_dataset_custom(data_dir: Path) -> StereoData:
-    image_0 = plt.imread(data_dir / "image_0.png")[..., :3]
-    image_1 = plt.imread(data_dir / "image_1.png")[..., :3]
+    width, height = _read_png_size(data_dir / "image_0.png")
 
     lens_model_0 = LensModel.read_from_json(data_dir / "lens_model_0.json")
     lens_model_1 = LensModel.read_from_json(data_dir / "lens_model_1.json")
@@ -45,42 +176,25 @@ def _parse_dataset_custom(data_dir: Path) -> StereoData:
     expected_disparity = np.load(data_dir / "expected_disparity.npy", allow_pickle=True)
 
     return StereoData(
-        image_0=image_0,
-        image_1=image_1,
+        image_0=partial(_read_image, data_dir / "image_0.png"),
+        image_1=partial(_read_image, data_dir / "image_1.png"),
         lens_model_0=lens_model_0,
         lens_model_1=lens_model_1,
         transformation_matrix=transformation_matrix,
         expected_disparity=expected_disparity,
-        width=image_0.shape[1],
-        height=image_0.shape[0],
+        width=width,
+        height=height,
     )
 
 
-def _load_pfm(file_path: Path) -> NDArray[Shape["H, W"], Float32]:
-    with open(file_path, "rb") as f:
-        header = f.readline().decode().strip()
-        if header not in {"PF", "Pf"}:
-            raise ValueError("Not a valid PFM file.")
-
-        dimensions = f.readline().decode().strip()
-        width, height = map(int, dimensions.split())
-
-        scale = float(f.readline().decode().strip())
-        endian = "<" if scale < 0 else ">"
-        data_type = endian + "f"
-
-        disparity_data = np.fromfile(f, data_type).reshape((height, width))
-        disparity_data = np.flipud(disparity_data)
-        return disparity_data
+def _load_ground_truth_disparity(file_path: Path) -> NDArray[Shape["H, W"], Float32]:
+    # The map is copy-on-write, so only pages holding invalid values are copied
+    ground_truth_disparity = read_pfm(file_path, memory_map=True)
+    ground_truth_disparity[~np.isfinite(ground_truth_disparity)] = np.nan
+    return ground_truth_disparity
 
 
 def _parse_dataset_mobile(data_dir: Path) -> StereoData:
-    image_0 = plt.imread(data_dir / "im0.png")[..., :3]
-    image_1 = plt.imread(data_dir / "im1.png")[..., :3]
-    ground_truth_disparity = _load_pfm(data_dir / "disp0.pfm")
-
-    ground_truth_disparity[~np.isfinite(ground_truth_disparity)] = np.nan
-
     with open(data_dir / "calib.txt", encoding="utf-8") as f:
         calibration_data = f.readlines()
     calibration_data_splitted = [
@@ -129,13 +243,213 @@ def _parse_dataset_mobile(data_dir: Path) -> StereoData:
     vmax = int(calibration_data_dict["vmax"])
 
     return StereoData(
-        image_0=image_0,
-        image_1=image_1,
+        image_0=partial(_read_image, data_dir / "im0.png"),
+        image_1=partial(_read_image, data_dir / "im1.png"),
         lens_model_0=lens_model_0,
         lens_model_1=lens_model_1,
         transformation_matrix=transformation_matrix,
         expected_disparity=np.sort(np.array([vmin, vmax], dtype=np.float32)),
         width=width,
         height=height,
-        ground_truth_disparity=ground_truth_disparity,
+        ground_truth_disparity=partial(
+            _load_ground_truth_disparity, data_dir / "disp0.pfm"
+        ),
     )
+
+
+def _source_signature(data_dir: Path) -> dict[str, list[int]]:
+    file_names = (
+        _CUSTOM_SOURCE_FILES
+        if (data_dir / "image_0.png").exists()
+        else _MOBILE_SOURCE_FILES
+    )
+    signature = {}
+    for file_name in file_names:
+        stat = (data_dir / file_name).stat()
+        signature[file_name] = [stat.st_mtime_ns, stat.st_size]
+    return signature
+
+
+def _align(offset: int) -> int:
+    return -(-offset // _CACHE_ALIGNMENT) * _CACHE_ALIGNMENT
+
+
+def write_cache(stereo_data: StereoData, data_dir: Path) -> Path:
+    arrays = {
+        "image_0": stereo_data.image_0,
+        "image_1": stereo_data.image_1,
+    }
+    if stereo_data.ground_truth_disparity is not None:
+        arrays["ground_truth_disparity"] = stereo_data.ground_truth_disparity
+
+    header: dict[str, Any] = {
+        "sources": _source_signature(data_dir),
+        "lens_model_0": stereo_data.lens_model_0.to_dict(),
+        "lens_model_1": stereo_data.lens_model_1.to_dict(),
+        "transformation_matrix": stereo_data.transformation_matrix.to_dict(),
+        "expected_disparity": np.asarray(stereo_data.expected_disparity).tolist(),
+        "width": stereo_data.width,
+        "height": stereo_data.height,
+        "arrays": {},
+    }
+    # Offsets are relative to the end of the header, so they do not depend on its size
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = {
+            "offset": offset,
+            "shape": list(array.shape),
+            "dtype": np.dtype(np.float32).str,
+        }
+        offset = _align(offset + array.size * np.dtype(np.float32).itemsize)
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_offset = _align(len(_CACHE_MAGIC) + 8 + len(header_bytes))
+
+    cache_path = data_dir / _CACHE_FILE_NAME
+    temporary_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    with open(temporary_path, "wb") as f:
+        f.write(_CACHE_MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_offset + header["arrays"][name]["offset"])
+            f.write(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+        f.truncate(data_offset + offset)
+    os.replace(temporary_path, cache_path)
+    return cache_path
+
+
+def _read_cache_header(cache_path: Path) -> Optional[tuple[dict[str, Any], int]]:
+    with open(cache_path, "rb") as f:
+        if f.read(len(_CACHE_MAGIC)) != _CACHE_MAGIC:
+            return None
+        try:
+            (header_size,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_size).decode("utf-8"))
+        except (struct.error, ValueError):
+            return None
+    return header, _align(len(_CACHE_MAGIC) + 8 + header_size)
+
+
+def _cache_arrays(
+    cache_path: Path, header: dict[str, Any], data_offset: int
+) -> Optional[dict[str, np.memmap]]:
+    # A truncated file would fail to memory-map, or map past its end
+    file_size = cache_path.stat().st_size
+    descriptions = {
+        name: (
+            data_offset + description["offset"],
+            tuple(description["shape"]),
+            np.dtype(description["dtype"]),
+        )
+        for name, description in header["arrays"].items()
+    }
+    if any(
+        offset + int(np.prod(shape)) * dtype.itemsize > file_size
+        for offset, shape, dtype in descriptions.values()
+    ):
+        return None
+
+    return {
+        name: np.memmap(cache_path, dtype=dtype, mode="c", offset=offset, shape=shape)
+        for name, (offset, shape, dtype) in descriptions.items()
+    }
+
+
+def _read_cache(data_dir: Path) -> Optional[StereoData]:
+    cache_path = data_dir / _CACHE_FILE_NAME
+    if not cache_path.exists():
+        return None
+
+    cache_header = _read_cache_header(cache_path)
+    if cache_header is None:
+        return None
+    header, data_offset = cache_header
+
+    # A cache that is stale, corrupt or from another version is rebuilt
+    try:
+        if header["sources"] != _source_signature(data_dir):
+            return None
+        arrays = _cache_arrays(cache_path, header=header, data_offset=data_offset)
+        if arrays is None:
+            return None
+        return StereoData(
+            image_0=arrays["image_0"],
+            image_1=arrays["image_1"],
+            lens_model_0=LensModel.from_dict(header["lens_model_0"]),
+            lens_model_1=LensModel.from_dict(header["lens_model_1"]),
+            transformation_matrix=TransformationMatrix.from_dict(
+                header["transformation_matrix"]
+            ),
+            expected_disparity=np.array(header["expected_disparity"], dtype=np.float32),
+            width=header["width"],
+            height=header["height"],
+            ground_truth_disparity=arrays.get("ground_truth_disparity"),
+        )
+    except (FileNotFoundError, KeyError, TypeError, ValueError):
+        return None
+
+
+def find_dataset_dirs(root_dir: Path) -> list[Path]:
+    data_dirs = {
+        marker_path.parent
+        for marker_file in _DATASET_MARKER_FILES
+        for marker_path in root_dir.rglob(marker_file)
+    }
+    return sorted(data_dirs)
+
+
+def _load_stereo_data(data_dir: Path, use_cache: bool) -> StereoData:
+    return StereoData.from_path(data_dir, lazy=False, use_cache=use_cache)
+
+
+@dataclass
+class StereoDataset:
+    root_dir: Path
+    prefetch: int = 4
+    number_of_workers: int = 2
+    use_processes: bool = False
+    use_cache: bool = False
+    shard_index: int = 0
+    number_of_shards: int = 1
+    data_dirs: list[Path] = field(init=False)
+
+    def __post_init__(self) -> None:
+        if not 0 <= self.shard_index < self.number_of_shards:
+            raise ValueError("Shard index must be in [0, number_of_shards)")
+        self.data_dirs = find_dataset_dirs(self.root_dir)[
+            self.shard_index :: self.number_of_shards
+        ]
+
+    def __len__(self) -> int:
+        return len(self.data_dirs)
+
+    def _executor(self) -> Executor:
+        if self.use_processes:
+            return ProcessPoolExecutor(max_workers=self.number_of_workers)
+        return ThreadPoolExecutor(max_workers=self.number_of_workers)
+
+    def __iter__(self) -> Iterator[StereoData]:
+        pending_dirs = iter(self.data_dirs)
+        futures: deque[Future[StereoData]] = deque()
+
+        with self._executor() as executor:
+            try:
+                for data_dir in pending_dirs:
+                    futures.append(
+                        executor.submit(_load_stereo_data, data_dir, self.use_cache)
+                    )
+                    if len(futures) >= max(self.prefetch, 1):
+                        break
+
+                while futures:
+                    stereo_data = futures.popleft().result()
+                    next_dir = next(pending_dirs, None)
+                    if next_dir is not None:
+                        futures.append(
+                            executor.submit(_load_stereo_data, next_dir, self.use_cache)
+                        )
+                    yield stereo_data
+            finally:
+                for future in futures:
+                    future.cancel()
@@ -0,0 +1,353 @@
+# %% [markdown]
+# # Batch Reconstruction
+#
+# This module reconstructs a directory of captured stereo pairs offline, and is
+# installed as the `oaf-reconstruct` command:
+#
+# ```
+# oaf-reconstruct DATASET_ROOT OUTPUT_DIR --workers 4 --block-size 11 11
+# ```
+#
+# Every directory below the dataset root that `StereoData.from_path` can read is one
+# frame. The frames are distributed over a pool of worker processes. Every worker is
+# initialized once with a `StereoPipeline` for the rig of the first frame, so the
+# camera vectors and buffers are not recomputed per frame. Frames with a different
+# rig get their own pipeline, which the worker keeps for the next frames.
+#
+# For every frame the disparity is written as PFM and the points, colored with the
+# first image, as binary PLY, at the same relative path below the output directory.
+# The files are written under a temporary name and renamed when complete, so a frame
+# is done when both files exist. A second run skips the frames that are done,
+# so an interrupted reconstruction resumes where it stopped. The wall time and the
+# throughput are reported for every frame and for the full run.
+#
+# A frame that fails, for instance a corrupt image, is reported as a `FrameFailure`
+# and the other frames are still reconstructed. The command exits with an error when
+# any frame failed, and a second run retries only these frames.
+
+# %%
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, Optional, Sequence, Union
+
+import numpy as np
+from nptyping import Float32, Int32, NDArray, Shape
+
+from oaf_vision_3d._stereo_data_reader import StereoData, find_dataset_dirs
+from oaf_vision_3d.block_matching import CostFunction
+from oaf_vision_3d.pfm import write_pfm
+from oaf_vision_3d.point_cloud_io import write_ply
+from oaf_vision_3d.stereo_pipeline import StereoPipeline
+
+DISPARITY_FILE_NAME = "disparity.pfm"
+POINT_CLOUD_FILE_NAME = "points.ply"
+
+
+@dataclass(frozen=True)
+class ReconstructionOptions:
+    block_size: NDArray[Shape["[x, y]"], Int32] = field(
+        default_factory=lambda: np.array([11, 11], dtype=np.int32)
+    )
+    subpixel_fit: bool = True
+    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE
+    disparity_range: Optional[NDArray[Shape["2"], Float32]] = None
+    use_cache: bool = False
+
+
+@dataclass(frozen=True)
+class FrameResult:
+    data_dir: Path
+    wall_time_s: float
+    number_of_pixels: int
+    number_of_points: int
+
+    @property
+    def pixels_per_second(self) -> float:
+        return self.number_of_pixels / self.wall_time_s
+
+
+@dataclass(frozen=True)
+class FrameFailure:
+    data_dir: Path
+    error: str
+
+
+@dataclass
+class _WorkerState:
+    options: ReconstructionOptions = field(default_factory=ReconstructionOptions)
+    pipelines: dict[str, StereoPipeline] = field(default_factory=dict)
+
+
+_WORKER_STATE = _WorkerState()
+
+
+def frame_outputs(
+    data_dir: Path, root_dir: Path, output_dir: Path
+) -> tuple[Path, Path]:
+    frame_dir = output_dir / data_dir.relative_to(root_dir)
+    return frame_dir / DISPARITY_FILE_NAME, frame_dir / POINT_CLOUD_FILE_NAME
+
+
+def _is_done(output_paths: tuple[Path, Path]) -> bool:
+    return all(output_path.exists() for output_path in output_paths)
+
+
+def _disparity_range(
+    stereo_data: StereoData, options: ReconstructionOptions
+) -> NDArray[Shape["2"], Float32]:
+    if options.disparity_range is None:
+        return stereo_data.expected_disparity
+    return options.disparity_range
+
+
+def _rig_key(stereo_data: StereoData, options: ReconstructionOptions) -> str:
+    return json.dumps(
+        {
+            "lens_model_0": stereo_data.lens_model_0.to_dict(),
+            "lens_model_1": stereo_data.lens_model_1.to_dict(),
+            "transformation_matrix": stereo_data.transformation_matrix.to_dict(),
+            "width": stereo_data.width,
+            "height": stereo_data.height,
+            "disparity_range": np.asarray(
+                _disparity_range(stereo_data=stereo_data, options=options)
+            ).tolist(),
+        },
+        sort_keys=True,
+    )
+
+
+def _pipeline(stereo_data: StereoData) -> StereoPipeline:
+    options = _WORKER_STATE.options
+    key = _rig_key(stereo_data=stereo_data, options=options)
+    if key not in _WORKER_STATE.pipelines:
+        _WORKER_STATE.pipelines[key] = StereoPipeline(
+            lens_model_0=stereo_data.lens_model_0,
+            lens_model_1=stereo_data.lens_model_1,
+            transformation_matrix=stereo_data.transformation_matrix,
+            width=stereo_data.width,
+            height=stereo_data.height,
+            disparity_range=_disparity_range(stereo_data=stereo_data, options=options),
+            block_size=options.block_size,
+            subpixel_fit=options.subpixel_fit,
+            cost_function=options.cost_function,
+        )
+    return _WORKER_STATE.pipelines[key]
+
+
+def _initialize_worker(options: ReconstructionOptions, rig_dir: Optional[Path]) -> None:
+    _WORKER_STATE.options = options
+    _WORKER_STATE.pipelines = {}
+    if rig_dir is not None:
+        # Only the calibration is read, the images are loaded lazily. A broken rig is
+        # reported by its frame, and must not break the whole pool.
+        try:
+            _pipeline(StereoData.from_path(rig_dir, lazy=True))
+        except Exception:  # pylint: disable=broad-exception-caught
+            pass
+
+
+def _partial_path(output_path: Path) -> Path:
+    return output_path.with_name(f".{output_path.name}.partial")
+
+
+def _reconstruct_frame(data_dir: Path, output_paths: tuple[Path, Path]) -> FrameResult:
+    start = time.perf_counter()
+    stereo_data = StereoData.from_path(
+        data_dir, lazy=False, use_cache=_WORKER_STATE.options.use_cache
+    )
+    result = _pipeline(stereo_data).process(
+        image_0=stereo_data.image_0, image_1=stereo_data.image_1
+    )
+
+    disparity_path, point_cloud_path = output_paths
+    disparity_path.parent.mkdir(parents=True, exist_ok=True)
+    write_pfm(_partial_path(disparity_path), result.disparity)
+    number_of_points = write_ply(
+        file_path=_partial_path(point_cloud_path),
+        xyz=result.xyz,
+        rgb=stereo_data.image_0,
+    )
+    # The point cloud is renamed last, so a frame is only done with both files
+    os.replace(_partial_path(disparity_path), disparity_path)
+    os.replace(_partial_path(point_cloud_path), point_cloud_path)
+
+    return FrameResult(
+        data_dir=data_dir,
+        wall_time_s=time.perf_counter() - start,
+        number_of_pixels=stereo_data.width * stereo_data.height,
+        number_of_points=number_of_points,
+    )
+
+
+def pending_frames(
+    root_dir: Path, output_dir: Path, resume: bool = True
+) -> list[tuple[Path, tuple[Path, Path]]]:
+    frames = [
+        (
+            data_dir,
+            frame_outputs(data_dir=data_dir, root_dir=root_dir, output_dir=output_dir),
+        )
+        for data_dir in find_dataset_dirs(root_dir)
+    ]
+    if not resume:
+        return frames
+    return [frame for frame in frames if not _is_done(frame[1])]
+
+
+def reconstruct_dataset(
+    root_dir: Path,
+    output_dir: Path,
+    options: ReconstructionOptions = ReconstructionOptions(),
+    number_of_workers: int = 1,
+    resume: bool = True,
+) -> Iterator[Union[FrameResult, FrameFailure]]:
+    frames = pending_frames(root_dir=root_dir, output_dir=output_dir, resume=resume)
+    if not frames:
+        return
+    rig_dir = frames[0][0]
+
+    # pylint: disable=broad-exception-caught
+    if number_of_workers <= 1:
+        _initialize_worker(options=options, rig_dir=rig_dir)
+        for data_dir, output_paths in frames:
+            try:
+                yield _reconstruct_frame(data_dir=data_dir, output_paths=output_paths)
+            except Exception as error:
+                yield FrameFailure(data_dir=data_dir, error=repr(error))
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=number_of_workers,
+        initializer=_initialize_worker,
+        initargs=(options, rig_dir),
+    ) as executor:
+        futures = {
+            executor.submit(_reconstruct_frame, data_dir, output_paths): data_dir
+            for data_dir, output_paths in frames
+        }
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as error:
+                yield FrameFailure(data_dir=futures[future], error=repr(error))
+
+
+def _args(argv: Optional[Sequence[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Reconstruct disparities and point clouds for a stereo dataset"
+    )
+    parser.add_argument(
+        "root_dir", type=Path, help="Directory with one sub-directory per frame."
+    )
+    parser.add_argument(
+        "output_dir", type=Path, help="Directory to write the results to."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes.",
+        required=False,
+        default=os.cpu_count() or 1,
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        nargs=2,
+        metavar=("X", "Y"),
+        help="Block size for the matching.",
+        required=False,
+        default=[11, 11],
+    )
+    parser.add_argument(
+        "--cost-function",
+        choices=[cost_function.name for cost_function in CostFunction],
+        help="Cost function for the matching.",
+        required=False,
+        default=CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE.name,
+    )
+    parser.add_argument(
+        "--disparity-range",
+        type=float,
+        nargs=2,
+        metavar=("MIN", "MAX"),
+        help="Disparity range, instead of the expected disparity of every frame.",
+        required=False,
+        default=None,
+    )
+    parser.add_argument(
+        "--no-subpixel-fit",
+        action="store_true",
+        help="Only return integer disparities.",
+        required=False,
+        default=False,
+    )
+    parser.add_argument(
+        "--use-cache",
+        action="store_true",
+        help="Read the frames through the stereo data cache.",
+        required=False,
+        default=False,
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Reconstruct all frames, also the ones that are done.",
+        required=False,
+        default=False,
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    args = _args(argv)
+    options = ReconstructionOptions(
+        block_size=np.array(args.block_size, dtype=np.int32),
+        subpixel_fit=not args.no_subpixel_fit,
+        cost_function=CostFunction[args.cost_function],
+        disparity_range=(
+            None
+            if args.disparity_range is None
+            else np.array(args.disparity_range, dtype=np.float32)
+        ),
+        use_cache=args.use_cache,
+    )
+
+    start = time.perf_counter()
+    number_of_frames = 0
+    failures = []
+    for result in reconstruct_dataset(
+        root_dir=args.root_dir,
+        output_dir=args.output_dir,
+        options=options,
+        number_of_workers=args.workers,
+        resume=not args.no_resume,
+    ):
+        if isinstance(result, FrameFailure):
+            failures.append(result)
+            print(f"{result.data_dir}: failed, {result.error}")
+            continue
+        number_of_frames += 1
+        print(
+            f"{result.data_dir}: {result.wall_time_s:.3f} s, "
+            f"{result.pixels_per_second / 1e6:.2f} Mpx/s, "
+            f"{result.number_of_points} points"
+        )
+
+    wall_time_s = time.perf_counter() - start
+    print(
+        f"Reconstructed {number_of_frames} frames in {wall_time_s:.2f} s "
+        f"({number_of_frames / max(wall_time_s, 1e-9):.2f} frames/s)"
+    )
+    if failures:
+        raise SystemExit(f"{len(failures)} frames failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,58 @@
 # This function performs block matching to estimate the depth of a pixel in a set of 2D
 # images. The process for this was discussed in more detail in the workshop
 # [6: Stereo Matching Fundamentals](../workshops/06_stereo_matching_fundamentals.ipynb).
+#
+# With a [region of interest](region_of_interest.py) only the windows around the
+# region are matched. The windows include half a block for the aggregation and the
+# largest disparity horizontally, as the second image is shifted by up to that many
+# pixels and that many columns at the window border are set to NaN.
+#
+# The cost volume can be stored with reduced [precision](cost_precision.py), which
+# roughly halves the memory and the memory bandwidth of the matching.
+#
+# `block_matching_cost_volume` returns the aggregated [cost volume](cost_volume.py)
+# itself, optionally memory-mapped, so it can be reduced in several ways without
+# matching again. With `output` it fills an existing cost volume instead, so a
+# [stereo pipeline](stereo_pipeline.py) allocates it only once for all frames. The
+# costs are computed with the channels first and the second image wrapped around like
+# `np.roll`, but without copying it for every disparity.
+#
+# With `disparity_bounds` every pixel searches its own range, like the disparity range
+# but as a map with the minimum and maximum disparity per pixel, row `(H, 1, 2)`,
+# column `(1, W, 2)` or, with `tile_range_map` from
+# [tiled processing](tiled_processing.py), per tile. The bounds are clipped to
+# `disparity_range`, which still decides the border that is set to NaN. For every
+# disparity only the bounding box of the pixels that search it is matched and
+# aggregated, with half a block of halo, and the best disparity is tracked per pixel
+# while the disparities are swept, so no cost volume is stored. The sub-pixel fit uses
+# the costs next to the best disparity of every pixel, and the disparity is NaN if
+# the best disparity is at either end of the range of the pixel.
 
 
 # %%
 from enum import Enum
+from pathlib import Path
+from typing import Optional
 
 import numpy as np
 from nptyping import Float32, Int32, NDArray, Shape
-from scipy.signal import convolve2d
 
-from oaf_vision_3d.poly_2_subvalue_fit import find_subvalue_poly_2
+from oaf_vision_3d.cost_precision import (
+    CostPrecision,
+    aggregate_cost_volume,
+    maximum_quantized_cost,
+    quantize_image,
+    quantized_absolute_difference,
+)
+from oaf_vision_3d.cost_volume import CostVolume, CostVolumeKind
+from oaf_vision_3d.instrumentation import stage
+from oaf_vision_3d.poly_2_subvalue_fit import subvalue_offset_poly_2
+from oaf_vision_3d.region_of_interest import (
+    RegionOfInterest,
+    Tile,
+    apply_region_of_interest,
+    region_of_interest_tiles,
+)
 
 
 class CostFunction(Enum):
@@ -21,7 +63,7 @@ class CostFunction(Enum):
     SUM_OF_SQUARED_DIFFERENCE = 1
 
 
-def _get_cost(
+def block_matching_cost(
     image_0: NDArray[Shape["H, W, ..."], Float32],
     image_1: NDArray[Shape["H, W, ..."], Float32],
     cost_function: CostFunction,
@@ -35,43 +77,359 @@ def _get_cost(
             raise ValueError("Invalid cost function")
 
 
-def block_matching(
+def block_matching_halo(
+    disparity_range: NDArray[Shape["2"], Float32],
+    block_size: NDArray[Shape["[x, y]"], Int32],
+) -> NDArray[Shape["[x, y]"], Int32]:
+    disparities = np.arange(disparity_range[0], disparity_range[1], dtype=np.int32)
+    return np.array(
+        [int(np.abs(disparities).max()) + block_size[0] // 2, block_size[1] // 2],
+        dtype=np.int32,
+    )
+
+
+def block_matching_tile(
+    tile: Tile,
     image_0: NDArray[Shape["H, W"], Float32],
     image_1: NDArray[Shape["H, W"], Float32],
     disparity_range: NDArray[Shape["2"], Float32],
     block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
     subpixel_fit: bool = True,
     cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+    disparity_bounds: Optional[NDArray[Shape["H, W, 2"], Float32]] = None,
 ) -> NDArray[Shape["H, W"], Float32]:
-    disparities = np.arange(disparity_range[0], disparity_range[1], dtype=np.int32)
-    error = []
-    for _disparity in disparities:
-        shifted_image_1 = np.roll(image_1, _disparity, axis=1)
-        single_pixel_error = _get_cost(image_0, shifted_image_1, cost_function)
-
-        convoluted_error = convolve2d(
-            convolve2d(
-                single_pixel_error,
-                np.ones((1, block_size[0])) / block_size[0],
-                mode="same",
-            ),
-            np.ones((block_size[1], 1)) / block_size[1],
-            mode="same",
+    return block_matching(
+        image_0=np.ascontiguousarray(image_0[tile.window], dtype=np.float32),
+        image_1=np.ascontiguousarray(image_1[tile.window], dtype=np.float32),
+        disparity_range=disparity_range,
+        block_size=block_size,
+        subpixel_fit=subpixel_fit,
+        cost_function=cost_function,
+        precision=precision,
+        disparity_bounds=(
+            None
+            if disparity_bounds is None
+            else _broadcast_disparity_bounds(
+                disparity_bounds, height=image_0.shape[0], width=image_0.shape[1]
+            )[tile.window]
+        ),
+    )[tile.core_in_window]
+
+
+def _fill_cost(
+    cost: NDArray[Shape["H, W"], Float32],
+    planes_0: NDArray[Shape["C, H, W"], Float32],
+    planes_1: NDArray[Shape["C, H, W"], Float32],
+    difference: NDArray[Shape["C, H, W"], Float32],
+    cost_function: CostFunction,
+) -> None:
+    np.subtract(planes_0, planes_1, out=difference)
+    match cost_function:
+        case CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE:
+            np.abs(difference, out=difference)
+        case CostFunction.SUM_OF_SQUARED_DIFFERENCE:
+            np.square(difference, out=difference)
+        case _:
+            raise ValueError("Invalid cost function")
+    difference.sum(axis=0, out=cost)
+
+
+def _fill_cost_volume(
+    costs: NDArray[Shape["D, H, W"], Float32],
+    disparities: NDArray[Shape["D"], Int32],
+    image_0: NDArray[Shape["H, W, ..."], Float32],
+    image_1: NDArray[Shape["H, W, ..."], Float32],
+    cost_function: CostFunction,
+) -> None:
+    # Channels first, so the cost is a sum of contiguous planes
+    planes_0 = np.ascontiguousarray(np.moveaxis(image_0, -1, 0), dtype=np.float32)
+    planes_1 = np.ascontiguousarray(np.moveaxis(image_1, -1, 0), dtype=np.float32)
+    difference = np.empty_like(planes_0)
+    cost = np.empty(costs.shape[1:], dtype=np.float32)
+    width = costs.shape[2]
+
+    # Same wrap around as np.roll, without copying image_1
+    for _disparity, _error in zip(disparities, costs):
+        shift = int(_disparity) % width
+        _cost = _error if _error.dtype == np.float32 else cost
+        _fill_cost(
+            cost=_cost[:, shift:],
+            planes_0=planes_0[..., shift:],
+            planes_1=planes_1[..., : width - shift],
+            difference=difference[..., shift:],
+            cost_function=cost_function,
+        )
+        _fill_cost(
+            cost=_cost[:, :shift],
+            planes_0=planes_0[..., :shift],
+            planes_1=planes_1[..., width - shift :],
+            difference=difference[..., :shift],
+            cost_function=cost_function,
         )
-        error.append(convoluted_error)
+        if _cost is not _error:
+            _error[...] = _cost
 
-    disparity_error = np.array(error, dtype=np.float32)
 
-    if subpixel_fit:
-        disparity = find_subvalue_poly_2(
-            values=disparities.astype(np.float32), function_value=disparity_error
+def block_matching_cost_volume(
+    image_0: NDArray[Shape["H, W"], Float32],
+    image_1: NDArray[Shape["H, W"], Float32],
+    disparity_range: NDArray[Shape["2"], Float32],
+    block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
+    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+    file_path: Optional[Path] = None,
+    output: Optional[CostVolume] = None,
+) -> CostVolume:
+    disparities = np.arange(disparity_range[0], disparity_range[1], dtype=np.int32)
+    if output is None:
+        cost_volume = CostVolume.empty(
+            values=disparities.astype(np.float32),
+            height=image_0.shape[0],
+            width=image_0.shape[1],
+            precision=precision,
+            kind=CostVolumeKind.DISPARITY,
+            file_path=file_path,
         )
+    elif (
+        file_path is not None
+        or output.precision != precision
+        or output.kind != CostVolumeKind.DISPARITY
+        or output.costs.shape[1:] != image_0.shape[:2]
+        or not np.array_equal(output.values, disparities)
+    ):
+        raise ValueError("Output does not match the images and the disparity range")
     else:
-        disparity = disparities[np.argmin(disparity_error, axis=0)].astype(np.float32)
+        cost_volume = output
+
+    disparity_error = cost_volume.costs
+    maximum_cost = 0
+    with stage("block_matching.cost", disparities=disparities.shape[0]):
+        if precision == CostPrecision.UINT16:
+            if cost_function != CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE:
+                raise ValueError(
+                    "Quantized costs only support the sum of absolute differences"
+                )
+            maximum_cost = maximum_quantized_cost(number_of_channels=image_0.shape[-1])
+            quantized_image_0 = quantize_image(image_0)
+            quantized_image_1 = quantize_image(image_1)
+            for _disparity, _error in zip(disparities, disparity_error):
+                _error[...] = quantized_absolute_difference(
+                    image_0=quantized_image_0,
+                    images=[np.roll(quantized_image_1, _disparity, axis=1)],
+                )
+        else:
+            _fill_cost_volume(
+                costs=disparity_error,
+                disparities=disparities,
+                image_0=image_0,
+                image_1=image_1,
+                cost_function=cost_function,
+            )
+
+    with stage("block_matching.aggregation"):
+        aggregate_cost_volume(
+            cost_volume=disparity_error,
+            block_size=block_size,
+            precision=precision,
+            maximum_cost=maximum_cost,
+        )
+    return cost_volume
+
 
+def mask_disparity_border(
+    disparity: NDArray[Shape["H, W"], Float32],
+    disparities: NDArray[Shape["D"], Float32],
+) -> NDArray[Shape["H, W"], Float32]:
+    # The border columns are matched against pixels wrapped around from the other side
     disparity[:, : int(np.abs(disparities).max())] = np.nan
     disparity[:, -int(np.abs(disparities).max()) :] = np.nan
-    disparity[disparity >= disparities.max()] = np.nan
-    disparity[disparity <= disparities.min()] = np.nan
-
     return disparity
+
+
+def _broadcast_disparity_bounds(
+    disparity_bounds: NDArray[Shape["H, W, 2"], Float32], height: int, width: int
+) -> NDArray[Shape["H, W, 2"], Float32]:
+    try:
+        return np.broadcast_to(disparity_bounds, (height, width, 2))
+    except ValueError as error:
+        raise ValueError(
+            "Disparity bounds must be a (H, W, 2), (H, 1, 2) or (1, W, 2) map"
+        ) from error
+
+
+def _disparity_span(
+    minimum: NDArray[Shape["N"], Int32],
+    maximum: NDArray[Shape["N"], Int32],
+    disparity: int,
+    halo: int,
+    size: int,
+) -> Optional[tuple[slice, slice]]:
+    # The core with the pixels that search the disparity, and the window around it
+    indices = np.flatnonzero((minimum <= disparity) & (disparity < maximum))
+    if indices.shape[0] == 0:
+        return None
+    core = slice(int(indices[0]), int(indices[-1]) + 1)
+    return core, slice(max(core.start - halo, 0), min(core.stop + halo, size))
+
+
+def _block_matching_with_bounds(
+    image_0: NDArray[Shape["H, W, ..."], Float32],
+    image_1: NDArray[Shape["H, W, ..."], Float32],
+    disparity_range: NDArray[Shape["2"], Float32],
+    disparity_bounds: NDArray[Shape["H, W, 2"], Float32],
+    block_size: NDArray[Shape["[x, y]"], Int32],
+    subpixel_fit: bool,
+    cost_function: CostFunction,
+) -> NDArray[Shape["H, W"], Float32]:
+    height, width = image_0.shape[:2]
+    disparities = np.arange(disparity_range[0], disparity_range[1], dtype=np.int32)
+    bounds = np.clip(
+        np.ceil(
+            _broadcast_disparity_bounds(disparity_bounds, height=height, width=width)
+        ),
+        disparities.min(),
+        disparities.max() + 1,
+    ).astype(np.int32)
+    minimum, maximum = bounds[..., 0], bounds[..., 1]
+    row_minimum, row_maximum = minimum.min(axis=1), maximum.max(axis=1)
+    column_minimum, column_maximum = minimum.min(axis=0), maximum.max(axis=0)
+
+    best_cost = np.full((height, width), np.inf, dtype=np.float32)
+    best_disparity = np.full((height, width), disparities.min() - 2, dtype=np.int32)
+    previous_cost = np.full((height, width), np.nan, dtype=np.float32)
+    previous_disparity = np.full((height, width), disparities.min() - 2, np.int32)
+    left_cost = np.full((height, width), np.nan, dtype=np.float32)
+    right_cost = np.full((height, width), np.nan, dtype=np.float32)
+
+    candidates = 0
+    for _disparity in disparities:
+        row_span = _disparity_span(
+            minimum=row_minimum,
+            maximum=row_maximum,
+            disparity=_disparity,
+            halo=int(block_size[1]) // 2,
+            size=height,
+        )
+        column_span = _disparity_span(
+            minimum=column_minimum,
+            maximum=column_maximum,
+            disparity=_disparity,
+            halo=int(block_size[0]) // 2,
+            size=width,
+        )
+        if row_span is None or column_span is None:
+            continue
+        tile = Tile(
+            core=(row_span[0], column_span[0]), window=(row_span[1], column_span[1])
+        )
+
+        # The columns wrap around like np.roll for the full range
+        columns = np.arange(tile.window[1].start, tile.window[1].stop) - _disparity
+        cost = block_matching_cost(
+            image_0[tile.window],
+            np.take(image_1[tile.window[0]], np.mod(columns, width), axis=1),
+            cost_function,
+        )[None, ...]
+        aggregate_cost_volume(cost_volume=cost, block_size=block_size)
+        is_searched = (minimum[tile.core] <= _disparity) & (
+            _disparity < maximum[tile.core]
+        )
+        cost = np.where(is_searched, cost[0][tile.core_in_window], np.nan)
+        candidates += int(is_searched.sum())
+
+        right_cost[tile.core] = np.where(
+            best_disparity[tile.core] == _disparity - 1, cost, right_cost[tile.core]
+        )
+        is_better = cost < best_cost[tile.core]
+        best_cost[tile.core][is_better] = cost[is_better]
+        best_disparity[tile.core][is_better] = _disparity
+        left_cost[tile.core][is_better] = np.where(
+            previous_disparity[tile.core] == _disparity - 1,
+            previous_cost[tile.core],
+            np.nan,
+        )[is_better]
+        right_cost[tile.core][is_better] = np.nan
+        previous_cost[tile.core] = cost
+        previous_disparity[tile.core] = _disparity
+
+    with stage("block_matching.subpixel_fit", candidates=candidates):
+        # Without a cost on both sides the minimum may be outside the range
+        is_bracketed = np.isfinite(left_cost) & np.isfinite(right_cost)
+        offset = (
+            subvalue_offset_poly_2(f_0=left_cost, f_1=best_cost, f_2=right_cost)
+            if subpixel_fit
+            else np.zeros((height, width), dtype=np.float32)
+        )
+        disparity = np.where(is_bracketed, best_disparity + offset, np.nan).astype(
+            np.float32
+        )
+    return mask_disparity_border(
+        disparity=disparity, disparities=disparities.astype(np.float32)
+    )
+
+
+def block_matching(
+    image_0: NDArray[Shape["H, W"], Float32],
+    image_1: NDArray[Shape["H, W"], Float32],
+    disparity_range: NDArray[Shape["2"], Float32],
+    block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
+    subpixel_fit: bool = True,
+    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE,
+    region_of_interest: Optional[RegionOfInterest] = None,
+    crop_to_region_of_interest: bool = False,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+    disparity_bounds: Optional[NDArray[Shape["H, W, 2"], Float32]] = None,
+) -> NDArray[Shape["H, W"], Float32]:
+    if disparity_bounds is not None and precision != CostPrecision.FLOAT32:
+        raise ValueError("Disparity bounds only support float32 costs")
+
+    if region_of_interest is not None:
+        disparity = np.full(image_0.shape[:2], np.nan, dtype=np.float32)
+        for tile in region_of_interest_tiles(
+            region_of_interest=region_of_interest,
+            height=image_0.shape[0],
+            width=image_0.shape[1],
+            halo=block_matching_halo(
+                disparity_range=disparity_range, block_size=block_size
+            ),
+        ):
+            disparity[tile.core] = block_matching_tile(
+                tile=tile,
+                image_0=image_0,
+                image_1=image_1,
+                disparity_range=disparity_range,
+                block_size=block_size,
+                subpixel_fit=subpixel_fit,
+                cost_function=cost_function,
+                precision=precision,
+                disparity_bounds=disparity_bounds,
+            )
+        return apply_region_of_interest(
+            values=disparity,
+            region_of_interest=region_of_interest,
+            crop=crop_to_region_of_interest,
+        )
+
+    if disparity_bounds is not None:
+        return _block_matching_with_bounds(
+            image_0=image_0,
+            image_1=image_1,
+            disparity_range=disparity_range,
+            disparity_bounds=disparity_bounds,
+            block_size=block_size,
+            subpixel_fit=subpixel_fit,
+            cost_function=cost_function,
+        )
+
+    cost_volume = block_matching_cost_volume(
+        image_0=image_0,
+        image_1=image_1,
+        disparity_range=disparity_range,
+        block_size=block_size,
+        cost_function=cost_function,
+        precision=precision,
+    )
+    with stage("block_matching.subpixel_fit"):
+        disparity = cost_volume.best_values(subpixel_fit=subpixel_fit)
+    return mask_disparity_border(disparity=disparity, disparities=cost_volume.values)
@@ -6,59 +6,299 @@
 # kernel is 2D, it is convolved directly. The function also handles NaN values in the
 # image by setting them to 0 before convolution and then dividing the result by the
 # number of non-NaN values in the kernel.
+#
+# The values and the validity mask are stacked and filtered together in a single
+# pass, using the fastest method for the kernel:
+# - Constant (box) kernels are filtered with running sums, independent of kernel size
+# - Separable kernels are filtered with two 1D passes
+# - Large kernels are filtered in the frequency domain with FFT
+# - Small non-separable kernels are filtered directly
+#
+# Whole stacks of images, like a cost volume or a burst of frames, can be filtered in
+# one call with `convolution_2d_nan_stack`, which has the same NaN semantics. Stacks can
+# be processed in chunks to bound memory, and chunks can be spread over threads.
+# `convolution_2d_stack` instead lets NaN values propagate to every output pixel whose
+# window covers them, like a plain convolution.
 
 # %%
-import warnings
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Callable, Optional
 
 import numpy as np
 from nptyping import Float32, NDArray, Shape
-from scipy.signal import convolve2d
+from scipy.ndimage import convolve, convolve1d, uniform_filter1d
 
+_MAX_SEPARABLE_KERNEL_SIZE = 15
+_MAX_DIRECT_KERNEL_ELEMENTS = 25
+_WEIGHT_TOLERANCE = 1e-5
 
-def convolution_2d_nan(
-    image: NDArray[Shape["H, W"], Float32], kernel: NDArray[Shape["K, ..."], Float32]
-) -> NDArray[Shape["H, W"], Float32]:
-    valid_image = image.copy()
 
-    isnans = np.isnan(valid_image)
-    valid_image[isnans] = 0
+class ConvolutionMethod(Enum):
+    AUTO = 0
+    DIRECT = 1
+    SEPARABLE = 2
+    BOX = 3
+    FFT = 4
 
-    warnings.filterwarnings(
-        "ignore", category=RuntimeWarning, message="invalid value encountered in divide"
-    )
+
+def _as_2d_kernel(
+    kernel: NDArray[Shape["K, ..."], Float32],
+) -> NDArray[Shape["K, L"], Float32]:
     match kernel.ndim:
         case 1:
-            convolved_valid_image = convolve2d(
-                convolve2d(
-                    valid_image,
-                    kernel[:, None],
-                    mode="same",
-                ),
-                kernel[None, :],
-                mode="same",
-            )
-            convolved_no_nan = convolve2d(
-                convolve2d(
-                    np.logical_not(isnans).astype(np.float32),
-                    kernel[:, None],
-                    mode="same",
-                ),
-                kernel[None, :],
-                mode="same",
-            )
-            return convolved_valid_image / convolved_no_nan
+            return np.outer(kernel, kernel).astype(np.float32)
         case 2:
-            convolved_valid_image = convolve2d(
-                valid_image,
-                kernel,
-                mode="same",
+            return kernel.astype(np.float32)
+        case _:
+            raise ValueError("Kernel must be 1D or 2D")
+
+
+def _separate_kernel(
+    kernel: NDArray[Shape["K, ..."], Float32],
+) -> Optional[tuple[NDArray[Shape["K"], Float32], NDArray[Shape["L"], Float32]]]:
+    if kernel.ndim == 1:
+        return kernel.astype(np.float32), kernel.astype(np.float32)
+
+    u, s, vt = np.linalg.svd(kernel.astype(np.float64))
+    if s[0] == 0 or (s.shape[0] > 1 and s[1] > 1e-6 * s[0]):
+        return None
+    scale = np.sqrt(s[0])
+    return (u[:, 0] * scale).astype(np.float32), (vt[0] * scale).astype(np.float32)
+
+
+def _is_box_kernel(kernel: NDArray[Shape["K, ..."], Float32]) -> bool:
+    return bool(np.all(kernel == kernel.flat[0]))
+
+
+def _select_method(kernel: NDArray[Shape["K, ..."], Float32]) -> ConvolutionMethod:
+    if _is_box_kernel(kernel):
+        return ConvolutionMethod.BOX
+    if _separate_kernel(kernel) is not None:
+        if max(kernel.shape) <= _MAX_SEPARABLE_KERNEL_SIZE:
+            return ConvolutionMethod.SEPARABLE
+        return ConvolutionMethod.FFT
+    if kernel.size <= _MAX_DIRECT_KERNEL_ELEMENTS:
+        return ConvolutionMethod.DIRECT
+    return ConvolutionMethod.FFT
+
+
+def _same_origin(size: int) -> int:
+    # scipy.ndimage centers even kernels one element to the right of
+    # scipy.signal.convolve2d(..., mode="same"), the same as a leading zero pad
+    return -1 if size % 2 == 0 else 0
+
+
+def _convolve_last_two_axes(
+    stack: NDArray[Shape["N, H, W"], Float32],
+    kernel: NDArray[Shape["K, ..."], Float32],
+    method: ConvolutionMethod = ConvolutionMethod.AUTO,
+) -> NDArray[Shape["N, H, W"], Float32]:
+    stack = stack.astype(np.float32, copy=False)
+    kernel_2d = _as_2d_kernel(kernel)
+    if method == ConvolutionMethod.AUTO:
+        method = _select_method(kernel)
+
+    match method:
+        case ConvolutionMethod.BOX:
+            if not _is_box_kernel(kernel):
+                raise ValueError("Box convolution requires a constant kernel")
+            height, width = kernel_2d.shape
+            # Running sums are normalized by the window size, rescale to the kernel sum
+            scale = np.float32(kernel_2d.sum())
+            return (
+                uniform_filter1d(
+                    uniform_filter1d(stack, size=height, axis=-2, mode="constant"),
+                    size=width,
+                    axis=-1,
+                    mode="constant",
+                )
+                * scale
             )
-            convolved_no_nan = convolve2d(
-                np.logical_not(isnans).astype(np.float32),
-                kernel,
+        case ConvolutionMethod.SEPARABLE:
+            separated = _separate_kernel(kernel)
+            if separated is None:
+                raise ValueError("Separable convolution requires a rank 1 kernel")
+            column, row = separated
+            return convolve1d(
+                convolve1d(
+                    stack,
+                    column,
+                    axis=-2,
+                    mode="constant",
+                    origin=_same_origin(column.shape[0]),
+                ),
+                row,
+                axis=-1,
+                mode="constant",
+                origin=_same_origin(row.shape[0]),
+            ).astype(np.float32, copy=False)
+        case ConvolutionMethod.FFT:
+            # scipy.signal is slow to import, and only needed for large kernels
+            # pylint: disable=import-outside-toplevel
+            from scipy.signal import fftconvolve
+
+            return fftconvolve(
+                stack,
+                kernel_2d.reshape((1,) * (stack.ndim - 2) + kernel_2d.shape),
                 mode="same",
+                axes=(-2, -1),
+            ).astype(np.float32, copy=False)
+        case ConvolutionMethod.DIRECT:
+            odd_kernel = np.pad(
+                kernel_2d, [(1 - size % 2, 0) for size in kernel_2d.shape]
             )
-            return convolved_valid_image / convolved_no_nan
-
+            return convolve(
+                stack,
+                odd_kernel.reshape((1,) * (stack.ndim - 2) + odd_kernel.shape),
+                mode="constant",
+            ).astype(np.float32, copy=False)
         case _:
-            raise ValueError("Kernel must be 1D or 2D")
+            raise ValueError("Invalid convolution method")
+
+
+def _weight_tolerance(
+    kernel: NDArray[Shape["K, ..."], Float32], method: ConvolutionMethod
+) -> float:
+    if method == ConvolutionMethod.AUTO:
+        method = _select_method(kernel)
+    # Running sums and FFT leave round-off residue where the true weight is zero
+    if method in (ConvolutionMethod.BOX, ConvolutionMethod.FFT):
+        return _WEIGHT_TOLERANCE * float(np.abs(_as_2d_kernel(kernel)).sum())
+    return 0.0
+
+
+def _normalize_by_weights(
+    convolved_values: NDArray[Shape["N, H, W"], Float32],
+    convolved_weights: NDArray[Shape["N, H, W"], Float32],
+    tolerance: float,
+) -> NDArray[Shape["N, H, W"], Float32]:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normalized = convolved_values / convolved_weights
+    if tolerance > 0:
+        normalized[np.abs(convolved_weights) <= tolerance] = np.nan
+    return normalized
+
+
+def _split_nans(
+    images: NDArray[Shape["N, H, W"], Float32],
+) -> NDArray[Shape["2, N, H, W"], Float32]:
+    isnans = np.isnan(images)
+
+    stack = np.empty((2, *images.shape), dtype=np.float32)
+    np.copyto(stack[0], images, casting="same_kind")
+    stack[0][isnans] = 0
+    np.copyto(stack[1], isnans, casting="unsafe")
+    return stack
+
+
+def _convolve_nan_normalized(
+    images: NDArray[Shape["N, H, W"], Float32],
+    kernel: NDArray[Shape["K, ..."], Float32],
+    method: ConvolutionMethod,
+) -> NDArray[Shape["N, H, W"], Float32]:
+    stack = _split_nans(images)
+    np.subtract(1, stack[1], out=stack[1])
+
+    convolved = _convolve_last_two_axes(stack=stack, kernel=kernel, method=method)
+    return _normalize_by_weights(
+        convolved_values=convolved[0],
+        convolved_weights=convolved[1],
+        tolerance=_weight_tolerance(kernel=kernel, method=method),
+    )
+
+
+def _convolve_nan_propagated(
+    images: NDArray[Shape["N, H, W"], Float32],
+    kernel: NDArray[Shape["K, ..."], Float32],
+    method: ConvolutionMethod,
+) -> NDArray[Shape["N, H, W"], Float32]:
+    if not np.isnan(images).any():
+        return _convolve_last_two_axes(stack=images, kernel=kernel, method=method)
+
+    stack = _split_nans(images)
+    convolved = _convolve_last_two_axes(stack=stack, kernel=kernel, method=method)
+    tolerance = _weight_tolerance(kernel=kernel, method=method)
+    convolved[0][np.abs(convolved[1]) > tolerance] = np.nan
+    return convolved[0]
+
+
+def _map_over_chunks(
+    function: Callable[[NDArray[Shape["N, H, W"], Float32]], NDArray],
+    images: NDArray[Shape["N, H, W"], Float32],
+    chunk_size: Optional[int],
+    number_of_workers: int,
+    output: Optional[NDArray[Shape["N, H, W"], Float32]],
+) -> NDArray[Shape["N, H, W"], Float32]:
+    if images.ndim != 3:
+        raise ValueError("Images must be a stack of 2D images")
+    if output is None:
+        output = np.empty(images.shape, dtype=np.float32)
+    if output.shape != images.shape:
+        raise ValueError("Output must have the same shape as the images")
+
+    number_of_images = images.shape[0]
+    if chunk_size is None:
+        chunk_size = -(-number_of_images // max(number_of_workers, 1))
+    chunk_size = max(chunk_size, 1)
+    chunks = [
+        slice(start, min(start + chunk_size, number_of_images))
+        for start in range(0, number_of_images, chunk_size)
+    ]
+
+    def _process(chunk: slice) -> None:
+        output[chunk] = function(images[chunk])
+
+    if number_of_workers > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+            list(executor.map(_process, chunks))
+    else:
+        for chunk in chunks:
+            _process(chunk)
+    return output
+
+
+def convolution_2d_nan(
+    image: NDArray[Shape["H, W"], Float32],
+    kernel: NDArray[Shape["K, ..."], Float32],
+    method: ConvolutionMethod = ConvolutionMethod.AUTO,
+) -> NDArray[Shape["H, W"], Float32]:
+    return _convolve_nan_normalized(images=image[None], kernel=kernel, method=method)[0]
+
+
+def convolution_2d_nan_stack(
+    images: NDArray[Shape["N, H, W"], Float32],
+    kernel: NDArray[Shape["K, ..."], Float32],
+    method: ConvolutionMethod = ConvolutionMethod.AUTO,
+    chunk_size: Optional[int] = None,
+    number_of_workers: int = 1,
+    output: Optional[NDArray[Shape["N, H, W"], Float32]] = None,
+) -> NDArray[Shape["N, H, W"], Float32]:
+    return _map_over_chunks(
+        function=lambda chunk: _convolve_nan_normalized(
+            images=chunk, kernel=kernel, method=method
+        ),
+        images=images,
+        chunk_size=chunk_size,
+        number_of_workers=number_of_workers,
+        output=output,
+    )
+
+
+def convolution_2d_stack(
+    images: NDArray[Shape["N, H, W"], Float32],
+    kernel: NDArray[Shape["K, ..."], Float32],
+    method: ConvolutionMethod = ConvolutionMethod.AUTO,
+    chunk_size: Optional[int] = None,
+    number_of_workers: int = 1,
+    output: Optional[NDArray[Shape["N, H, W"], Float32]] = None,
+) -> NDArray[Shape["N, H, W"], Float32]:
+    return _map_over_chunks(
+        function=lambda chunk: _convolve_nan_propagated(
+            images=chunk, kernel=kernel, method=method
+        ),
+        images=images,
+        chunk_size=chunk_size,
+        number_of_workers=number_of_workers,
+        output=output,
+    )
@@ -0,0 +1,153 @@
+# %% [markdown]
+# # Cost Precision
+#
+# The cost volumes of `block_matching` and `plane_sweeping` hold one cost per pixel and
+# disparity or depth, and their size and the memory bandwidth to fill, aggregate and
+# search them dominate the run time. With `precision` the cost volume can be stored
+# with fewer bytes:
+# - `FLOAT32` is the default, with 4 bytes per cost
+# - `FLOAT16` computes the costs in float32 and stores them with 2 bytes. The
+#   aggregation is done in float32 in chunks of the cost volume
+# - `UINT16` quantizes the images to 8 bits and computes the sum of absolute
+#   differences as integers with 2 bytes per cost. The box aggregation is done with
+#   integer running sums, and the sums are shifted right just enough to fit in 16 bits
+#
+# Only the three costs around the minimum are converted to float for the sub-pixel
+# fit. As the fit only depends on the ratio of the cost differences, the scale of the
+# quantized costs does not matter.
+
+# %%
+from enum import Enum
+
+import numpy as np
+from nptyping import Float32, Int32, NDArray, Shape, UInt8, UInt16
+
+from oaf_vision_3d.convolve2d import convolution_2d_stack
+
+_FLOAT16_AGGREGATION_CHUNK_SIZE = 8
+_QUANTIZATION_LEVELS = 255
+
+
+class CostPrecision(Enum):
+    FLOAT32 = 0
+    FLOAT16 = 1
+    UINT16 = 2
+
+
+def cost_volume_dtype(precision: CostPrecision) -> np.dtype:
+    match precision:
+        case CostPrecision.FLOAT32:
+            return np.dtype(np.float32)
+        case CostPrecision.FLOAT16:
+            return np.dtype(np.float16)
+        case CostPrecision.UINT16:
+            return np.dtype(np.uint16)
+        case _:
+            raise ValueError("Invalid cost precision")
+
+
+def quantize_image(
+    image: NDArray[Shape["H, W, ..."], Float32],
+) -> NDArray[Shape["H, W, ..."], UInt8]:
+    quantized = np.clip(image, 0.0, 1.0) * _QUANTIZATION_LEVELS + 0.5
+    return np.nan_to_num(quantized, nan=0.0).astype(np.uint8)
+
+
+def maximum_quantized_cost(number_of_channels: int, number_of_images: int = 1) -> int:
+    maximum_cost = _QUANTIZATION_LEVELS * number_of_channels * number_of_images
+    if maximum_cost > np.iinfo(np.uint16).max:
+        raise ValueError("Too many channels and images for 16-bit quantized costs")
+    return maximum_cost
+
+
+def quantized_absolute_difference(
+    image_0: NDArray[Shape["H, W, C"], UInt8],
+    images: list[NDArray[Shape["H, W, C"], UInt8]],
+) -> NDArray[Shape["H, W"], UInt16]:
+    cost = np.zeros(image_0.shape[:2], dtype=np.uint16)
+    for _image in images:
+        absolute_difference = np.maximum(image_0, _image)
+        absolute_difference -= np.minimum(image_0, _image)
+        cost += absolute_difference.sum(axis=-1, dtype=np.uint16)
+    return cost
+
+
+def _accumulator_dtype(maximum_sum: int) -> np.dtype:
+    if maximum_sum <= np.iinfo(np.uint32).max:
+        return np.dtype(np.uint32)
+    return np.dtype(np.uint64)
+
+
+def _box_sum_along_axis(
+    values: NDArray[Shape["H, W"], UInt16],
+    size: int,
+    axis: int,
+    dtype: np.dtype,
+) -> NDArray[Shape["H, W"], UInt16]:
+    # Zero padded and centered like scipy.ndimage.uniform_filter1d, so the window of
+    # pixel i starts at i - size // 2
+    length = values.shape[axis]
+    padding = [(0, 0), (0, 0)]
+    padding[axis] = (1, 0)
+    running_sum = np.pad(np.cumsum(values, axis=axis, dtype=dtype), padding)
+    start = np.arange(length) - size // 2
+    return np.take(running_sum, np.clip(start + size, 0, length), axis=axis) - np.take(
+        running_sum, np.clip(start, 0, length), axis=axis
+    )
+
+
+def _aggregate_quantized(
+    cost_volume: NDArray,
+    block_size: NDArray[Shape["[x, y]"], Int32],
+    maximum_cost: int,
+) -> None:
+    height, width = cost_volume.shape[1:]
+    block_width, block_height = int(block_size[0]), int(block_size[1])
+    maximum_sum = maximum_cost * block_width * block_height
+    shift = max(int(maximum_sum).bit_length() - 16, 0)
+    row_dtype = _accumulator_dtype(maximum_cost * height)
+    column_dtype = _accumulator_dtype(maximum_cost * block_height * width)
+
+    for _cost in cost_volume:
+        box_sum = _box_sum_along_axis(
+            values=_box_sum_along_axis(
+                values=_cost, size=block_height, axis=0, dtype=row_dtype
+            ),
+            size=block_width,
+            axis=1,
+            dtype=column_dtype,
+        )
+        np.right_shift(box_sum, shift, out=box_sum)
+        _cost[...] = box_sum
+
+
+def aggregate_cost_volume(
+    cost_volume: NDArray,
+    block_size: NDArray[Shape["[x, y]"], Int32],
+    precision: CostPrecision = CostPrecision.FLOAT32,
+    maximum_cost: int = 0,
+) -> NDArray:
+    kernel = np.full(
+        (block_size[1], block_size[0]),
+        1 / (block_size[0] * block_size[1]),
+        dtype=np.float32,
+    )
+    match precision:
+        case CostPrecision.FLOAT32:
+            convolution_2d_stack(images=cost_volume, kernel=kernel, output=cost_volume)
+        case CostPrecision.FLOAT16:
+            convolution_2d_stack(
+                images=cost_volume,
+                kernel=kernel,
+                chunk_size=_FLOAT16_AGGREGATION_CHUNK_SIZE,
+                output=cost_volume,
+            )
+        case CostPrecision.UINT16:
+            _aggregate_quantized(
+                cost_volume=cost_volume,
+                block_size=block_size,
+                maximum_cost=maximum_cost,
+            )
+        case _:
+            raise ValueError("Invalid cost precision")
+    return cost_volume
@@ -0,0 +1,193 @@
+# %% [markdown]
+# # Cost Volume
+#
+# Both `block_matching` and `plane_sweeping` build an aggregated cost volume, with
+# one cost per candidate value (disparity or depth) and pixel, and then reduce it to
+# the best value per pixel. Building the cost volume is the expensive part, while the
+# reductions are cheap. `CostVolume` keeps the cost volume together with its candidate
+# values, its [precision](cost_precision.py) and whether the values are disparities
+# or depths, so it can be reduced several times without matching again:
+# - `argmin` gives the candidate value with the lowest cost
+# - `subpixel` refines the minimum with a second order polynomial fit
+# - `confidence` is one minus the ratio of the lowest to the mean cost, which is close
+#   to zero for textureless pixels where all candidates match equally well
+# - `right_view` gives the cost volume with the right image as reference, see
+#   [left-right consistency](left_right_consistency.py)
+#
+# Candidate values at the ends of the range are not trusted, as the true minimum may
+# be outside the range, so they are set to NaN.
+#
+# The costs can be memory-mapped: `CostVolume.empty` with a file path allocates them
+# as a `.npy` file with the metadata next to it in a `.json` file, and
+# `CostVolume.read` opens a written cost volume memory-mapped again.
+
+# %%
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from nptyping import Float32, NDArray, Shape
+
+from oaf_vision_3d.cost_precision import CostPrecision, cost_volume_dtype
+from oaf_vision_3d.poly_2_subvalue_fit import find_subvalue_poly_2
+
+
+class CostVolumeKind(Enum):
+    DISPARITY = 0
+    DEPTH = 1
+
+
+def _largest_cost(dtype: np.dtype) -> float:
+    if np.issubdtype(dtype, np.integer):
+        return float(np.iinfo(dtype).max)
+    # Finite and with headroom, so the sub-pixel fit does not overflow
+    return float(np.finfo(dtype).max) / 4
+
+
+def _metadata_path(file_path: Path) -> Path:
+    return file_path.with_suffix(".json")
+
+
+def _is_same_file(file_name: Optional[str], file_path: Path) -> bool:
+    return file_name is not None and Path(file_name).resolve() == file_path.resolve()
+
+
+@dataclass
+class CostVolume:
+    values: NDArray[Shape["D"], Float32]
+    costs: NDArray[Shape["D, H, W"], Float32]
+    precision: CostPrecision = CostPrecision.FLOAT32
+    kind: CostVolumeKind = CostVolumeKind.DISPARITY
+
+    def __post_init__(self) -> None:
+        if self.costs.ndim != 3 or self.costs.shape[0] != self.values.shape[0]:
+            raise ValueError("Costs must have the shape (number of values, H, W)")
+
+    @property
+    def height(self) -> int:
+        return self.costs.shape[1]
+
+    @property
+    def width(self) -> int:
+        return self.costs.shape[2]
+
+    @staticmethod
+    def empty(
+        values: NDArray[Shape["D"], Float32],
+        height: int,
+        width: int,
+        precision: CostPrecision = CostPrecision.FLOAT32,
+        kind: CostVolumeKind = CostVolumeKind.DISPARITY,
+        file_path: Optional[Path] = None,
+    ) -> CostVolume:
+        shape = (values.shape[0], height, width)
+        dtype = cost_volume_dtype(precision)
+        if file_path is None:
+            costs = np.empty(shape, dtype=dtype)
+        else:
+            costs = np.lib.format.open_memmap(
+                file_path, mode="w+", dtype=dtype, shape=shape
+            )
+
+        cost_volume = CostVolume(
+            values=np.asarray(values, dtype=np.float32),
+            costs=costs,
+            precision=precision,
+            kind=kind,
+        )
+        if file_path is not None:
+            cost_volume.write_metadata(file_path)
+        return cost_volume
+
+    def _mask_range(
+        self, best_values: NDArray[Shape["H, W"], Float32]
+    ) -> NDArray[Shape["H, W"], Float32]:
+        best_values[best_values >= self.values.max()] = np.nan
+        best_values[best_values <= self.values.min()] = np.nan
+        return best_values
+
+    def argmin(self) -> NDArray[Shape["H, W"], Float32]:
+        return self._mask_range(
+            self.values[np.argmin(self.costs, axis=0)].astype(np.float32)
+        )
+
+    def subpixel(self) -> NDArray[Shape["H, W"], Float32]:
+        return self._mask_range(
+            find_subvalue_poly_2(values=self.values, function_value=self.costs)
+        )
+
+    def best_values(self, subpixel_fit: bool = True) -> NDArray[Shape["H, W"], Float32]:
+        return self.subpixel() if subpixel_fit else self.argmin()
+
+    def confidence(self) -> NDArray[Shape["H, W"], Float32]:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (
+                1
+                - self.costs.min(axis=0).astype(np.float32)
+                / self.costs.mean(axis=0, dtype=np.float32)
+            ).astype(np.float32, copy=False)
+
+    def right_view(
+        self, output: Optional[NDArray[Shape["D, H, W"], Float32]] = None
+    ) -> CostVolume:
+        # The cost of right pixel x at disparity d is the cost of left pixel x + d.
+        # The output can be the costs themselves, as every slice is shifted on its own
+        if self.kind != CostVolumeKind.DISPARITY:
+            raise ValueError("The right view requires a disparity cost volume")
+        if output is None:
+            output = np.empty_like(self.costs)
+        if output.shape != self.costs.shape:
+            raise ValueError("Output must have the same shape as the costs")
+
+        largest_cost = _largest_cost(self.costs.dtype)
+        for _value, _cost, _right_cost in zip(self.values, self.costs, output):
+            shift = int(np.clip(np.round(_value), -self.width, self.width))
+            if shift >= 0:
+                _right_cost[:, : self.width - shift] = _cost[:, shift:]
+                _right_cost[:, self.width - shift :] = largest_cost
+            else:
+                _right_cost[:, -shift:] = _cost[:, : self.width + shift]
+                _right_cost[:, :-shift] = largest_cost
+
+        return CostVolume(
+            values=self.values,
+            costs=output,
+            precision=self.precision,
+            kind=self.kind,
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            "values": self.values.tolist(),
+            "precision": self.precision.name,
+            "kind": self.kind.name,
+        }
+
+    def write_metadata(self, file_path: Path) -> None:
+        with _metadata_path(file_path).open("w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=4)
+
+    def write(self, file_path: Path) -> None:
+        # Costs memory-mapped from the same file only need to be flushed
+        costs = self.costs
+        if isinstance(costs, np.memmap) and _is_same_file(costs.filename, file_path):
+            costs.flush()
+        else:
+            np.save(file_path, self.costs)
+        self.write_metadata(file_path)
+
+    @staticmethod
+    def read(file_path: Path, memory_map: bool = True) -> CostVolume:
+        with _metadata_path(file_path).open("r", encoding="utf-8") as file:
+            metadata = json.load(file)
+        return CostVolume(
+            values=np.array(metadata["values"], dtype=np.float32),
+            costs=np.load(file_path, mmap_mode="r" if memory_map else None),
+            precision=CostPrecision[metadata["precision"]],
+            kind=CostVolumeKind[metadata["kind"]],
+        )
@@ -0,0 +1,502 @@
+# %% [markdown]
+# # Depth Service
+#
+# `DepthService` serves depth requests from several camera clients over a local TCP
+# socket, around the blocking `StereoPipeline`. Every message is a small header with
+# a magic number and the length of a JSON header, the JSON header, and a raw binary
+# payload:
+# - A frame request names a rig, the output (`disparity` or `xyz`) and the shape of
+#   the images, followed by both images as float32
+# - The response has the shape of the result, followed by the result as float32, or
+#   an error message
+# - A metrics request returns the metrics as JSON
+#
+# The rigs are configured once with `RigConfiguration`. The service runs a pool of
+# worker processes that build a `StereoPipeline` for every rig when they start, so
+# the lens models, camera vectors and buffers are preloaded before the first frame.
+#
+# The frames wait in a bounded queue. When it is full, the connections stop reading
+# until there is room again, which slows the clients down instead of growing the
+# queue. A batcher collects up to `max_batch_size` frames of the same rig and output,
+# waiting at most `batch_timeout_s` for more, and sends every batch to the pool as
+# one task. At most one batch per worker is in flight, so the frames queue in the
+# service, where they are counted, and not in the pool.
+#
+# The metrics hold the 50th and 99th percentile of the latency from receiving a
+# frame to sending its result over the last `latency_window` frames, the current
+# and the largest queue depth, and the number of frames and batches. `DepthClient`
+# is a local client for the protocol, for tests and as a reference for other clients.
+
+# %%
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import struct
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+import numpy as np
+from nptyping import Float32, Int32, NDArray, Shape
+
+from oaf_vision_3d._stereo_data_reader import StereoData
+from oaf_vision_3d.block_matching import CostFunction
+from oaf_vision_3d.lens_model import LensModel
+from oaf_vision_3d.stereo_pipeline import StereoPipeline
+from oaf_vision_3d.transformation_matrix import TransformationMatrix
+
+_MAGIC = b"OAFD"
+_PREFIX = struct.Struct("<4sI")
+_OUTPUTS = ("disparity", "xyz")
+
+
+@dataclass(frozen=True)
+class RigConfiguration:
+    lens_model_0: LensModel
+    lens_model_1: LensModel
+    transformation_matrix: TransformationMatrix
+    width: int
+    height: int
+    disparity_range: NDArray[Shape["2"], Float32]
+    block_size: NDArray[Shape["[x, y]"], Int32] = field(
+        default_factory=lambda: np.array([11, 11], dtype=np.int32)
+    )
+    subpixel_fit: bool = True
+    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE
+
+    @staticmethod
+    def from_stereo_data(stereo_data: StereoData) -> RigConfiguration:
+        return RigConfiguration(
+            lens_model_0=stereo_data.lens_model_0,
+            lens_model_1=stereo_data.lens_model_1,
+            transformation_matrix=stereo_data.transformation_matrix,
+            width=stereo_data.width,
+            height=stereo_data.height,
+            disparity_range=stereo_data.expected_disparity,
+        )
+
+    def pipeline(self) -> StereoPipeline:
+        return StereoPipeline(
+            lens_model_0=self.lens_model_0,
+            lens_model_1=self.lens_model_1,
+            transformation_matrix=self.transformation_matrix,
+            width=self.width,
+            height=self.height,
+            disparity_range=self.disparity_range,
+            block_size=self.block_size,
+            subpixel_fit=self.subpixel_fit,
+            cost_function=self.cost_function,
+        )
+
+
+_WORKER_PIPELINES: dict[str, StereoPipeline] = {}
+
+
+def _initialize_worker(rigs: dict[str, RigConfiguration]) -> None:
+    _WORKER_PIPELINES.clear()
+    for name, rig in rigs.items():
+        _WORKER_PIPELINES[name] = rig.pipeline()
+
+
+def _process_batch(
+    rig_name: str,
+    output: str,
+    frames: list[tuple[NDArray[Shape["H, W, C"], Float32], ...]],
+) -> list[NDArray[Shape["H, W, ..."], Float32]]:
+    pipeline = _WORKER_PIPELINES[rig_name]
+    results = []
+    for image_0, image_1 in frames:
+        disparity, _ = pipeline.match(image_0=image_0, image_1=image_1)
+        if output == "xyz":
+            results.append(pipeline.triangulate(disparity=disparity))
+        else:
+            results.append(disparity)
+    return results
+
+
+def encode_message(header: dict[str, Any], payload: bytes = b"") -> bytes:
+    encoded_header = json.dumps({**header, "payload_size": len(payload)}).encode()
+    return _PREFIX.pack(_MAGIC, len(encoded_header)) + encoded_header + payload
+
+
+async def read_message(
+    reader: asyncio.StreamReader,
+) -> Optional[tuple[dict[str, Any], bytes]]:
+    try:
+        magic, header_size = _PREFIX.unpack(await reader.readexactly(_PREFIX.size))
+    except asyncio.IncompleteReadError:
+        return None
+    if magic != _MAGIC:
+        raise ValueError("Invalid message")
+    header = json.loads(await reader.readexactly(header_size))
+    return header, await reader.readexactly(int(header["payload_size"]))
+
+
+@dataclass
+class ServiceMetrics:
+    latency_window: int = 1000
+    number_of_frames: int = 0
+    number_of_batches: int = 0
+    queue_depth: int = 0
+    max_queue_depth: int = 0
+    _latencies_s: deque[float] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._latencies_s = deque(maxlen=self.latency_window)
+
+    def add_latency(self, latency_s: float) -> None:
+        self.number_of_frames += 1
+        self._latencies_s.append(latency_s)
+
+    def set_queue_depth(self, queue_depth: int) -> None:
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def to_dict(self) -> dict[str, Any]:
+        p50, p99 = (
+            np.percentile(np.array(self._latencies_s), [50, 99]).tolist()
+            if self._latencies_s
+            else (float("nan"), float("nan"))
+        )
+        return {
+            "p50_latency_s": p50,
+            "p99_latency_s": p99,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "number_of_frames": self.number_of_frames,
+            "number_of_batches": self.number_of_batches,
+        }
+
+
+@dataclass
+class _Request:
+    rig_name: str
+    output: str
+    images: tuple[NDArray[Shape["H, W, C"], Float32], ...]
+    received: float
+    result: asyncio.Future[NDArray[Shape["H, W, ..."], Float32]]
+
+    @property
+    def batch_key(self) -> tuple[str, str]:
+        return self.rig_name, self.output
+
+
+@dataclass
+class DepthService:
+    rigs: dict[str, RigConfiguration]
+    number_of_workers: int = 1
+    max_queue_size: int = 16
+    max_batch_size: int = 4
+    batch_timeout_s: float = 0.005
+    latency_window: int = 1000
+    metrics: ServiceMetrics = field(init=False)
+    _queue: asyncio.Queue[_Request] = field(init=False, repr=False)
+    _executor: Optional[ProcessPoolExecutor] = field(
+        init=False, default=None, repr=False
+    )
+    _server: Optional[asyncio.Server] = field(init=False, default=None, repr=False)
+    _tasks: set[asyncio.Task] = field(init=False, default_factory=set, repr=False)
+    _held_request: Optional[_Request] = field(init=False, default=None, repr=False)
+    _connections: dict[asyncio.StreamWriter, asyncio.Task] = field(
+        init=False, default_factory=dict, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        self.metrics = ServiceMetrics(latency_window=self.latency_window)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> tuple[str, int]:
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.number_of_workers,
+            initializer=_initialize_worker,
+            initargs=(self.rigs,),
+        )
+        self._tasks.add(asyncio.create_task(self._batch_requests()))
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        address = self._server.sockets[0].getsockname()
+        return address[0], address[1]
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            raise ValueError("The service is not started")
+        await self._server.serve_forever()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        # Closing the connections ends their handlers at the next read
+        for writer in self._connections:
+            writer.close()
+        await asyncio.gather(*self._connections.values(), return_exceptions=True)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+    async def __aenter__(self) -> DepthService:
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        await self.close()
+
+    def _parse_request(self, header: dict[str, Any], payload: bytes) -> _Request:
+        rig_name, output = header.get("rig"), header.get("output", "disparity")
+        if rig_name not in self.rigs:
+            raise ValueError(f"Unknown rig {rig_name}")
+        if output not in _OUTPUTS:
+            raise ValueError(f"Output must be one of {_OUTPUTS}")
+        shape = tuple(int(size) for size in header["shape"])
+        rig = self.rigs[rig_name]
+        if len(shape) != 3 or shape[:2] != (rig.height, rig.width):
+            raise ValueError(
+                f"Images must have the shape ({rig.height}, {rig.width}, C)"
+            )
+        if len(payload) != 2 * int(np.prod(shape)) * 4:
+            raise ValueError("The payload must hold two float32 images")
+
+        images = np.frombuffer(payload, dtype="<f4").reshape(2, *shape)
+        return _Request(
+            rig_name=rig_name,
+            output=output,
+            images=(images[0], images[1]),
+            received=time.perf_counter(),
+            result=asyncio.get_running_loop().create_future(),
+        )
+
+    async def _respond(
+        self, header: dict[str, Any], payload: bytes
+    ) -> tuple[dict[str, Any], bytes]:
+        if header.get("type") == "metrics":
+            return {"status": "ok", "metrics": self.metrics.to_dict()}, b""
+
+        try:
+            request = self._parse_request(header=header, payload=payload)
+        except (KeyError, ValueError) as error:
+            return {"status": "error", "error": str(error)}, b""
+
+        # Waits while the queue is full, so the client is not read from meanwhile
+        await self._queue.put(request)
+        self.metrics.set_queue_depth(self._queue.qsize())
+        try:
+            result = await request.result
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            return {"status": "error", "error": str(error)}, b""
+
+        self.metrics.add_latency(time.perf_counter() - request.received)
+        return {"status": "ok", "shape": list(result.shape), "dtype": "<f4"}, (
+            np.ascontiguousarray(result, dtype="<f4").tobytes()
+        )
+
+    async def _handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        handler = asyncio.current_task()
+        if handler is not None:
+            self._connections[writer] = handler
+        try:
+            while (message := await read_message(reader)) is not None:
+                header, payload = await self._respond(*message)
+                writer.write(
+                    encode_message(
+                        {"request_id": message[0].get("request_id"), **header}, payload
+                    )
+                )
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    async def _next_batch(self) -> list[_Request]:
+        if self._held_request is None:
+            batch = [await self._queue.get()]
+        else:
+            batch, self._held_request = [self._held_request], None
+        deadline = time.perf_counter() + self.batch_timeout_s
+        while len(batch) < self.max_batch_size:
+            try:
+                request = await asyncio.wait_for(
+                    self._queue.get(), timeout=max(deadline - time.perf_counter(), 0)
+                )
+            except asyncio.TimeoutError:
+                break
+            if request.batch_key != batch[0].batch_key:
+                # Different rigs or outputs are not batched, the request starts the
+                # next batch
+                self._held_request = request
+                break
+            batch.append(request)
+        self.metrics.set_queue_depth(self._queue.qsize())
+        return batch
+
+    async def _run_batch(self, batch: list[_Request], slots: asyncio.Semaphore) -> None:
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                _process_batch,
+                batch[0].rig_name,
+                batch[0].output,
+                [request.images for request in batch],
+            )
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            # Whatever the worker raised, or a broken pool, so no request waits forever
+            for request in batch:
+                if not request.result.done():
+                    request.result.set_exception(error)
+        else:
+            for request, result in zip(batch, results):
+                if not request.result.done():
+                    request.result.set_result(result)
+        finally:
+            slots.release()
+
+    async def _batch_requests(self) -> None:
+        slots = asyncio.Semaphore(self.number_of_workers)
+        while True:
+            await slots.acquire()
+            batch = await self._next_batch()
+            self.metrics.number_of_batches += 1
+            task = asyncio.create_task(self._run_batch(batch=batch, slots=slots))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+
+@dataclass
+class DepthClient:
+    host: str
+    port: int
+    _reader: Optional[asyncio.StreamReader] = field(
+        init=False, default=None, repr=False
+    )
+    _writer: Optional[asyncio.StreamWriter] = field(
+        init=False, default=None, repr=False
+    )
+    _request_id: int = field(init=False, default=0, repr=False)
+
+    async def connect(self) -> DepthClient:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        return self
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            await self._writer.wait_closed()
+
+    async def __aenter__(self) -> DepthClient:
+        return await self.connect()
+
+    async def __aexit__(self, *_: object) -> None:
+        await self.close()
+
+    async def _exchange(
+        self, header: dict[str, Any], payload: bytes = b""
+    ) -> tuple[dict[str, Any], bytes]:
+        if self._reader is None or self._writer is None:
+            raise ValueError("The client is not connected")
+        self._request_id += 1
+        self._writer.write(
+            encode_message({**header, "request_id": self._request_id}, payload)
+        )
+        await self._writer.drain()
+        message = await read_message(self._reader)
+        if message is None:
+            raise ConnectionError("The service closed the connection")
+        if message[0]["status"] != "ok":
+            raise ValueError(message[0]["error"])
+        return message
+
+    async def request(
+        self,
+        rig: str,
+        image_0: NDArray[Shape["H, W, C"], Float32],
+        image_1: NDArray[Shape["H, W, C"], Float32],
+        output: str = "disparity",
+    ) -> NDArray[Shape["H, W, ..."], Float32]:
+        header, payload = await self._exchange(
+            {"type": "frame", "rig": rig, "output": output, "shape": image_0.shape},
+            np.ascontiguousarray(np.stack([image_0, image_1]), dtype="<f4").tobytes(),
+        )
+        return np.frombuffer(payload, dtype=np.float32).reshape(header["shape"])
+
+    async def metrics(self) -> dict[str, Any]:
+        header, _ = await self._exchange({"type": "metrics"})
+        return header["metrics"]
+
+
+def _args(argv: Optional[Sequence[str]]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve depth requests for stereo rigs")
+    parser.add_argument(
+        "--rig",
+        action="append",
+        metavar="NAME=DATA_DIR",
+        help="Rig name and a dataset directory with its calibration.",
+        required=True,
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        help="Host to listen on.",
+        required=False,
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "--port", type=int, help="Port to listen on.", required=False, default=8765
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of worker processes.",
+        required=False,
+        default=1,
+    )
+    parser.add_argument(
+        "--max-queue-size",
+        type=int,
+        help="Number of frames that can wait before the clients are slowed down.",
+        required=False,
+        default=16,
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        help="Largest number of frames per batch.",
+        required=False,
+        default=4,
+    )
+    return parser.parse_args(argv)
+
+
+async def _serve(args: argparse.Namespace) -> None:
+    rigs = {}
+    for rig in args.rig:
+        name, data_dir = rig.split("=", 1)
+        rigs[name] = RigConfiguration.from_stereo_data(
+            StereoData.from_path(Path(data_dir), lazy=True)
+        )
+
+    async with DepthService(
+        rigs=rigs,
+        number_of_workers=args.workers,
+        max_queue_size=args.max_queue_size,
+        max_batch_size=args.max_batch_size,
+    ) as service:
+        host, port = await service.start(host=args.host, port=args.port)
+        print(f"Serving {', '.join(rigs)} on {host}:{port}")
+        await service.serve_forever()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    asyncio.run(_serve(_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# %% [markdown]
+# # Frame Transport
+#
+# When capture, matching and triangulation run in separate processes, every image,
+# disparity and point map sent through a `multiprocessing.Queue` is pickled, copied
+# through a pipe and unpickled. `FrameRing` keeps the frames in one block of shared
+# memory instead, split into a fixed number of slots. Every slot holds one frame with
+# the arrays of `FrameLayout`, by default the images of `StereoData` and the
+# disparity, confidence and points of `StereoResult`, as float32 at a fixed offset.
+#
+# The stages only send `FrameMessage`s with the slot and the index of the frame
+# through their queues, and read and write the arrays of the slot in place:
+# - The producer takes a free slot with `acquire`, fills it, for example with
+#   `send_stereo_data`, and puts the message on the queue of the first stage
+# - `run_stage` calls a stage function with the arrays of the slot of every message,
+#   and passes the message on to the next queue, until it receives `None`. When the
+#   stage function fails, the stage gives the slot of the frame back to the ring, and
+#   the slots of all frames it still receives until `None`, and passes `None` on
+# - The consumer reads the frames with `receive_frames`, which gives the slot back to
+#   the ring after every frame, so the arrays must be copied to be kept
+#
+# `acquire` blocks while all slots are in use, so the memory is bounded by the number
+# of slots, and a slow stage slows the producer down. The ring can be passed as an
+# argument to `multiprocessing.Process`, and the process attaches to the same shared
+# memory. The queue of free slots is created with `context`, which has to be the
+# context that starts the processes, for example `multiprocessing.get_context("spawn")`.
+# Only the process that created the ring unlinks the memory in `close`, also when
+# a forked process inherits the ring without pickling it.
+
+# %%
+from __future__ import annotations
+
+import multiprocessing
+import os
+from dataclasses import dataclass, field
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable, Iterator, Optional
+
+import numpy as np
+from nptyping import Float32, NDArray, Shape
+
+from oaf_vision_3d._stereo_data_reader import StereoData
+from oaf_vision_3d.stereo_pipeline import StereoPipeline
+
+_ALIGNMENT = 64
+
+SlotArrays = dict[str, NDArray[Shape["*, ..."], Float32]]
+StageFunction = Callable[[SlotArrays], None]
+
+
+def _align(offset: int) -> int:
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+@dataclass(frozen=True)
+class FrameLayout:
+    fields: tuple[tuple[str, tuple[int, ...]], ...]
+
+    @staticmethod
+    def stereo(
+        width: int, height: int, channels: int = 3, ground_truth: bool = False
+    ) -> FrameLayout:
+        fields: list[tuple[str, tuple[int, ...]]] = [
+            ("image_0", (height, width, channels)),
+            ("image_1", (height, width, channels)),
+        ]
+        if ground_truth:
+            fields.append(("ground_truth_disparity", (height, width)))
+        fields += [
+            ("disparity", (height, width)),
+            ("confidence", (height, width)),
+            ("xyz", (height, width, 3)),
+        ]
+        return FrameLayout(fields=tuple(fields))
+
+    @staticmethod
+    def from_stereo_data(
+        stereo_data: StereoData, ground_truth: bool = False
+    ) -> FrameLayout:
+        return FrameLayout.stereo(
+            width=stereo_data.width,
+            height=stereo_data.height,
+            ground_truth=ground_truth,
+        )
+
+    @property
+    def offsets(self) -> dict[str, int]:
+        offsets = {}
+        offset = 0
+        for name, shape in self.fields:
+            offsets[name] = offset
+            offset = _align(
+                offset + int(np.prod(shape)) * np.dtype(np.float32).itemsize
+            )
+        return offsets
+
+    @property
+    def slot_size(self) -> int:
+        name, shape = self.fields[-1]
+        return _align(
+            self.offsets[name] + int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        )
+
+
+@dataclass(frozen=True)
+class FrameMessage:
+    slot: int
+    frame_index: int
+
+
+@dataclass
+class FrameRing:
+    layout: FrameLayout
+    number_of_slots: int = 4
+    context: Any = field(default=multiprocessing, repr=False)
+    _shared_memory: SharedMemory = field(init=False, repr=False)
+    _free_slots: Any = field(init=False, repr=False)
+    _slots: list[SlotArrays] = field(init=False, repr=False)
+    _owner_pid: int = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.number_of_slots < 1:
+            raise ValueError("The ring needs at least one slot")
+        self._shared_memory = SharedMemory(
+            create=True, size=self.number_of_slots * self.layout.slot_size
+        )
+        self._owner_pid = os.getpid()
+        self._free_slots = self.context.Queue()
+        for slot in range(self.number_of_slots):
+            self._free_slots.put(slot)
+        self._slots = self._slot_views()
+
+    def __getstate__(self) -> dict[str, Any]:
+        return {
+            "layout": self.layout,
+            "number_of_slots": self.number_of_slots,
+            "name": self._shared_memory.name,
+            "free_slots": self._free_slots,
+            "owner_pid": self._owner_pid,
+        }
+
+    def __setstate__(self, state: dict[str, Any]) -> None:
+        self.layout = state["layout"]
+        self.number_of_slots = state["number_of_slots"]
+        self.context = multiprocessing
+        self._shared_memory = SharedMemory(name=state["name"])
+        self._free_slots = state["free_slots"]
+        self._slots = self._slot_views()
+        self._owner_pid = state["owner_pid"]
+
+    def __enter__(self) -> FrameRing:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def _slot_views(self) -> list[SlotArrays]:
+        offsets = self.layout.offsets
+        return [
+            {
+                name: np.ndarray(
+                    shape,
+                    dtype=np.float32,
+                    buffer=self._shared_memory.buf,
+                    offset=slot * self.layout.slot_size + offsets[name],
+                )
+                for name, shape in self.layout.fields
+            }
+            for slot in range(self.number_of_slots)
+        ]
+
+    @property
+    def nbytes(self) -> int:
+        return self.number_of_slots * self.layout.slot_size
+
+    def acquire(self, timeout: Optional[float] = None) -> int:
+        return self._free_slots.get(timeout=timeout)
+
+    def release(self, slot: int) -> None:
+        if not 0 <= slot < self.number_of_slots:
+            raise ValueError("Invalid slot")
+        self._free_slots.put(slot)
+
+    def arrays(self, slot: int) -> SlotArrays:
+        if not 0 <= slot < self.number_of_slots:
+            raise ValueError("Invalid slot")
+        return self._slots[slot]
+
+    def close(self) -> None:
+        # The views have to be released before the memory can be closed
+        self._slots = []
+        self._shared_memory.close()
+        if os.getpid() == self._owner_pid:
+            self._shared_memory.unlink()
+
+
+def send_stereo_data(
+    ring: FrameRing,
+    queue: Any,
+    stereo_data: StereoData,
+    frame_index: int,
+    timeout: Optional[float] = None,
+) -> FrameMessage:
+    slot = ring.acquire(timeout=timeout)
+    arrays = ring.arrays(slot)
+    arrays["image_0"][...] = stereo_data.image_0
+    arrays["image_1"][...] = stereo_data.image_1
+    if "ground_truth_disparity" in arrays:
+        ground_truth_disparity = stereo_data.ground_truth_disparity
+        arrays["ground_truth_disparity"][...] = (
+            np.nan if ground_truth_disparity is None else ground_truth_disparity
+        )
+    message = FrameMessage(slot=slot, frame_index=frame_index)
+    queue.put(message)
+    return message
+
+
+def _release_messages(ring: FrameRing, queue: Any) -> None:
+    while (message := queue.get()) is not None:
+        ring.release(message.slot)
+
+
+def run_stage(
+    ring: FrameRing, stage_function: StageFunction, input_queue: Any, output_queue: Any
+) -> None:
+    try:
+        while (message := input_queue.get()) is not None:
+            try:
+                stage_function(ring.arrays(message.slot))
+            except Exception:
+                # The slots of the failed frame and of the frames still on their way
+                # go back to the ring, so the producer does not block forever
+                ring.release(message.slot)
+                _release_messages(ring, input_queue)
+                raise
+            output_queue.put(message)
+    finally:
+        # Also when the stage fails, so the next stages and the consumer stop
+        output_queue.put(None)
+
+
+def receive_frames(ring: FrameRing, queue: Any) -> Iterator[tuple[int, SlotArrays]]:
+    while (message := queue.get()) is not None:
+        try:
+            yield message.frame_index, ring.arrays(message.slot)
+        finally:
+            ring.release(message.slot)
+
+
+def match_stage(pipeline: StereoPipeline, arrays: SlotArrays) -> None:
+    arrays["disparity"][...], arrays["confidence"][...] = pipeline.match(
+        image_0=arrays["image_0"], image_1=arrays["image_1"]
+    )
+
+
+def triangulate_stage(pipeline: StereoPipeline, arrays: SlotArrays) -> None:
+    arrays["xyz"][...] = pipeline.triangulate(disparity=arrays["disparity"])
@@ -0,0 +1,214 @@
+# %% [markdown]
+# # Instrumentation
+#
+# When a frame is slow it is useful to know which stage the time went to. The hot
+# paths in `block_matching`, `plane_sweeping`, `lens_model`, `triangulation` and
+# `project_points` are split into named stages with `stage`, which records:
+# - The start and duration of every call of the stage, per thread
+# - The net number of bytes allocated in the stage, when `trace_memory` is enabled
+# - Counters given by the stage, like the number of disparities or planes evaluated
+#
+# Instrumentation is off by default, and a disabled stage is a shared no-op context
+# manager, so the hooks cost a function call. It is enabled for a region with the
+# `instrumentation` context manager, which returns the thread-safe registry. The
+# registry can be summarized per stage and exported as JSON or in the Chrome trace
+# event format, which can be opened in `chrome://tracing` or
+# [Perfetto](https://ui.perfetto.dev).
+
+# %%
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from dataclasses import dataclass, field
+from functools import wraps
+from pathlib import Path
+from types import TracebackType
+from typing import Callable, Iterator, Optional, ParamSpec, TypeVar
+
+_P = ParamSpec("_P")
+_R = TypeVar("_R")
+
+
+@dataclass
+class StageEvent:
+    name: str
+    start_ns: int
+    duration_ns: int
+    thread_id: int
+    allocated_bytes: Optional[int]
+    counts: dict[str, int]
+
+
+@dataclass
+class Registry:
+    enabled: bool = False
+    trace_memory: bool = False
+    _events: list[StageEvent] = field(default_factory=list, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, event: StageEvent) -> None:
+        with self._lock:
+            self._events.append(event)
+
+    def events(self) -> list[StageEvent]:
+        with self._lock:
+            return list(self._events)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._events.clear()
+
+    def summary(self) -> dict[str, dict]:
+        summary: dict[str, dict] = {}
+        for event in self.events():
+            stage_summary = summary.setdefault(
+                event.name,
+                {
+                    "calls": 0,
+                    "total_s": 0.0,
+                    "min_s": float("inf"),
+                    "max_s": 0.0,
+                    "allocated_bytes": 0,
+                    "counts": {},
+                },
+            )
+            duration_s = event.duration_ns * 1e-9
+            stage_summary["calls"] += 1
+            stage_summary["total_s"] += duration_s
+            stage_summary["min_s"] = min(stage_summary["min_s"], duration_s)
+            stage_summary["max_s"] = max(stage_summary["max_s"], duration_s)
+            stage_summary["allocated_bytes"] += event.allocated_bytes or 0
+            for name, value in event.counts.items():
+                stage_summary["counts"][name] = (
+                    stage_summary["counts"].get(name, 0) + value
+                )
+
+        for stage_summary in summary.values():
+            stage_summary["mean_s"] = stage_summary["total_s"] / stage_summary["calls"]
+        return summary
+
+    def to_chrome_trace(self) -> dict:
+        process_id = os.getpid()
+        return {
+            "traceEvents": [
+                {
+                    "name": event.name,
+                    "cat": event.name.split(".")[0],
+                    "ph": "X",
+                    "ts": event.start_ns / 1e3,
+                    "dur": event.duration_ns / 1e3,
+                    "pid": process_id,
+                    "tid": event.thread_id,
+                    "args": {
+                        **event.counts,
+                        **(
+                            {}
+                            if event.allocated_bytes is None
+                            else {"allocated_bytes": event.allocated_bytes}
+                        ),
+                    },
+                }
+                for event in self.events()
+            ],
+            "displayTimeUnit": "ms",
+        }
+
+    def write_json(self, file_path: Path) -> None:
+        with file_path.open("w", encoding="utf-8") as file:
+            json.dump(self.summary(), file, indent=4)
+
+    def write_chrome_trace(self, file_path: Path) -> None:
+        with file_path.open("w", encoding="utf-8") as file:
+            json.dump(self.to_chrome_trace(), file)
+
+
+_REGISTRY = Registry()
+_DISABLED_STAGE: AbstractContextManager[None] = nullcontext()
+
+
+def get_registry() -> Registry:
+    return _REGISTRY
+
+
+class _Stage:
+    def __init__(self, name: str, counts: dict[str, int]) -> None:
+        self._name = name
+        self._counts = counts
+        self._start_ns = 0
+        self._start_bytes: Optional[int] = None
+
+    def __enter__(self) -> None:
+        if _REGISTRY.trace_memory and tracemalloc.is_tracing():
+            self._start_bytes = tracemalloc.get_traced_memory()[0]
+        self._start_ns = time.perf_counter_ns()
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        duration_ns = time.perf_counter_ns() - self._start_ns
+        allocated_bytes = (
+            None
+            if self._start_bytes is None
+            else tracemalloc.get_traced_memory()[0] - self._start_bytes
+        )
+        _REGISTRY.record(
+            StageEvent(
+                name=self._name,
+                start_ns=self._start_ns,
+                duration_ns=duration_ns,
+                thread_id=threading.get_ident(),
+                allocated_bytes=allocated_bytes,
+                counts=self._counts,
+            )
+        )
+
+
+def stage(name: str, **counts: int) -> AbstractContextManager[None]:
+    if not _REGISTRY.enabled:
+        return _DISABLED_STAGE
+    return _Stage(name=name, counts=counts)
+
+
+def instrument(name: str) -> Callable[[Callable[_P, _R]], Callable[_P, _R]]:
+    def decorator(function: Callable[_P, _R]) -> Callable[_P, _R]:
+        @wraps(function)
+        def wrapper(*args: _P.args, **kwargs: _P.kwargs) -> _R:
+            if not _REGISTRY.enabled:
+                return function(*args, **kwargs)
+            with _Stage(name=name, counts={}):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def instrumentation(
+    trace_memory: bool = False, clear: bool = True
+) -> Iterator[Registry]:
+    previous_enabled, previous_trace_memory = _REGISTRY.enabled, _REGISTRY.trace_memory
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if clear:
+        _REGISTRY.clear()
+    if started_tracing:
+        tracemalloc.start()
+
+    _REGISTRY.enabled, _REGISTRY.trace_memory = True, trace_memory
+    try:
+        yield _REGISTRY
+    finally:
+        _REGISTRY.enabled, _REGISTRY.trace_memory = (
+            previous_enabled,
+            previous_trace_memory,
+        )
+        if started_tracing:
+            tracemalloc.stop()
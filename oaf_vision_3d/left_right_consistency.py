@@ -0,0 +1,142 @@
+# %% [markdown]
+# # Left-Right Consistency
+#
+# `block_matching` finds a disparity for every pixel of the left image, also for the
+# pixels that are occluded in the right image or that match the wrong block. These
+# give wrong 3D points. A common check is to also match from the right image to the
+# left image, and only keep the pixels where both agree.
+#
+# The right disparity does not need a second matching pass. The cost of right pixel
+# $x_r$ at disparity $d$ is the cost of left pixel $x_r + d$ at the same disparity, so
+# every disparity slice of the aggregated cost volume is shifted by its disparity with
+# `CostVolume.right_view`. As the aggregation is a box filter, this is the same as
+# aggregating the right costs, except at the image border. Costs outside the left
+# image are set to a very large value, so they are never the minimum.
+#
+# For every left pixel the right disparity is looked up at $x - d$, and the pixel is
+# kept if the two disparities are within `tolerance`. The rejected pixels can
+# optionally be filled:
+# - Occluded pixels see the background, so every rejected pixel is first set to the
+#   smaller (further away) of the nearest valid disparities to the left and to the
+#   right on the same row
+# - The filled pixels are then smoothed with the median of their neighbourhood, which
+#   removes the streaks of the row-wise propagation
+
+# %%
+import warnings
+
+import numpy as np
+from nptyping import Bool, Float32, Int32, NDArray, Shape
+
+from oaf_vision_3d.block_matching import (
+    CostFunction,
+    block_matching_cost_volume,
+    mask_disparity_border,
+)
+from oaf_vision_3d.cost_precision import CostPrecision
+from oaf_vision_3d.instrumentation import stage
+
+
+def left_right_consistency_mask(
+    disparity: NDArray[Shape["H, W"], Float32],
+    right_disparity: NDArray[Shape["H, W"], Float32],
+    tolerance: float = 1.0,
+) -> NDArray[Shape["H, W"], Bool]:
+    height, width = disparity.shape
+    right_columns = np.arange(width, dtype=np.float32)[None, :] - np.round(disparity)
+    # NaN disparities compare as False and are never consistent
+    is_inside = (right_columns >= 0) & (right_columns < width)
+    right_columns = np.where(is_inside, right_columns, 0).astype(np.intp)
+
+    disparity_in_right = right_disparity[np.arange(height)[:, None], right_columns]
+    return is_inside & (np.abs(disparity - disparity_in_right) <= tolerance)
+
+
+def _nearest_valid_along_rows(
+    disparity: NDArray[Shape["H, W"], Float32],
+    is_valid: NDArray[Shape["H, W"], Bool],
+    reverse: bool,
+) -> NDArray[Shape["H, W"], Float32]:
+    if reverse:
+        return _nearest_valid_along_rows(
+            disparity=disparity[:, ::-1], is_valid=is_valid[:, ::-1], reverse=False
+        )[:, ::-1]
+
+    columns = np.where(is_valid, np.arange(disparity.shape[1]), -1)
+    nearest_columns = np.maximum.accumulate(columns, axis=1)
+    nearest = np.take_along_axis(disparity, np.maximum(nearest_columns, 0), axis=1)
+    return np.where(nearest_columns >= 0, nearest, np.nan)
+
+
+def fill_occlusions(
+    disparity: NDArray[Shape["H, W"], Float32],
+    occluded: NDArray[Shape["H, W"], Bool],
+    median_size: int = 5,
+) -> NDArray[Shape["H, W"], Float32]:
+    is_valid = np.isfinite(disparity) & ~occluded
+    background = np.fmin(
+        _nearest_valid_along_rows(
+            disparity=disparity, is_valid=is_valid, reverse=False
+        ),
+        _nearest_valid_along_rows(disparity=disparity, is_valid=is_valid, reverse=True),
+    )
+    filled = np.where(occluded, background, disparity).astype(np.float32)
+    if median_size <= 1:
+        return filled
+
+    rows, columns = np.nonzero(occluded)
+    radius = median_size // 2
+    neighbourhoods = np.lib.stride_tricks.sliding_window_view(
+        np.pad(filled, radius, constant_values=np.nan), (median_size, median_size)
+    )[rows, columns]
+    with warnings.catch_warnings():
+        # Neighbourhoods without any valid pixel stay NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        filled[rows, columns] = np.nanmedian(neighbourhoods, axis=(1, 2))
+    return filled
+
+
+def consistent_block_matching(
+    image_0: NDArray[Shape["H, W"], Float32],
+    image_1: NDArray[Shape["H, W"], Float32],
+    disparity_range: NDArray[Shape["2"], Float32],
+    block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
+    subpixel_fit: bool = True,
+    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+    tolerance: float = 1.0,
+    occlusion_filling: bool = False,
+    median_size: int = 5,
+) -> NDArray[Shape["H, W"], Float32]:
+    cost_volume = block_matching_cost_volume(
+        image_0=image_0,
+        image_1=image_1,
+        disparity_range=disparity_range,
+        block_size=block_size,
+        cost_function=cost_function,
+        precision=precision,
+    )
+    disparity = mask_disparity_border(
+        disparity=cost_volume.best_values(subpixel_fit=subpixel_fit),
+        disparities=cost_volume.values,
+    )
+
+    with stage("left_right_consistency.check"):
+        # The left view is not needed anymore, so it is shifted in place
+        right_disparity = cost_volume.right_view(output=cost_volume.costs).best_values(
+            subpixel_fit=subpixel_fit
+        )
+        inconsistent = np.isfinite(disparity) & ~left_right_consistency_mask(
+            disparity=disparity, right_disparity=right_disparity, tolerance=tolerance
+        )
+
+    if occlusion_filling:
+        with stage("left_right_consistency.fill", pixels=int(inconsistent.sum())):
+            return fill_occlusions(
+                disparity=disparity,
+                occluded=inconsistent,
+                median_size=median_size,
+            )
+
+    disparity[inconsistent] = np.nan
+    return disparity
@@ -15,7 +15,9 @@ from dataclasses import dataclass, field
 from pathlib import Path
 
 import numpy as np
-from nptyping import Float32, NDArray, Shape
+from nptyping import Float32, Float64, NDArray, Shape
+
+from oaf_vision_3d.instrumentation import instrument
 
 # %% [markdown]
 # ## Camera Matrix
@@ -255,6 +257,24 @@ def _undistort_pixels(
     return undistorted_normalized_pixels
 
 
+_OPENCV_ORDER = (
+    "k1",
+    "k2",
+    "p1",
+    "p2",
+    "k3",
+    "k4",
+    "k5",
+    "k6",
+    "s1",
+    "s2",
+    "s3",
+    "s4",
+    "tau_x",
+    "tau_y",
+)
+
+
 # %% [markdown]
 # ## Lens Model
 
@@ -277,11 +297,13 @@ class LensModel:
     ) -> NDArray[Shape["H, W, 2"], Float32]:
         return _denormalize_pixels(pixels, self.camera_matrix)
 
+    @instrument("lens_model.distort_pixels")
     def distort_pixels(
         self, normalized_pixels: NDArray[Shape["H, W, 2"], Float32]
     ) -> NDArray[Shape["H, W, 2"], Float32]:
         return _distort_pixels(normalized_pixels, self.distortion_coefficients)
 
+    @instrument("lens_model.undistort_pixels")
     def undistort_pixels(
         self, normalized_pixels: NDArray[Shape["H, W, 2"], Float32]
     ) -> NDArray[Shape["H, W, 2"], Float32]:
@@ -310,3 +332,233 @@ class LensModel:
     def read_from_json(file_path: Path) -> LensModel:
         with file_path.open("r", encoding="utf-8") as file:
             return LensModel.from_dict(json.load(file))
+
+
+# %% [markdown]
+# ## Lens Model Array
+#
+# `LensModelArray` stacks the camera matrices and distortion coefficients of K lens
+# models into contiguous arrays, with the coefficients in the OpenCV order. The pixels
+# of all cameras are normalized, distorted and undistorted in one broadcasted
+# evaluation, with the camera as the first axis of the pixels. The rational, prism
+# and tilt terms are skipped when they are zero for every camera, and the tilt
+# matrices are only built once. The array is written to JSON as a list of lens
+# models in the format of `LensModel`.
+
+
+# %%
+def _tilt_matrices(
+    tau_x: NDArray[Shape["K"], Float64], tau_y: NDArray[Shape["K"], Float64]
+) -> NDArray[Shape["K, 3, 3"], Float32]:
+    zeros = np.zeros_like(tau_x)
+    return np.stack(
+        [
+            np.stack([np.cos(tau_x), zeros, zeros], axis=-1),
+            np.stack([-np.sin(tau_x) * np.sin(tau_y), np.cos(tau_y), zeros], axis=-1),
+            np.stack(
+                [
+                    np.sin(tau_y),
+                    -np.sin(tau_x) * np.cos(tau_y),
+                    np.cos(tau_x) * np.cos(tau_y),
+                ],
+                axis=-1,
+            ),
+        ],
+        axis=-2,
+    ).astype(np.float32)
+
+
+@dataclass
+class LensModelArray:
+    focal_lengths: NDArray[Shape["K, 2"], Float64]
+    principal_points: NDArray[Shape["K, 2"], Float64]
+    distortion_vectors: NDArray[Shape["K, 14"], Float64]
+    _focal_lengths: NDArray[Shape["K, 2"], Float32] = field(init=False, repr=False)
+    _principal_points: NDArray[Shape["K, 2"], Float32] = field(init=False, repr=False)
+    _has_rational: bool = field(init=False, repr=False)
+    _has_prism: bool = field(init=False, repr=False)
+    _has_tilt: bool = field(init=False, repr=False)
+    _tilt_matrices: NDArray[Shape["K, 3, 3"], Float32] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        # Float64 like the Python floats of LensModel, so the JSON round trip is exact
+        self.focal_lengths = np.ascontiguousarray(self.focal_lengths, dtype=np.float64)
+        self.principal_points = np.ascontiguousarray(
+            self.principal_points, dtype=np.float64
+        )
+        self.distortion_vectors = np.ascontiguousarray(
+            self.distortion_vectors, dtype=np.float64
+        )
+        number_of_cameras = self.focal_lengths.shape[0]
+        if (
+            self.focal_lengths.shape != (number_of_cameras, 2)
+            or self.principal_points.shape != (number_of_cameras, 2)
+            or self.distortion_vectors.shape != (number_of_cameras, len(_OPENCV_ORDER))
+        ):
+            raise ValueError(
+                "Lens model arrays must have the shapes (K, 2) and (K, 14)"
+            )
+
+        # Float32 like CameraMatrix.focal_length and CameraMatrix.principal_point
+        self._focal_lengths = self.focal_lengths.astype(np.float32)
+        self._principal_points = self.principal_points.astype(np.float32)
+        self._has_rational = bool(np.any(self.distortion_vectors[:, 5:8]))
+        self._has_prism = bool(np.any(self.distortion_vectors[:, 8:12]))
+        self._has_tilt = bool(np.any(self.distortion_vectors[:, 12:14]))
+        self._tilt_matrices = _tilt_matrices(
+            tau_x=self.distortion_vectors[:, 12], tau_y=self.distortion_vectors[:, 13]
+        )
+
+    def __len__(self) -> int:
+        return self.focal_lengths.shape[0]
+
+    def __getitem__(self, index: int) -> LensModel:
+        return LensModel(
+            camera_matrix=CameraMatrix(
+                fx=float(self.focal_lengths[index, 0]),
+                fy=float(self.focal_lengths[index, 1]),
+                cx=float(self.principal_points[index, 0]),
+                cy=float(self.principal_points[index, 1]),
+            ),
+            distortion_coefficients=DistortionCoefficients.from_dict(
+                dict(zip(_OPENCV_ORDER, self.distortion_vectors[index].tolist()))
+            ),
+        )
+
+    @staticmethod
+    def from_lens_models(lens_models: list[LensModel]) -> LensModelArray:
+        return LensModelArray(
+            focal_lengths=np.array(
+                [
+                    [_lens_model.camera_matrix.fx, _lens_model.camera_matrix.fy]
+                    for _lens_model in lens_models
+                ],
+                dtype=np.float64,
+            ).reshape(-1, 2),
+            principal_points=np.array(
+                [
+                    [_lens_model.camera_matrix.cx, _lens_model.camera_matrix.cy]
+                    for _lens_model in lens_models
+                ],
+                dtype=np.float64,
+            ).reshape(-1, 2),
+            distortion_vectors=np.array(
+                [
+                    [
+                        _lens_model.distortion_coefficients.to_dict()[name]
+                        for name in _OPENCV_ORDER
+                    ]
+                    for _lens_model in lens_models
+                ],
+                dtype=np.float64,
+            ).reshape(-1, len(_OPENCV_ORDER)),
+        )
+
+    def to_lens_models(self) -> list[LensModel]:
+        return [self[index] for index in range(len(self))]
+
+    def _per_camera(
+        self, values: NDArray[Shape["K"], Float64], ndim: int, dtype: np.dtype
+    ) -> NDArray[Shape["K, ..."], Float64]:
+        return values.astype(dtype, copy=False).reshape(-1, *(1,) * (ndim - 1))
+
+    def _check_pixels(self, pixels: NDArray[Shape["K, H, W, 2"], Float32]) -> None:
+        if pixels.ndim < 2 or pixels.shape[0] != len(self) or pixels.shape[-1] != 2:
+            raise ValueError("Pixels must have the shape (K, ..., 2)")
+
+    def normalize_pixels(
+        self, pixels: NDArray[Shape["K, H, W, 2"], Float32]
+    ) -> NDArray[Shape["K, H, W, 2"], Float32]:
+        self._check_pixels(pixels)
+        shape = (len(self), *(1,) * (pixels.ndim - 2), 2)
+        return (pixels - self._principal_points.reshape(shape)) / (
+            self._focal_lengths.reshape(shape)
+        )
+
+    def denormalize_pixels(
+        self, pixels: NDArray[Shape["K, H, W, 2"], Float32]
+    ) -> NDArray[Shape["K, H, W, 2"], Float32]:
+        self._check_pixels(pixels)
+        shape = (len(self), *(1,) * (pixels.ndim - 2), 2)
+        return (pixels * self._focal_lengths.reshape(shape)) + (
+            self._principal_points.reshape(shape)
+        )
+
+    @instrument("lens_model_array.distort_pixels")
+    def distort_pixels(
+        self, normalized_pixels: NDArray[Shape["K, H, W, 2"], Float32]
+    ) -> NDArray[Shape["K, H, W, 2"], Float32]:
+        self._check_pixels(normalized_pixels)
+        x = normalized_pixels[..., 0]
+        y = normalized_pixels[..., 1]
+        # Cast like the Python float coefficients of LensModel, to the pixel type
+        k1, k2, p1, p2, k3, k4, k5, k6, s1, s2, s3, s4 = (
+            self._per_camera(values=_values, ndim=x.ndim, dtype=normalized_pixels.dtype)
+            for _values in self.distortion_vectors[:, :12].T
+        )
+
+        r2 = x**2 + y**2
+        r4 = r2 * r2
+        r6 = r4 * r2
+
+        radial_coefficient = 1 + k1 * r2 + k2 * r4 + k3 * r6
+        if self._has_rational:
+            radial_coefficient = radial_coefficient / (1 + k4 * r2 + k5 * r4 + k6 * r6)
+
+        two_xy = 2 * x * y
+        distorted_x = x * radial_coefficient + (p1 * two_xy + p2 * (r2 + 2 * x**2))
+        distorted_y = y * radial_coefficient + (p2 * two_xy + p1 * (r2 + 2 * y**2))
+        if self._has_prism:
+            distorted_x = distorted_x + (s1 * r2 + s2 * r4)
+            distorted_y = distorted_y + (s3 * r2 + s4 * r4)
+
+        if self._has_tilt:
+            tilt = self._tilt_matrices.reshape(len(self), *(1,) * (x.ndim - 1), 3, 3)
+            tilted = [
+                tilt[..., _row, 0] * distorted_x
+                + tilt[..., _row, 1] * distorted_y
+                + tilt[..., _row, 2]
+                for _row in range(3)
+            ]
+            distorted_x = tilted[0] / tilted[2]
+            distorted_y = tilted[1] / tilted[2]
+        return np.stack((distorted_x, distorted_y), axis=-1)
+
+    @instrument("lens_model_array.undistort_pixels")
+    def undistort_pixels(
+        self,
+        normalized_pixels: NDArray[Shape["K, H, W, 2"], Float32],
+        number_of_iterations: int = 10,
+    ) -> NDArray[Shape["K, H, W, 2"], Float32]:
+        undistorted_normalized_pixels = normalized_pixels.copy()
+        for _ in range(number_of_iterations):
+            undistorted_normalized_pixels += normalized_pixels - self.distort_pixels(
+                undistorted_normalized_pixels
+            )
+        return undistorted_normalized_pixels
+
+    def to_dicts(self) -> list[dict]:
+        return [_lens_model.to_dict() for _lens_model in self.to_lens_models()]
+
+    @staticmethod
+    def from_dicts(data: list[dict]) -> LensModelArray:
+        return LensModelArray.from_lens_models(
+            [LensModel.from_dict(_data) for _data in data]
+        )
+
+    def write_to_json(self, file_path: Path) -> None:
+        with file_path.open("w", encoding="utf-8") as file:
+            json.dump(self.to_dicts(), file, indent=4)
+
+    @staticmethod
+    def read_from_json(file_path: Path) -> LensModelArray:
+        with file_path.open("r", encoding="utf-8") as file:
+            data = json.load(file)
+        # A single lens model file is an array of one camera
+        return LensModelArray.from_dicts(data if isinstance(data, list) else [data])
+
+    @staticmethod
+    def read_from_json_files(file_paths: list[Path]) -> LensModelArray:
+        return LensModelArray.from_lens_models(
+            [LensModel.read_from_json(_file_path) for _file_path in file_paths]
+        )
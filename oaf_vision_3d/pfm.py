@@ -0,0 +1,64 @@
+# %% [markdown]
+# # PFM
+#
+# This module reads and writes [PFM](https://netpbm.sourceforge.net/doc/pfm.html)
+# files, the format used for the ground truth disparity maps in the Middlebury stereo
+# datasets. A PFM file has a three line text header followed by raw 32 bit floats,
+# stored bottom row first. The sign of the scale in the header gives the endianness.
+#
+# The reader can memory map the file instead of reading it. The returned array is
+# then a flipped view into the file, with the endianness handled by the dtype, so no
+# data is copied until it is used. The map is copy-on-write, so changing the array
+# never changes the file.
+
+# %%
+from pathlib import Path
+
+import numpy as np
+from nptyping import Float32, NDArray, Shape
+
+
+def _read_header(file_path: Path) -> tuple[tuple[int, ...], np.dtype, int]:
+    with open(file_path, "rb") as f:
+        header = f.readline().decode().strip()
+        if header not in {"PF", "Pf"}:
+            raise ValueError("Not a valid PFM file.")
+
+        dimensions = f.readline().decode().strip()
+        width, height = map(int, dimensions.split())
+
+        scale = float(f.readline().decode().strip())
+        endian = "<" if scale < 0 else ">"
+
+        shape = (height, width, 3) if header == "PF" else (height, width)
+        return shape, np.dtype(endian + "f4"), f.tell()
+
+
+def read_pfm(
+    file_path: Path, memory_map: bool = False
+) -> NDArray[Shape["H, W, ..."], Float32]:
+    shape, data_type, offset = _read_header(file_path)
+
+    if memory_map:
+        return np.memmap(
+            file_path, dtype=data_type, mode="c", offset=offset, shape=shape
+        )[::-1]
+
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        data = np.fromfile(f, dtype=data_type, count=int(np.prod(shape)))
+    return data.reshape(shape)[::-1].astype(np.float32, copy=False)
+
+
+def write_pfm(file_path: Path, data: NDArray[Shape["H, W, ..."], Float32]) -> None:
+    match data.ndim:
+        case 2:
+            header = "Pf"
+        case 3 if data.shape[2] == 3:
+            header = "PF"
+        case _:
+            raise ValueError("PFM data must be H x W or H x W x 3")
+
+    with open(file_path, "wb") as f:
+        f.write(f"{header}\n{data.shape[1]} {data.shape[0]}\n-1.0\n".encode())
+        np.ascontiguousarray(data[::-1], dtype="<f4").tofile(f)
@@ -4,19 +4,52 @@
 # This function performs plane sweeping to estimate the depth of a pixel in a set of 2D
 # images. The process for this was discussed in more detail in the workshop
 # [7: Stereo Matching Fundamentals Continues](../workshops/07_stereo_matching_fundamentals_continued.ipynb).
+#
+# With a [region of interest](region_of_interest.py) only the windows around the
+# region are swept, with half a block of halo for the aggregation. The principal point
+# of the reference camera is moved to the window, and every secondary image is cropped
+# to the part the window projects to at the swept depths.
+#
+# The cost volume can be stored with reduced [precision](cost_precision.py). With
+# quantized costs, samples outside a secondary image get the largest possible cost
+# instead of NaN, so they never win, but they do not invalidate the pixel either.
+#
+# `plane_sweeping_cost_volume` returns the aggregated [cost volume](cost_volume.py)
+# over the depths itself, optionally memory-mapped. Its reductions give depths, which
+# are turned into points with the camera vectors from `get_camera_vectors`.
+#
+# The secondary cameras are stacked in a [`LensModelArray`](lens_model.py), so every
+# depth is projected into all of them with one call of `project_points_array`.
 
 
 # %%
 from enum import Enum
+from pathlib import Path
+from typing import Optional, Union
 
 import numpy as np
-from nptyping import Float32, Int32, NDArray, Shape
+from nptyping import Float32, Int32, NDArray, Shape, UInt8, UInt16
 from scipy.ndimage import map_coordinates
-from scipy.signal import convolve2d
 
-from oaf_vision_3d.lens_model import LensModel
-from oaf_vision_3d.poly_2_subvalue_fit import find_subvalue_poly_2
-from oaf_vision_3d.project_points import project_points
+from oaf_vision_3d.cost_precision import (
+    CostPrecision,
+    aggregate_cost_volume,
+    maximum_quantized_cost,
+    quantize_image,
+    quantized_absolute_difference,
+)
+from oaf_vision_3d.cost_volume import CostVolume, CostVolumeKind
+from oaf_vision_3d.instrumentation import stage
+from oaf_vision_3d.lens_model import LensModel, LensModelArray
+from oaf_vision_3d.project_points import project_points, project_points_array
+from oaf_vision_3d.region_of_interest import (
+    RegionOfInterest,
+    Tile,
+    apply_region_of_interest,
+    crop_lens_model,
+    projected_window,
+    region_of_interest_tiles,
+)
 from oaf_vision_3d.transformation_matrix import TransformationMatrix
 
 
@@ -25,7 +58,7 @@ class CostFunction(Enum):
     SUM_OF_SQUARED_DIFFERENCE = 1
 
 
-def _get_cost(
+def plane_sweeping_cost(
     image_0: NDArray[Shape["H, W, ..."], Float32],
     images: list[NDArray[Shape["H, W, ..."], Float32]],
     cost_function: CostFunction,
@@ -39,26 +72,27 @@ def _get_cost(
             raise ValueError("Invalid cost function")
 
 
-def repeoject_image_at_depth(
-    image: NDArray[Shape["H, W, ..."], Float32],
-    camera_vectors: NDArray[Shape["H, W, 3"], Float32],
-    depth: float,
-    lens_model: LensModel,
-    transformation_matrix: TransformationMatrix,
-) -> NDArray[Shape["H, W, ..."], Float32]:
-    xyz = camera_vectors * depth
+def _get_quantized_cost(
+    image_0: NDArray[Shape["H, W, ..."], UInt8],
+    images: list[NDArray[Shape["H, W, ..."], Float32]],
+    maximum_cost: int,
+) -> NDArray[Shape["H, W"], UInt16]:
+    cost = quantized_absolute_difference(
+        image_0=image_0, images=[quantize_image(_image) for _image in images]
+    )
+    cost[np.isnan(np.array(images)).any(axis=(0, -1))] = maximum_cost
+    return cost
 
-    projected_points = project_points(
-        points=xyz.reshape(-1, 3),
-        lens_model=lens_model,
-        transformation_matrix=transformation_matrix.inverse(),
-    ).reshape(*camera_vectors.shape[:2], 2)
 
+def _sample_image(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    pixels: NDArray[Shape["H, W, 2"], Float32],
+) -> NDArray[Shape["H, W, ..."], Float32]:
     return np.stack(
         [
             map_coordinates(
                 input=_image,
-                coordinates=[projected_points[..., 1], projected_points[..., 0]],
+                coordinates=[pixels[..., 1], pixels[..., 0]],
                 order=1,
                 mode="constant",
                 cval=np.nan,
@@ -70,70 +104,278 @@ def repeoject_image_at_depth(
     )
 
 
-def plane_sweeping(
+def repeoject_image_at_depth(
     image: NDArray[Shape["H, W, ..."], Float32],
+    camera_vectors: NDArray[Shape["H, W, 3"], Float32],
+    depth: Union[float, NDArray[Shape["H, W, 1"], Float32]],
     lens_model: LensModel,
-    secondary_images: list[NDArray[Shape["H, W, ..."], Float32]],
-    secondary_lens_models: list[LensModel],
-    secondary_transformation_matrices: list[TransformationMatrix],
-    depth_range: NDArray[Shape["2"], Float32],
-    step_size: float,
-    block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
-    subpixel_fit: bool = True,
-    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE,
+    transformation_matrix: TransformationMatrix,
+) -> NDArray[Shape["H, W, ..."], Float32]:
+    xyz = camera_vectors * depth
+
+    projected_points = project_points(
+        points=xyz.reshape(-1, 3),
+        lens_model=lens_model,
+        transformation_matrix=transformation_matrix.inverse(),
+    ).reshape(*camera_vectors.shape[:2], 2)
+
+    return _sample_image(image=image, pixels=projected_points)
+
+
+def reproject_images_at_depth(
+    images: list[NDArray[Shape["H, W, ..."], Float32]],
+    camera_vectors: NDArray[Shape["H, W, 3"], Float32],
+    depth: Union[float, NDArray[Shape["H, W, 1"], Float32]],
+    lens_model_array: LensModelArray,
+    inverse_transformation_matrices: list[TransformationMatrix],
+) -> list[NDArray[Shape["H, W, ..."], Float32]]:
+    xyz = camera_vectors * depth
+
+    projected_points = project_points_array(
+        points=xyz.reshape(-1, 3),
+        lens_model_array=lens_model_array,
+        transformation_matrices=inverse_transformation_matrices,
+    ).reshape(len(images), *camera_vectors.shape[:2], 2)
+
+    return [
+        _sample_image(image=_image, pixels=_pixels)
+        for _image, _pixels in zip(images, projected_points)
+    ]
+
+
+def _get_depths(
+    depth_range: NDArray[Shape["2"], Float32], step_size: float
+) -> NDArray[Shape["D"], Float32]:
+    return np.arange(
+        start=depth_range[0],
+        stop=depth_range[1] + step_size,
+        step=step_size,
+        dtype=np.float32,
+    )
+
+
+def get_camera_vectors(
+    lens_model: LensModel, shape: tuple[int, ...]
 ) -> NDArray[Shape["H, W, 3"], Float32]:
-    pixels = np.indices(image.shape[:2], dtype=np.float32)[::-1].transpose((1, 2, 0))
+    pixels = np.indices(shape[:2], dtype=np.float32)[::-1].transpose((1, 2, 0))
     undistorted_normalized_pixels = lens_model.undistort_pixels(
         normalized_pixels=lens_model.normalize_pixels(pixels=pixels)
     )
-    camera_vectors = np.pad(
+    return np.pad(
         undistorted_normalized_pixels, ((0, 0), (0, 0), (0, 1)), constant_values=1.0
     )
 
-    depths = np.arange(
-        start=depth_range[0],
-        stop=depth_range[1] + step_size,
-        step=step_size,
-        dtype=np.float32,
+
+def _plane_sweeping_cost_volume(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    camera_vectors: NDArray[Shape["H, W, 3"], Float32],
+    secondary_images: list[NDArray[Shape["H, W, ..."], Float32]],
+    secondary_lens_models: list[LensModel],
+    secondary_transformation_matrices: list[TransformationMatrix],
+    depth_range: NDArray[Shape["2"], Float32],
+    step_size: float,
+    block_size: NDArray[Shape["[x, y]"], Int32],
+    cost_function: CostFunction,
+    precision: CostPrecision,
+    file_path: Optional[Path] = None,
+) -> CostVolume:
+    depths = _get_depths(depth_range=depth_range, step_size=step_size)
+    cost_volume = CostVolume.empty(
+        values=depths,
+        height=image.shape[0],
+        width=image.shape[1],
+        precision=precision,
+        kind=CostVolumeKind.DEPTH,
+        file_path=file_path,
     )
-    error = []
-    for depth in depths:
-        shifted_images = [
-            repeoject_image_at_depth(
-                image=_image,
+    error_array = cost_volume.costs
+    maximum_cost, quantized_image = 0, None
+    if precision == CostPrecision.UINT16:
+        if cost_function != CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE:
+            raise ValueError(
+                "Quantized costs only support the sum of absolute differences"
+            )
+        maximum_cost = maximum_quantized_cost(
+            number_of_channels=image.shape[-1],
+            number_of_images=len(secondary_images),
+        )
+        quantized_image = quantize_image(image)
+
+    # The cameras are stacked and inverted once, and projected together per depth
+    secondary_lens_model_array = LensModelArray.from_lens_models(secondary_lens_models)
+    inverse_transformation_matrices = [
+        _transformation_matrix.inverse()
+        for _transformation_matrix in secondary_transformation_matrices
+    ]
+    for depth, _error in zip(depths, error_array):
+        with stage("plane_sweeping.reprojection", images=len(secondary_images)):
+            shifted_images = reproject_images_at_depth(
+                images=secondary_images,
                 camera_vectors=camera_vectors,
                 depth=depth,
-                lens_model=_lens_model,
-                transformation_matrix=_transformation_matrix,
-            )
-            for _image, _lens_model, _transformation_matrix in zip(
-                secondary_images,
-                secondary_lens_models,
-                secondary_transformation_matrices,
+                lens_model_array=secondary_lens_model_array,
+                inverse_transformation_matrices=inverse_transformation_matrices,
             )
-        ]
-        single_pixel_error = _get_cost(
-            image_0=image, images=shifted_images, cost_function=cost_function
+        with stage("plane_sweeping.cost", planes=1):
+            if quantized_image is not None:
+                _error[...] = _get_quantized_cost(
+                    image_0=quantized_image,
+                    images=shifted_images,
+                    maximum_cost=maximum_cost,
+                )
+            else:
+                _error[...] = plane_sweeping_cost(
+                    image_0=image, images=shifted_images, cost_function=cost_function
+                )
+
+    with stage("plane_sweeping.aggregation"):
+        aggregate_cost_volume(
+            cost_volume=error_array,
+            block_size=block_size,
+            precision=precision,
+            maximum_cost=maximum_cost,
         )
+    return cost_volume
+
 
-        convoluted_error = convolve2d(
-            convolve2d(
-                single_pixel_error,
-                np.ones((1, block_size[0])) / block_size[0],
-                mode="same",
-            ),
-            np.ones((block_size[1], 1)) / block_size[1],
-            mode="same",
+def plane_sweeping_cost_volume(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    lens_model: LensModel,
+    secondary_images: list[NDArray[Shape["H, W, ..."], Float32]],
+    secondary_lens_models: list[LensModel],
+    secondary_transformation_matrices: list[TransformationMatrix],
+    depth_range: NDArray[Shape["2"], Float32],
+    step_size: float,
+    block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
+    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+    file_path: Optional[Path] = None,
+) -> CostVolume:
+    return _plane_sweeping_cost_volume(
+        image=image,
+        camera_vectors=get_camera_vectors(lens_model=lens_model, shape=image.shape),
+        secondary_images=secondary_images,
+        secondary_lens_models=secondary_lens_models,
+        secondary_transformation_matrices=secondary_transformation_matrices,
+        depth_range=depth_range,
+        step_size=step_size,
+        block_size=block_size,
+        cost_function=cost_function,
+        precision=precision,
+        file_path=file_path,
+    )
+
+
+def plane_sweeping_tile(
+    tile: Tile,
+    image: NDArray[Shape["H, W, ..."], Float32],
+    lens_model: LensModel,
+    secondary_images: list[NDArray[Shape["H, W, ..."], Float32]],
+    secondary_lens_models: list[LensModel],
+    secondary_transformation_matrices: list[TransformationMatrix],
+    depth_range: NDArray[Shape["2"], Float32],
+    step_size: float,
+    block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
+    subpixel_fit: bool = True,
+    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+) -> NDArray[Shape["H, W, 3"], Float32]:
+    depths = _get_depths(depth_range=depth_range, step_size=step_size)
+    windows = [
+        projected_window(
+            window=tile.window,
+            lens_model=lens_model,
+            secondary_lens_model=_lens_model,
+            secondary_transformation_matrix=_transformation_matrix,
+            depths=depths,
+            secondary_shape=_image.shape,
         )
-        error.append(convoluted_error)
-    error_array = np.array(error, dtype=np.float32)
+        for _image, _lens_model, _transformation_matrix in zip(
+            secondary_images, secondary_lens_models, secondary_transformation_matrices
+        )
+    ]
+    return plane_sweeping(
+        image=np.ascontiguousarray(image[tile.window], dtype=np.float32),
+        lens_model=crop_lens_model(
+            lens_model=lens_model, x=tile.window[1].start, y=tile.window[0].start
+        ),
+        secondary_images=[
+            np.ascontiguousarray(_image[_window], dtype=np.float32)
+            for _image, _window in zip(secondary_images, windows)
+        ],
+        secondary_lens_models=[
+            crop_lens_model(
+                lens_model=_lens_model, x=_window[1].start, y=_window[0].start
+            )
+            for _lens_model, _window in zip(secondary_lens_models, windows)
+        ],
+        secondary_transformation_matrices=secondary_transformation_matrices,
+        depth_range=depth_range,
+        step_size=step_size,
+        block_size=block_size,
+        subpixel_fit=subpixel_fit,
+        cost_function=cost_function,
+        precision=precision,
+    )[tile.core_in_window]
+
 
-    if subpixel_fit:
-        output_value = find_subvalue_poly_2(values=depths, function_value=error_array)
-    else:
-        output_value = depths[np.argmin(error_array, axis=0)].astype(np.float32)
+def plane_sweeping(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    lens_model: LensModel,
+    secondary_images: list[NDArray[Shape["H, W, ..."], Float32]],
+    secondary_lens_models: list[LensModel],
+    secondary_transformation_matrices: list[TransformationMatrix],
+    depth_range: NDArray[Shape["2"], Float32],
+    step_size: float,
+    block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
+    subpixel_fit: bool = True,
+    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE,
+    region_of_interest: Optional[RegionOfInterest] = None,
+    crop_to_region_of_interest: bool = False,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+) -> NDArray[Shape["H, W, 3"], Float32]:
+    if region_of_interest is not None:
+        xyz = np.full((*image.shape[:2], 3), np.nan, dtype=np.float32)
+        for tile in region_of_interest_tiles(
+            region_of_interest=region_of_interest,
+            height=image.shape[0],
+            width=image.shape[1],
+            halo=np.array([block_size[0] // 2, block_size[1] // 2], dtype=np.int32),
+        ):
+            xyz[tile.core] = plane_sweeping_tile(
+                tile=tile,
+                image=image,
+                lens_model=lens_model,
+                secondary_images=secondary_images,
+                secondary_lens_models=secondary_lens_models,
+                secondary_transformation_matrices=secondary_transformation_matrices,
+                depth_range=depth_range,
+                step_size=step_size,
+                block_size=block_size,
+                subpixel_fit=subpixel_fit,
+                cost_function=cost_function,
+                precision=precision,
+            )
+        return apply_region_of_interest(
+            values=xyz,
+            region_of_interest=region_of_interest,
+            crop=crop_to_region_of_interest,
+        )
 
-    output_value[output_value >= depths.max()] = np.nan
-    output_value[output_value <= depths.min()] = np.nan
+    camera_vectors = get_camera_vectors(lens_model=lens_model, shape=image.shape)
+    cost_volume = _plane_sweeping_cost_volume(
+        image=image,
+        camera_vectors=camera_vectors,
+        secondary_images=secondary_images,
+        secondary_lens_models=secondary_lens_models,
+        secondary_transformation_matrices=secondary_transformation_matrices,
+        depth_range=depth_range,
+        step_size=step_size,
+        block_size=block_size,
+        cost_function=cost_function,
+        precision=precision,
+    )
+    with stage("plane_sweeping.subpixel_fit"):
+        depth = cost_volume.best_values(subpixel_fit=subpixel_fit)
 
-    return camera_vectors * output_value[..., None]
+    return camera_vectors * depth[..., None]
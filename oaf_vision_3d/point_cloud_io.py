@@ -0,0 +1,215 @@
+# %% [markdown]
+# # Point Cloud IO
+#
+# This module writes point clouds to disk without `open3d` or a display. The points are
+# taken directly from the `H x W x 3` maps returned by `triangulate_disparity` and
+# `plane_sweeping`, and the colors from the matching `H x W x 3` image. Invalid points
+# (NaN) are removed with a single mask, and colors are stored as `uint8`.
+#
+# Supported formats:
+# - Binary little endian [PLY](https://paulbourke.net/dataformats/ply/)
+# - Binary [PCD](https://pointclouds.org/documentation/tutorials/pcd_file_format.html)
+# - Compressed `npz` with `points` and `colors` arrays
+#
+# PLY and PCD are written through one structured array buffer. With `chunk_size` the
+# points are streamed to the file in chunks of that many input points, so large clouds
+# can be written with a bounded amount of extra memory.
+
+# %%
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+from nptyping import Bool, Float32, NDArray, Shape, UInt8
+
+_PLY_DTYPE = np.dtype(
+    [
+        ("x", "<f4"),
+        ("y", "<f4"),
+        ("z", "<f4"),
+        ("red", "u1"),
+        ("green", "u1"),
+        ("blue", "u1"),
+    ]
+)
+_PCD_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4"), ("rgb", "<u4")])
+_XYZ_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("z", "<f4")])
+
+
+def _flatten(
+    xyz: NDArray[Shape["H, W, 3"], Float32],
+    rgb: Optional[NDArray[Shape["H, W, 3"], Float32]],
+) -> tuple[NDArray[Shape["N, 3"], Float32], Optional[NDArray[Shape["N, 3"], Float32]]]:
+    points = xyz.reshape(-1, 3)
+    if rgb is None:
+        return points, None
+
+    colors = rgb.reshape(-1, rgb.shape[-1])[:, :3]
+    if colors.shape[0] != points.shape[0]:
+        raise ValueError("xyz and rgb must have the same number of points")
+    return points, colors
+
+
+def _valid_mask(points: NDArray[Shape["N, 3"], Float32]) -> NDArray[Shape["N"], Bool]:
+    return ~np.isnan(points).any(axis=1)
+
+
+def _colors_to_uint8(
+    colors: NDArray[Shape["N, 3"], Float32],
+) -> NDArray[Shape["N, 3"], UInt8]:
+    if colors.dtype == np.uint8:
+        return colors.astype(np.uint8, copy=False)
+    return (np.clip(colors, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+
+
+def _fill_ply_buffer(
+    buffer: np.ndarray,
+    points: NDArray[Shape["N, 3"], Float32],
+    colors: Optional[NDArray[Shape["N, 3"], Float32]],
+) -> None:
+    for axis, name in enumerate(("x", "y", "z")):
+        buffer[name] = points[:, axis]
+    if colors is not None:
+        colors_uint8 = _colors_to_uint8(colors)
+        for channel, name in enumerate(("red", "green", "blue")):
+            buffer[name] = colors_uint8[:, channel]
+
+
+def _fill_pcd_buffer(
+    buffer: np.ndarray,
+    points: NDArray[Shape["N, 3"], Float32],
+    colors: Optional[NDArray[Shape["N, 3"], Float32]],
+) -> None:
+    for axis, name in enumerate(("x", "y", "z")):
+        buffer[name] = points[:, axis]
+    if colors is not None:
+        colors_uint32 = _colors_to_uint8(colors).astype(np.uint32)
+        buffer["rgb"] = (
+            (colors_uint32[:, 0] << 16)
+            | (colors_uint32[:, 1] << 8)
+            | colors_uint32[:, 2]
+        )
+
+
+def _write_points(
+    file_path: Path,
+    header: str,
+    dtype: np.dtype,
+    fill_buffer: Callable[[np.ndarray, NDArray, Optional[NDArray]], None],
+    points: NDArray[Shape["N, 3"], Float32],
+    colors: Optional[NDArray[Shape["N, 3"], Float32]],
+    valid: NDArray[Shape["N"], Bool],
+    chunk_size: Optional[int],
+) -> None:
+    chunk_size = max(points.shape[0] if chunk_size is None else chunk_size, 1)
+    buffer = np.empty(min(chunk_size, int(valid.sum())), dtype=dtype)
+
+    with open(file_path, "wb") as f:
+        f.write(header.encode("ascii"))
+        for start in range(0, points.shape[0], chunk_size):
+            chunk = slice(start, start + chunk_size)
+            chunk_valid = valid[chunk]
+            number_of_points = int(chunk_valid.sum())
+            if number_of_points == 0:
+                continue
+
+            chunk_buffer = buffer[:number_of_points]
+            fill_buffer(
+                chunk_buffer,
+                points[chunk][chunk_valid],
+                None if colors is None else colors[chunk][chunk_valid],
+            )
+            chunk_buffer.tofile(f)
+
+
+def write_ply(
+    file_path: Path,
+    xyz: NDArray[Shape["H, W, 3"], Float32],
+    rgb: Optional[NDArray[Shape["H, W, 3"], Float32]] = None,
+    chunk_size: Optional[int] = None,
+) -> int:
+    points, colors = _flatten(xyz=xyz, rgb=rgb)
+    valid = _valid_mask(points)
+    number_of_points = int(valid.sum())
+
+    properties = [f"property float {name}" for name in ("x", "y", "z")]
+    if colors is not None:
+        properties += [f"property uchar {name}" for name in ("red", "green", "blue")]
+    header = "\n".join(
+        [
+            "ply",
+            "format binary_little_endian 1.0",
+            f"element vertex {number_of_points}",
+            *properties,
+            "end_header",
+            "",
+        ]
+    )
+
+    _write_points(
+        file_path=file_path,
+        header=header,
+        dtype=_PLY_DTYPE if colors is not None else _XYZ_DTYPE,
+        fill_buffer=_fill_ply_buffer,
+        points=points,
+        colors=colors,
+        valid=valid,
+        chunk_size=chunk_size,
+    )
+    return number_of_points
+
+
+def write_pcd(
+    file_path: Path,
+    xyz: NDArray[Shape["H, W, 3"], Float32],
+    rgb: Optional[NDArray[Shape["H, W, 3"], Float32]] = None,
+    chunk_size: Optional[int] = None,
+) -> int:
+    points, colors = _flatten(xyz=xyz, rgb=rgb)
+    valid = _valid_mask(points)
+    number_of_points = int(valid.sum())
+
+    fields = ["x", "y", "z"] + (["rgb"] if colors is not None else [])
+    header = "\n".join(
+        [
+            "# .PCD v0.7 - Point Cloud Data file format",
+            "VERSION 0.7",
+            f"FIELDS {' '.join(fields)}",
+            f"SIZE {' '.join('4' for _ in fields)}",
+            f"TYPE {' '.join('U' if name == 'rgb' else 'F' for name in fields)}",
+            f"COUNT {' '.join('1' for _ in fields)}",
+            f"WIDTH {number_of_points}",
+            "HEIGHT 1",
+            "VIEWPOINT 0 0 0 1 0 0 0",
+            f"POINTS {number_of_points}",
+            "DATA binary",
+            "",
+        ]
+    )
+
+    _write_points(
+        file_path=file_path,
+        header=header,
+        dtype=_PCD_DTYPE if colors is not None else _XYZ_DTYPE,
+        fill_buffer=_fill_pcd_buffer,
+        points=points,
+        colors=colors,
+        valid=valid,
+        chunk_size=chunk_size,
+    )
+    return number_of_points
+
+
+def write_npz(
+    file_path: Path,
+    xyz: NDArray[Shape["H, W, 3"], Float32],
+    rgb: Optional[NDArray[Shape["H, W, 3"], Float32]] = None,
+) -> int:
+    points, colors = _flatten(xyz=xyz, rgb=rgb)
+    valid = _valid_mask(points)
+
+    arrays: dict[str, NDArray] = {"points": points[valid].astype(np.float32)}
+    if colors is not None:
+        arrays["colors"] = _colors_to_uint8(colors[valid])
+    np.savez_compressed(file_path, **arrays)
+    return int(valid.sum())
@@ -0,0 +1,270 @@
+# %% [markdown]
+# # Point Cloud Processing
+#
+# Stereo matching gives "flying pixels" at depth discontinuities, points that float
+# between the foreground and the background. This module removes them and estimates
+# surface normals. Everything is built on a reusable neighbour index, of which there
+# are two:
+# - `OrganizedNeighbourIndex` uses the `H x W` layout of the point maps from
+#   `triangulate_disparity` and `plane_sweeping`. The neighbours of a pixel are the
+#   valid pixels in a small window around it, so the lookup is O(1) and every
+#   operation is a few shifted whole-image passes.
+# - `KDTreeNeighbourIndex` uses `scipy.spatial.KDTree` and works for any point
+#   cloud, for instance after downsampling. The neighbours are the `k` nearest points.
+#
+# Both indices give the mean distance to the neighbours, the number of neighbours
+# within a radius and the first and second moments of the neighbourhood. On top of
+# these we have:
+# - Statistical outlier removal, removing points whose mean neighbour distance is more
+#   than `std_ratio` standard deviations above the average
+# - Radius outlier removal, removing points with too few neighbours within a radius
+# - Normal estimation with PCA, the normal being the direction of least variance of
+#   the neighbourhood, oriented towards the viewpoint
+#
+# All results have the same shape as the input points, invalid points give NaN or
+# `False`.
+
+# %%
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Iterator, Optional, Union
+
+import numpy as np
+from nptyping import Bool, Float32, Int32, NDArray, Shape
+
+if TYPE_CHECKING:
+    from scipy.spatial import KDTree
+
+
+@dataclass
+class OrganizedNeighbourIndex:
+    xyz: NDArray[Shape["H, W, 3"], Float32]
+    window_size: int = 5
+    max_distance: Optional[float] = None
+    _padded_planes: NDArray[Shape["3, H, W"], Float32] = field(init=False, repr=False)
+    _padded_valid: NDArray[Shape["H, W"], Bool] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.window_size < 3 or self.window_size % 2 == 0:
+            raise ValueError("Window size must be odd and at least 3")
+        radius = self.window_size // 2
+        # One contiguous plane per axis makes every shifted pass a simple slice
+        self._padded_planes = np.pad(
+            self.xyz.astype(np.float32, copy=False).transpose(2, 0, 1),
+            ((0, 0), (radius, radius), (radius, radius)),
+            constant_values=np.nan,
+        )
+        self._padded_valid = ~np.isnan(self._padded_planes).any(axis=0)
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.xyz.shape[:-1]
+
+    def _shifted(
+        self, dy: int, dx: int
+    ) -> tuple[NDArray[Shape["3, H, W"], Float32], NDArray[Shape["H, W"], Bool]]:
+        radius = self.window_size // 2
+        height, width = self.shape
+        rows = slice(radius + dy, radius + dy + height)
+        columns = slice(radius + dx, radius + dx + width)
+        return self._padded_planes[:, rows, columns], self._padded_valid[rows, columns]
+
+    def _differences(
+        self,
+    ) -> Iterator[
+        tuple[
+            NDArray[Shape["3, H, W"], Float32],
+            NDArray[Shape["H, W"], Float32],
+            NDArray[Shape["H, W"], Bool],
+        ]
+    ]:
+        radius = self.window_size // 2
+        center, center_valid = self._shifted(dy=0, dx=0)
+        difference = np.empty_like(center)
+        squared_distance = np.empty(self.shape, dtype=np.float32)
+        for dy in range(-radius, radius + 1):
+            for dx in range(-radius, radius + 1):
+                if dy == 0 and dx == 0:
+                    continue
+                neighbours, neighbours_valid = self._shifted(dy=dy, dx=dx)
+                np.subtract(neighbours, center, out=difference)
+                np.einsum("ijk,ijk->jk", difference, difference, out=squared_distance)
+                valid = neighbours_valid & center_valid
+                if self.max_distance is not None:
+                    with np.errstate(invalid="ignore"):
+                        valid &= squared_distance <= self.max_distance**2
+                yield difference, squared_distance, valid
+
+    def mean_neighbour_distance(self) -> NDArray[Shape["H, W"], Float32]:
+        distance_sum = np.zeros(self.shape, dtype=np.float32)
+        count = np.zeros(self.shape, dtype=np.int32)
+        for _, squared_distance, valid in self._differences():
+            distance = np.sqrt(squared_distance)
+            np.copyto(distance, 0, where=~valid)
+            distance_sum += distance
+            count += valid
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(count > 0, distance_sum / count, np.nan).astype(np.float32)
+
+    def count_neighbours(self, radius: float) -> NDArray[Shape["H, W"], Int32]:
+        count = np.zeros(self.shape, dtype=np.int32)
+        for _, squared_distance, valid in self._differences():
+            with np.errstate(invalid="ignore"):
+                count += valid & (squared_distance <= radius**2)
+        return count
+
+    def neighbour_moments(
+        self,
+    ) -> tuple[
+        NDArray[Shape["H, W"], Int32],
+        NDArray[Shape["H, W, 3"], Float32],
+        NDArray[Shape["H, W, 3, 3"], Float32],
+    ]:
+        # Moments are accumulated relative to the center point to avoid cancellation
+        count = self._shifted(dy=0, dx=0)[1].astype(np.int32)
+        first_moment = np.zeros((3, *self.shape), dtype=np.float32)
+        second_moment = np.zeros((3, 3, *self.shape), dtype=np.float32)
+        for difference, _, valid in self._differences():
+            np.copyto(difference, 0, where=~valid)
+            count += valid
+            first_moment += difference
+            for i in range(3):
+                for j in range(i, 3):
+                    second_moment[i, j] += difference[i] * difference[j]
+        for i in range(3):
+            for j in range(i):
+                second_moment[i, j] = second_moment[j, i]
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_difference = np.moveaxis(first_moment / count, 0, -1)
+            covariance = (
+                np.moveaxis(second_moment / count, (0, 1), (-2, -1))
+                - mean_difference[..., :, None] * mean_difference[..., None, :]
+            )
+        return count, self.xyz + mean_difference, covariance
+
+
+@dataclass
+class KDTreeNeighbourIndex:
+    xyz: NDArray[Shape["*, ..."], Float32]
+    number_of_neighbours: int = 16
+    _valid: NDArray[Shape["N"], Bool] = field(init=False, repr=False)
+    _points: NDArray[Shape["N, 3"], Float32] = field(init=False, repr=False)
+    _tree: KDTree = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        points = self.xyz.reshape(-1, 3)
+        self._valid = ~np.isnan(points).any(axis=-1)
+        self._points = points[self._valid]
+        # scipy.spatial is slow to import, and only needed for unorganized points
+        # pylint: disable=import-outside-toplevel
+        from scipy.spatial import KDTree
+
+        self._tree = KDTree(self._points)
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return self.xyz.shape[:-1]
+
+    def _scatter(self, values: NDArray, fill_value: float) -> NDArray:
+        output = np.full(
+            (self._valid.shape[0], *values.shape[1:]), fill_value, dtype=values.dtype
+        )
+        output[self._valid] = values
+        return output.reshape(*self.shape, *values.shape[1:])
+
+    def _query(
+        self,
+    ) -> tuple[NDArray[Shape["N, K"], Float32], NDArray[Shape["N, K"], Int32]]:
+        # The closest point is the point itself, which is not a neighbour
+        distances, indices = self._tree.query(
+            self._points, k=self.number_of_neighbours + 1
+        )
+        return distances[:, 1:], indices[:, 1:]
+
+    def mean_neighbour_distance(self) -> NDArray[Shape["*"], Float32]:
+        distances, _ = self._query()
+        found = np.isfinite(distances)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_distance = (
+                np.where(found, distances, 0).sum(axis=-1) / found.sum(axis=-1)
+            ).astype(np.float32)
+        return self._scatter(values=mean_distance, fill_value=np.nan)
+
+    def count_neighbours(self, radius: float) -> NDArray[Shape["*"], Int32]:
+        count = self._tree.query_ball_point(self._points, r=radius, return_length=True)
+        return self._scatter(values=(count - 1).astype(np.int32), fill_value=0)
+
+    def neighbour_moments(
+        self,
+    ) -> tuple[
+        NDArray[Shape["*"], Int32],
+        NDArray[Shape["*, 3"], Float32],
+        NDArray[Shape["*, 3, 3"], Float32],
+    ]:
+        distances, indices = self._query()
+        found = np.isfinite(distances)
+        padded_points = np.vstack(
+            [self._points, np.zeros((1, 3), dtype=self._points.dtype)]
+        )
+        # Neighbours are taken relative to the center point to avoid cancellation
+        differences = np.where(
+            found[..., None],
+            padded_points[indices] - self._points[:, None, :],
+            0,
+        )
+
+        count = found.sum(axis=-1) + 1
+        mean_difference = differences.sum(axis=1) / count[:, None]
+        covariance = (
+            np.einsum("nki,nkj->nij", differences, differences) / count[:, None, None]
+            - mean_difference[:, :, None] * mean_difference[:, None, :]
+        )
+        return (
+            self._scatter(values=count.astype(np.int32), fill_value=0),
+            self._scatter(
+                values=(self._points + mean_difference).astype(np.float32),
+                fill_value=np.nan,
+            ),
+            self._scatter(values=covariance.astype(np.float32), fill_value=np.nan),
+        )
+
+
+NeighbourIndex = Union[OrganizedNeighbourIndex, KDTreeNeighbourIndex]
+
+
+def statistical_outlier_removal(
+    neighbour_index: NeighbourIndex, std_ratio: float = 2.0
+) -> NDArray[Shape["*, ..."], Bool]:
+    mean_distance = neighbour_index.mean_neighbour_distance()
+    threshold = np.nanmean(mean_distance) + std_ratio * np.nanstd(mean_distance)
+    with np.errstate(invalid="ignore"):
+        return mean_distance <= threshold
+
+
+def radius_outlier_removal(
+    neighbour_index: NeighbourIndex, radius: float, minimum_neighbours: int = 4
+) -> NDArray[Shape["*, ..."], Bool]:
+    valid = ~np.isnan(neighbour_index.xyz).any(axis=-1)
+    return valid & (
+        neighbour_index.count_neighbours(radius=radius) >= minimum_neighbours
+    )
+
+
+def estimate_normals(
+    neighbour_index: NeighbourIndex,
+    viewpoint: NDArray[Shape["3"], Float32] = np.zeros(3, dtype=np.float32),
+) -> NDArray[Shape["*, ..."], Float32]:
+    count, _, covariance = neighbour_index.neighbour_moments()
+    valid = (count >= 3) & np.isfinite(covariance).all(axis=(-2, -1))
+
+    normals = np.full((*count.shape, 3), np.nan, dtype=np.float32)
+    # Eigenvalues are in ascending order, the first eigenvector is the normal
+    _, eigenvectors = np.linalg.eigh(covariance[valid])
+    normals[valid] = eigenvectors[..., 0]
+
+    to_viewpoint = viewpoint - neighbour_index.xyz
+    flip = (normals * to_viewpoint).sum(axis=-1) < 0
+    normals[flip] *= -1
+    return normals
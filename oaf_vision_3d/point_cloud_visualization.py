@@ -17,8 +17,7 @@ def open3d_visualize_point_cloud(
         # pylint: disable=import-outside-toplevel
         import open3d as o3d  # type: ignore
 
-        points = xyz.reshape(-1, 3)
-        points[:, 1:3] *= -1
+        points = xyz.reshape(-1, 3) * np.array([1, -1, -1], dtype=np.float32)
         colors = rgb.reshape(-1, 3)
         invalid = np.isnan(points).any(axis=1)
         points = points[~invalid]
@@ -6,6 +6,21 @@ import numpy as np
 from nptyping import Float32, NDArray, Shape
 
 
+def subvalue_offset_poly_2(
+    f_0: NDArray[Shape["H, W"], Float32],
+    f_1: NDArray[Shape["H, W"], Float32],
+    f_2: NDArray[Shape["H, W"], Float32],
+) -> NDArray[Shape["H, W"], Float32]:
+    a = 0.5 * (f_0 + f_2) - f_1
+    b = 0.5 * (f_2 - f_0)
+
+    denom = 2 * a
+    denom = np.where(denom == 0, np.nan, denom)
+
+    delta = -b / denom
+    return np.where(np.abs(delta) > 1, np.nan, delta)
+
+
 def find_subvalue_poly_2(
     values: NDArray[Shape["N"], Float32],
     function_value: NDArray[Shape["N, H, W"], Float32],
@@ -16,17 +31,10 @@ def find_subvalue_poly_2(
 
     idx = np.clip(np.argmin(function_value, axis=0), 1, values.shape[0] - 2)
 
-    f_0 = function_value[idx - 1, h_idx, w_idx]
-    f_1 = function_value[idx, h_idx, w_idx]
-    f_2 = function_value[idx + 1, h_idx, w_idx]
-
-    a = 0.5 * (f_0 + f_2) - f_1
-    b = 0.5 * (f_2 - f_0)
-
-    denom = 2 * a
-    denom = np.where(denom == 0, np.nan, denom)
-
-    delta = -b / denom
-    delta = np.where(np.abs(delta) > 1, np.nan, delta)
+    delta = subvalue_offset_poly_2(
+        f_0=function_value[idx - 1, h_idx, w_idx].astype(np.float32),
+        f_1=function_value[idx, h_idx, w_idx].astype(np.float32),
+        f_2=function_value[idx + 1, h_idx, w_idx].astype(np.float32),
+    )
 
     return values[idx] + delta
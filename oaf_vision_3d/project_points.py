@@ -4,19 +4,29 @@
 # This function projects 3D points into a 2D image using a
 # [`LensModel`](lens_model.py) object. The process for this was discussed in more
 # detail in the workshop [4: 3D-2D Projections and PnP](../workshops/04_3d_2d_projections_and_pnp.ipynb).
+#
+# `project_points_array` projects the same points, or one set of points per camera,
+# into all cameras of a `LensModelArray` in one broadcasted evaluation.
 
 # %%
+from typing import Optional
+
+import numpy as np
 from nptyping import Float32, NDArray, Shape
 
-from oaf_vision_3d.lens_model import LensModel
+from oaf_vision_3d.instrumentation import instrument
+from oaf_vision_3d.lens_model import LensModel, LensModelArray
 from oaf_vision_3d.transformation_matrix import TransformationMatrix
 
 
+@instrument("project_points")
 def project_points(
     points: NDArray[Shape["*, 3"], Float32],
     lens_model: LensModel,
-    transformation_matrix: TransformationMatrix = TransformationMatrix(),
+    transformation_matrix: Optional[TransformationMatrix] = None,
 ) -> NDArray[Shape["*, 2"], Float32]:
+    if transformation_matrix is None:
+        transformation_matrix = TransformationMatrix()
     transformed_points = transformation_matrix @ points[None, ...]
 
     undistorted_normalized_pixels = (
@@ -26,3 +36,41 @@ def project_points(
         normalized_pixels=undistorted_normalized_pixels
     )
     return lens_model.denormalize_pixels(pixels=normalized_pixels)[0]
+
+
+@instrument("project_points_array")
+def project_points_array(
+    points: NDArray[Shape["*, 3"], Float32],
+    lens_model_array: LensModelArray,
+    transformation_matrices: Optional[list[TransformationMatrix]] = None,
+) -> NDArray[Shape["K, *, 2"], Float32]:
+    number_of_cameras = len(lens_model_array)
+    if points.ndim == 2:
+        points = points[None, ...]
+    if points.shape[0] not in (1, number_of_cameras):
+        raise ValueError("Points must have the shape (N, 3) or (K, N, 3)")
+
+    # Without transformations the identity is used, like in project_points
+    rotations = np.identity(3)[None, ...]
+    translations = np.zeros((1, 3), dtype=np.float32)
+    if transformation_matrices is not None:
+        if len(transformation_matrices) != number_of_cameras:
+            raise ValueError("Expected one transformation matrix per camera")
+        rotations = np.stack(
+            [_matrix.rotation.as_matrix() for _matrix in transformation_matrices]
+        )
+        translations = np.stack(
+            [_matrix.translation for _matrix in transformation_matrices]
+        )
+    transformed_points = np.broadcast_to(
+        points @ rotations.transpose(0, 2, 1) + translations[:, None, :],
+        (number_of_cameras, *points.shape[1:]),
+    )
+
+    undistorted_normalized_pixels = (
+        transformed_points[..., :2] / transformed_points[..., 2:]
+    )
+    normalized_pixels = lens_model_array.distort_pixels(
+        normalized_pixels=undistorted_normalized_pixels
+    )
+    return lens_model_array.denormalize_pixels(pixels=normalized_pixels)
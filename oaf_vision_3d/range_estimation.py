@@ -0,0 +1,455 @@
+# %% [markdown]
+# # Range Estimation
+#
+# `block_matching` and `plane_sweeping` search every disparity or depth in the given
+# range, so the run time grows with the range. The range of a dataset, like the
+# `expected_disparity` of `StereoData`, is usually much wider than what the scene
+# needs. The functions in this module estimate a tight range from a sparse set of
+# features, which costs a small fraction of the matching:
+# - Corners are detected in both images with the Harris response, with non-maximum
+#   suppression so they are spread over the image
+# - Every corner is described by its normalized patch, and the corners are matched
+#   with the normalized cross-correlation. A match must be the best for both corners,
+#   and clearly better than the second best. For rectified images the matches must
+#   lie on the same row, and within the given wide disparity range
+# - For plane sweeping the matches are triangulated with `triangulate_points`, and
+#   only the points that project back onto their match in the second camera are kept
+#
+# The range is taken between two percentiles of the matched disparities or depths,
+# so a few wrong matches do not widen it, and extended by a margin. It can be
+# estimated for the full image, or coarsely for every tile of
+# [tiled processing](tiled_processing.py) from the features in and around the tile.
+# Tiles with too few features get the range of the full image.
+
+# %%
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import numpy as np
+from nptyping import Float32, Int32, NDArray, Shape
+from scipy.ndimage import gaussian_filter, maximum_filter, sobel
+
+from oaf_vision_3d.instrumentation import stage
+from oaf_vision_3d.lens_model import LensModel
+from oaf_vision_3d.project_points import project_points
+from oaf_vision_3d.tiled_processing import tile_grid_shape
+from oaf_vision_3d.transformation_matrix import TransformationMatrix
+from oaf_vision_3d.triangulation import triangulate_points
+
+_HARRIS_K = 0.04
+_HARRIS_SIGMA = 1.5
+
+
+@dataclass
+class FeatureMatches:
+    pixels_0: NDArray[Shape["N, 2"], Float32]
+    pixels_1: NDArray[Shape["N, 2"], Float32]
+    score: NDArray[Shape["N"], Float32]
+
+    def __len__(self) -> int:
+        return self.score.shape[0]
+
+    @staticmethod
+    def empty() -> FeatureMatches:
+        return FeatureMatches(
+            pixels_0=np.zeros((0, 2), dtype=np.float32),
+            pixels_1=np.zeros((0, 2), dtype=np.float32),
+            score=np.zeros(0, dtype=np.float32),
+        )
+
+
+def _gray(
+    image: NDArray[Shape["H, W, ..."], Float32],
+) -> NDArray[Shape["H, W"], Float32]:
+    return np.asarray(image, dtype=np.float32).reshape(*image.shape[:2], -1).mean(-1)
+
+
+def detect_corners(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    max_corners: int = 1000,
+    minimum_distance: int = 8,
+    border: int = 8,
+    quality: float = 0.01,
+) -> NDArray[Shape["N, 2"], Int32]:
+    gray = _gray(image)
+    gradient_x, gradient_y = sobel(gray, axis=1), sobel(gray, axis=0)
+    xx = gaussian_filter(gradient_x * gradient_x, _HARRIS_SIGMA)
+    yy = gaussian_filter(gradient_y * gradient_y, _HARRIS_SIGMA)
+    xy = gaussian_filter(gradient_x * gradient_y, _HARRIS_SIGMA)
+    response = xx * yy - xy * xy - _HARRIS_K * (xx + yy) ** 2
+
+    is_corner = (
+        response == maximum_filter(response, size=2 * minimum_distance + 1)
+    ) & (response > quality * response.max())
+    is_corner[:border] = is_corner[-border:] = False
+    is_corner[:, :border] = is_corner[:, -border:] = False
+
+    rows, columns = np.nonzero(is_corner)
+    strongest = np.argsort(-response[rows, columns], kind="stable")[:max_corners]
+    return np.stack([columns[strongest], rows[strongest]], axis=-1).astype(np.int32)
+
+
+def _patch_descriptors(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    corners: NDArray[Shape["N, 2"], Int32],
+    patch_radius: int,
+) -> NDArray[Shape["N, P"], Float32]:
+    image = np.asarray(image, dtype=np.float32).reshape(*image.shape[:2], -1)
+    size = 2 * patch_radius + 1
+    if corners.shape[0] == 0:
+        return np.zeros((0, size * size * image.shape[-1]), dtype=np.float32)
+    patches = np.lib.stride_tricks.sliding_window_view(
+        np.pad(image, ((patch_radius,) * 2, (patch_radius,) * 2, (0, 0))),
+        (size, size, image.shape[-1]),
+    )[corners[:, 1], corners[:, 0], 0].reshape(corners.shape[0], -1)
+    patches = patches - patches.mean(axis=-1, keepdims=True)
+    norm = np.linalg.norm(patches, axis=-1, keepdims=True)
+    return patches / np.where(norm > 0, norm, np.inf)
+
+
+def match_features(
+    image_0: NDArray[Shape["H, W, ..."], Float32],
+    image_1: NDArray[Shape["H, W, ..."], Float32],
+    max_corners: int = 1000,
+    patch_radius: int = 7,
+    minimum_score: float = 0.8,
+    ratio: float = 0.9,
+    max_row_difference: Optional[float] = None,
+    disparity_range: Optional[NDArray[Shape["2"], Float32]] = None,
+) -> FeatureMatches:
+    with stage("range_estimation.features", corners=2 * max_corners):
+        corners_0 = detect_corners(
+            image_0, max_corners=max_corners, border=patch_radius
+        )
+        corners_1 = detect_corners(
+            image_1, max_corners=max_corners, border=patch_radius
+        )
+        # Flat or dark images have no corners
+        if corners_0.shape[0] == 0 or corners_1.shape[0] == 0:
+            return FeatureMatches.empty()
+        score = (
+            _patch_descriptors(image_0, corners_0, patch_radius)
+            @ _patch_descriptors(image_1, corners_1, patch_radius).T
+        )
+
+    with stage("range_estimation.matching", pairs=score.size):
+        if max_row_difference is not None:
+            row_difference = corners_0[:, None, 1] - corners_1[None, :, 1]
+            score[np.abs(row_difference) > max_row_difference] = -np.inf
+        if disparity_range is not None:
+            # The second image is sampled at x - d, like in block_matching
+            disparity = corners_0[:, None, 0] - corners_1[None, :, 0]
+            score[
+                (disparity <= disparity_range[0]) | (disparity >= disparity_range[1])
+            ] = -np.inf
+
+        if score.shape[1] < 2:
+            return FeatureMatches.empty()
+        best = np.argmax(score, axis=1)
+        best_score = score[np.arange(score.shape[0]), best]
+        second_best_score = np.partition(score, -2, axis=1)[:, -2]
+        is_match = (
+            (np.argmax(score, axis=0)[best] == np.arange(score.shape[0]))
+            & (best_score >= minimum_score)
+            & (1 - best_score <= ratio * (1 - second_best_score))
+        )
+
+    return FeatureMatches(
+        pixels_0=corners_0[is_match].astype(np.float32),
+        pixels_1=corners_1[best[is_match]].astype(np.float32),
+        score=best_score[is_match].astype(np.float32),
+    )
+
+
+def triangulate_matches(
+    matches: FeatureMatches,
+    lens_model_0: LensModel,
+    lens_model_1: LensModel,
+    transformation_matrix: TransformationMatrix,
+    max_reprojection_error: float = 2.0,
+) -> NDArray[Shape["N, 3"], Float32]:
+    points = triangulate_points(
+        undistorted_normalized_pixels_0=lens_model_0.undistort_pixels(
+            normalized_pixels=lens_model_0.normalize_pixels(
+                pixels=matches.pixels_0[None, ...]
+            )
+        ),
+        undistorted_normalized_pixels_1=lens_model_1.undistort_pixels(
+            normalized_pixels=lens_model_1.normalize_pixels(
+                pixels=matches.pixels_1[None, ...]
+            )
+        ),
+        transformation_matrix=transformation_matrix,
+    )[0]
+    reprojected_pixels = project_points(
+        points=points,
+        lens_model=lens_model_1,
+        transformation_matrix=transformation_matrix.inverse(),
+    )
+    reprojection_error = np.linalg.norm(reprojected_pixels - matches.pixels_1, axis=-1)
+    points[~(reprojection_error <= max_reprojection_error) | (points[:, 2] <= 0)] = (
+        np.nan
+    )
+    return points
+
+
+def robust_range(
+    values: NDArray[Shape["N"], Float32],
+    percentiles: tuple[float, float] = (2.0, 98.0),
+) -> Optional[NDArray[Shape["2"], Float32]]:
+    values = values[np.isfinite(values)]
+    if values.shape[0] == 0:
+        return None
+    return np.percentile(values, percentiles).astype(np.float32)
+
+
+def _disparity_range_with_margin(
+    disparity_range: NDArray[Shape["2"], Float32],
+    margin: int,
+    bounds: Optional[NDArray[Shape["2"], Float32]],
+) -> NDArray[Shape["2"], Float32]:
+    # Disparities at the ends of the range are set to NaN, so both ends are exclusive
+    minimum = np.floor(disparity_range[0]) - margin
+    maximum = np.ceil(disparity_range[1]) + margin + 1
+    if bounds is not None:
+        minimum, maximum = max(minimum, bounds[0]), min(maximum, bounds[1])
+    return np.array([minimum, maximum], dtype=np.float32)
+
+
+def _depth_range_with_margin(
+    depth_range: NDArray[Shape["2"], Float32],
+    margin: float,
+    bounds: Optional[NDArray[Shape["2"], Float32]],
+) -> NDArray[Shape["2"], Float32]:
+    minimum = depth_range[0] * (1 - margin)
+    maximum = depth_range[1] * (1 + margin)
+    if bounds is not None:
+        minimum, maximum = max(minimum, bounds[0]), min(maximum, bounds[1])
+    return np.array([minimum, maximum], dtype=np.float32)
+
+
+def _estimated_range(
+    values: NDArray[Shape["N"], Float32],
+    percentiles: tuple[float, float],
+    to_range: Callable[[NDArray[Shape["2"], Float32]], NDArray[Shape["2"], Float32]],
+    fallback_range: Optional[NDArray[Shape["2"], Float32]],
+) -> NDArray[Shape["2"], Float32]:
+    estimated_range = robust_range(values, percentiles=percentiles)
+    if estimated_range is not None:
+        return to_range(estimated_range)
+    if fallback_range is None:
+        raise ValueError("No features matched and no range to fall back to")
+    return np.asarray(fallback_range, dtype=np.float32)
+
+
+def _matched_disparities(
+    image_0: NDArray[Shape["H, W, ..."], Float32],
+    image_1: NDArray[Shape["H, W, ..."], Float32],
+    disparity_range: Optional[NDArray[Shape["2"], Float32]],
+    max_corners: int,
+) -> tuple[NDArray[Shape["N, 2"], Float32], NDArray[Shape["N"], Float32]]:
+    matches = match_features(
+        image_0=image_0,
+        image_1=image_1,
+        max_corners=max_corners,
+        max_row_difference=1.0,
+        disparity_range=disparity_range,
+    )
+    return matches.pixels_0, matches.pixels_0[:, 0] - matches.pixels_1[:, 0]
+
+
+def _matched_depths(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    secondary_image: NDArray[Shape["H, W, ..."], Float32],
+    lens_model: LensModel,
+    secondary_lens_model: LensModel,
+    secondary_transformation_matrix: TransformationMatrix,
+    depth_range: Optional[NDArray[Shape["2"], Float32]],
+    max_corners: int,
+) -> tuple[NDArray[Shape["N, 2"], Float32], NDArray[Shape["N"], Float32]]:
+    matches = match_features(
+        image_0=image, image_1=secondary_image, max_corners=max_corners
+    )
+    depths = triangulate_matches(
+        matches=matches,
+        lens_model_0=lens_model,
+        lens_model_1=secondary_lens_model,
+        transformation_matrix=secondary_transformation_matrix,
+    )[:, 2]
+    if depth_range is not None:
+        depths[(depths < depth_range[0]) | (depths > depth_range[1])] = np.nan
+    return matches.pixels_0, depths
+
+
+def estimate_disparity_range(
+    image_0: NDArray[Shape["H, W, ..."], Float32],
+    image_1: NDArray[Shape["H, W, ..."], Float32],
+    disparity_range: Optional[NDArray[Shape["2"], Float32]] = None,
+    percentiles: tuple[float, float] = (2.0, 98.0),
+    margin: int = 2,
+    max_corners: int = 1000,
+) -> NDArray[Shape["2"], Float32]:
+    _, disparities = _matched_disparities(
+        image_0=image_0,
+        image_1=image_1,
+        disparity_range=disparity_range,
+        max_corners=max_corners,
+    )
+    return _estimated_range(
+        values=disparities,
+        percentiles=percentiles,
+        to_range=lambda estimated_range: _disparity_range_with_margin(
+            estimated_range, margin=margin, bounds=disparity_range
+        ),
+        fallback_range=disparity_range,
+    )
+
+
+def estimate_depth_range(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    secondary_image: NDArray[Shape["H, W, ..."], Float32],
+    lens_model: LensModel,
+    secondary_lens_model: LensModel,
+    secondary_transformation_matrix: TransformationMatrix,
+    depth_range: Optional[NDArray[Shape["2"], Float32]] = None,
+    percentiles: tuple[float, float] = (2.0, 98.0),
+    margin: float = 0.1,
+    max_corners: int = 1000,
+) -> NDArray[Shape["2"], Float32]:
+    _, depths = _matched_depths(
+        image=image,
+        secondary_image=secondary_image,
+        lens_model=lens_model,
+        secondary_lens_model=secondary_lens_model,
+        secondary_transformation_matrix=secondary_transformation_matrix,
+        depth_range=depth_range,
+        max_corners=max_corners,
+    )
+    return _estimated_range(
+        values=depths,
+        percentiles=percentiles,
+        to_range=lambda estimated_range: _depth_range_with_margin(
+            estimated_range, margin=margin, bounds=depth_range
+        ),
+        fallback_range=depth_range,
+    )
+
+
+def _tile_ranges(
+    pixels: NDArray[Shape["N, 2"], Float32],
+    values: NDArray[Shape["N"], Float32],
+    grid_shape: tuple[int, int],
+    tile_size: NDArray[Shape["[x, y]"], Int32],
+    global_range: NDArray[Shape["2"], Float32],
+    to_range: Callable[[NDArray[Shape["2"], Float32]], NDArray[Shape["2"], Float32]],
+    percentiles: tuple[float, float],
+    minimum_matches: int,
+) -> NDArray[Shape["R, C, 2"], Float32]:
+    # The features within half a tile around the tile are used as well, as they see
+    # the same part of the scene at the tile border
+    tile_width, tile_height = int(tile_size[0]), int(tile_size[1])
+    ranges = np.empty((*grid_shape, 2), dtype=np.float32)
+    ranges[...] = global_range
+    is_valid = np.isfinite(values)
+    for row, column in np.ndindex(grid_shape):
+        is_near = (
+            is_valid
+            & (np.abs(pixels[:, 0] - (column + 0.5) * tile_width) <= tile_width)
+            & (np.abs(pixels[:, 1] - (row + 0.5) * tile_height) <= tile_height)
+        )
+        if np.count_nonzero(is_near) >= minimum_matches:
+            ranges[row, column] = _estimated_range(
+                values=values[is_near],
+                percentiles=percentiles,
+                to_range=to_range,
+                fallback_range=global_range,
+            )
+    return ranges
+
+
+def estimate_tile_disparity_ranges(
+    image_0: NDArray[Shape["H, W, ..."], Float32],
+    image_1: NDArray[Shape["H, W, ..."], Float32],
+    tile_size: NDArray[Shape["[x, y]"], Int32] = np.array([1024, 512], dtype=np.int32),
+    disparity_range: Optional[NDArray[Shape["2"], Float32]] = None,
+    percentiles: tuple[float, float] = (2.0, 98.0),
+    margin: int = 2,
+    max_corners: int = 1000,
+    minimum_matches: int = 10,
+) -> NDArray[Shape["R, C, 2"], Float32]:
+    pixels, disparities = _matched_disparities(
+        image_0=image_0,
+        image_1=image_1,
+        disparity_range=disparity_range,
+        max_corners=max_corners,
+    )
+    global_range = _estimated_range(
+        values=disparities,
+        percentiles=percentiles,
+        to_range=lambda estimated_range: _disparity_range_with_margin(
+            estimated_range, margin=margin, bounds=disparity_range
+        ),
+        fallback_range=disparity_range,
+    )
+    return _tile_ranges(
+        pixels=pixels,
+        values=disparities,
+        grid_shape=tile_grid_shape(
+            height=image_0.shape[0], width=image_0.shape[1], tile_size=tile_size
+        ),
+        tile_size=tile_size,
+        global_range=global_range,
+        to_range=lambda estimated_range: _disparity_range_with_margin(
+            estimated_range, margin=margin, bounds=global_range
+        ),
+        percentiles=percentiles,
+        minimum_matches=minimum_matches,
+    )
+
+
+def estimate_tile_depth_ranges(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    secondary_image: NDArray[Shape["H, W, ..."], Float32],
+    lens_model: LensModel,
+    secondary_lens_model: LensModel,
+    secondary_transformation_matrix: TransformationMatrix,
+    tile_size: NDArray[Shape["[x, y]"], Int32] = np.array([512, 512], dtype=np.int32),
+    depth_range: Optional[NDArray[Shape["2"], Float32]] = None,
+    percentiles: tuple[float, float] = (2.0, 98.0),
+    margin: float = 0.1,
+    max_corners: int = 1000,
+    minimum_matches: int = 10,
+) -> NDArray[Shape["R, C, 2"], Float32]:
+    pixels, depths = _matched_depths(
+        image=image,
+        secondary_image=secondary_image,
+        lens_model=lens_model,
+        secondary_lens_model=secondary_lens_model,
+        secondary_transformation_matrix=secondary_transformation_matrix,
+        depth_range=depth_range,
+        max_corners=max_corners,
+    )
+    global_range = _estimated_range(
+        values=depths,
+        percentiles=percentiles,
+        to_range=lambda estimated_range: _depth_range_with_margin(
+            estimated_range, margin=margin, bounds=depth_range
+        ),
+        fallback_range=depth_range,
+    )
+    return _tile_ranges(
+        pixels=pixels,
+        values=depths,
+        grid_shape=tile_grid_shape(
+            height=image.shape[0], width=image.shape[1], tile_size=tile_size
+        ),
+        tile_size=tile_size,
+        global_range=global_range,
+        to_range=lambda estimated_range: _depth_range_with_margin(
+            estimated_range, margin=margin, bounds=global_range
+        ),
+        percentiles=percentiles,
+        minimum_matches=minimum_matches,
+    )
@@ -0,0 +1,215 @@
+# %% [markdown]
+# # Region of Interest
+#
+# Often depth is only needed for a few regions of the image, like detected objects or
+# a conveyor belt. `block_matching` and `plane_sweeping` take a region of interest as
+# either:
+# - A list of rectangles `[x, y, width, height]` in pixels
+# - A boolean mask with the size of the image, which is split into the bounding boxes
+#   of its connected components
+#
+# Every rectangle is processed as a `Tile`: the rectangle itself (the core) and a
+# window around it with the halo the method needs for aggregation. The work then
+# scales with the area of the windows instead of the image. The result is either
+# returned in full-frame coordinates with NaN outside the region of interest, or
+# cropped to the bounding box of the region of interest.
+#
+# The same tiles are used by [tiled processing](tiled_processing.py), together with the
+# helpers to move the principal point of a lens model to a crop and to find the window
+# of a secondary image that a tile projects to.
+
+# %%
+from dataclasses import dataclass
+from typing import Sequence, Union
+
+import numpy as np
+from nptyping import Bool, Float32, Int32, NDArray, Shape
+from scipy.ndimage import find_objects, label
+
+from oaf_vision_3d.lens_model import CameraMatrix, LensModel
+from oaf_vision_3d.project_points import project_points
+from oaf_vision_3d.transformation_matrix import TransformationMatrix
+
+_PROJECTED_WINDOW_MARGIN = 2
+
+RegionOfInterest = Union[Sequence[Sequence[int]], NDArray[Shape["H, W"], Bool]]
+
+
+@dataclass(frozen=True)
+class Tile:
+    core: tuple[slice, slice]
+    window: tuple[slice, slice]
+
+    @property
+    def core_in_window(self) -> tuple[slice, slice]:
+        core_rows, core_columns = self.core
+        window_rows, window_columns = self.window
+        return (
+            slice(
+                core_rows.start - window_rows.start, core_rows.stop - window_rows.start
+            ),
+            slice(
+                core_columns.start - window_columns.start,
+                core_columns.stop - window_columns.start,
+            ),
+        )
+
+
+def tile_with_halo(
+    core: tuple[slice, slice],
+    halo: NDArray[Shape["[x, y]"], Int32],
+    height: int,
+    width: int,
+) -> Tile:
+    rows, columns = core
+    return Tile(
+        core=core,
+        window=(
+            slice(
+                max(rows.start - int(halo[1]), 0), min(rows.stop + int(halo[1]), height)
+            ),
+            slice(
+                max(columns.start - int(halo[0]), 0),
+                min(columns.stop + int(halo[0]), width),
+            ),
+        ),
+    )
+
+
+def _is_mask(region_of_interest: RegionOfInterest) -> bool:
+    return (
+        isinstance(region_of_interest, np.ndarray) and region_of_interest.dtype == bool
+    )
+
+
+def region_of_interest_mask(
+    region_of_interest: RegionOfInterest, height: int, width: int
+) -> NDArray[Shape["H, W"], Bool]:
+    if _is_mask(region_of_interest):
+        mask = np.asarray(region_of_interest, dtype=bool)
+        if mask.shape != (height, width):
+            raise ValueError("Region of interest mask must have the size of the image")
+        return mask
+
+    mask = np.zeros((height, width), dtype=bool)
+    for x, y, rectangle_width, rectangle_height in region_of_interest:
+        mask[
+            max(y, 0) : max(y + rectangle_height, 0),
+            max(x, 0) : max(x + rectangle_width, 0),
+        ] = True
+    return mask
+
+
+def region_of_interest_tiles(
+    region_of_interest: RegionOfInterest,
+    height: int,
+    width: int,
+    halo: NDArray[Shape["[x, y]"], Int32],
+) -> list[Tile]:
+    if _is_mask(region_of_interest):
+        labels = np.zeros((height, width), dtype=np.int32)
+        label(
+            region_of_interest_mask(region_of_interest, height=height, width=width),
+            output=labels,
+        )
+        cores = [core for core in find_objects(labels) if core is not None]
+    else:
+        cores = [
+            (
+                slice(max(y, 0), min(y + rectangle_height, height)),
+                slice(max(x, 0), min(x + rectangle_width, width)),
+            )
+            for x, y, rectangle_width, rectangle_height in region_of_interest
+        ]
+
+    return [
+        tile_with_halo(core=core, halo=halo, height=height, width=width)
+        for core in cores
+        if core[0].stop > core[0].start and core[1].stop > core[1].start
+    ]
+
+
+def apply_region_of_interest(
+    values: NDArray[Shape["H, W, ..."], Float32],
+    region_of_interest: RegionOfInterest,
+    crop: bool,
+) -> NDArray[Shape["H, W, ..."], Float32]:
+    mask = region_of_interest_mask(
+        region_of_interest, height=values.shape[0], width=values.shape[1]
+    )
+    values[~mask] = np.nan
+    if not crop:
+        return values
+
+    rows, columns = np.nonzero(mask.any(axis=1))[0], np.nonzero(mask.any(axis=0))[0]
+    if rows.shape[0] == 0:
+        return values[:0, :0]
+    return values[rows[0] : rows[-1] + 1, columns[0] : columns[-1] + 1]
+
+
+def crop_lens_model(lens_model: LensModel, x: float, y: float) -> LensModel:
+    camera_matrix = lens_model.camera_matrix
+    return LensModel(
+        camera_matrix=CameraMatrix(
+            fx=camera_matrix.fx,
+            fy=camera_matrix.fy,
+            cx=camera_matrix.cx - x,
+            cy=camera_matrix.cy - y,
+        ),
+        distortion_coefficients=lens_model.distortion_coefficients,
+    )
+
+
+def _window_border_pixels(
+    window: tuple[slice, slice],
+) -> NDArray[Shape["N, 2"], Float32]:
+    rows = np.arange(window[0].start, window[0].stop, dtype=np.float32)
+    columns = np.arange(window[1].start, window[1].stop, dtype=np.float32)
+    return np.concatenate(
+        [
+            np.stack([columns, np.full_like(columns, rows[0])], axis=-1),
+            np.stack([columns, np.full_like(columns, rows[-1])], axis=-1),
+            np.stack([np.full_like(rows, columns[0]), rows], axis=-1),
+            np.stack([np.full_like(rows, columns[-1]), rows], axis=-1),
+        ]
+    )
+
+
+def projected_window(
+    window: tuple[slice, slice],
+    lens_model: LensModel,
+    secondary_lens_model: LensModel,
+    secondary_transformation_matrix: TransformationMatrix,
+    depths: NDArray[Shape["D"], Float32],
+    secondary_shape: tuple[int, ...],
+) -> tuple[slice, slice]:
+    # The projection of the window is bounded by the projection of its border
+    border_pixels = _window_border_pixels(window)[None, ...]
+    camera_vectors = np.pad(
+        lens_model.undistort_pixels(
+            normalized_pixels=lens_model.normalize_pixels(pixels=border_pixels)
+        )[0],
+        ((0, 0), (0, 1)),
+        constant_values=1.0,
+    )
+    projected_points = project_points(
+        points=(camera_vectors[None, :, :] * depths[:, None, None]).reshape(-1, 3),
+        lens_model=secondary_lens_model,
+        transformation_matrix=secondary_transformation_matrix.inverse(),
+    )
+    projected_points = projected_points[np.isfinite(projected_points).all(axis=-1)]
+    if projected_points.shape[0] == 0:
+        return slice(0, 1), slice(0, 1)
+
+    minimum = np.floor(projected_points.min(axis=0)) - _PROJECTED_WINDOW_MARGIN
+    maximum = np.ceil(projected_points.max(axis=0)) + _PROJECTED_WINDOW_MARGIN + 1
+    height, width = secondary_shape[:2]
+    rows = slice(
+        int(np.clip(minimum[1], 0, height - 1)), int(np.clip(maximum[1], 1, height))
+    )
+    columns = slice(
+        int(np.clip(minimum[0], 0, width - 1)), int(np.clip(maximum[0], 1, width))
+    )
+    if rows.stop <= rows.start or columns.stop <= columns.start:
+        return slice(0, 1), slice(0, 1)
+    return rows, columns
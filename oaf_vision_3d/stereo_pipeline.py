@@ -0,0 +1,174 @@
+# %% [markdown]
+# # Stereo Pipeline
+#
+# The workshop [8: Building Your 3D Vision Pipeline](../workshops/08_building_your_3d_vision_pipeline.ipynb)
+# chains `block_matching` and `triangulate_disparity`, and every call recomputes the
+# parts that only depend on the camera rig. `StereoPipeline` is constructed once per
+# rig and keeps this state between frames:
+# - The undistorted camera vectors of the first camera, and the terms of the
+#   triangulation that only depend on them
+# - The undistorted and rotated camera vectors of the second camera at every integer
+#   pixel. A disparity moves a pixel along the row, so the vector at a subpixel
+#   position is interpolated linearly between two neighbouring pixels instead of
+#   undistorting it iteratively for every frame.
+# - The [cost volume](cost_volume.py), which `block_matching_cost_volume` fills for
+#   every frame instead of allocating a new one
+#
+# The images are expected to be rectified, as for `block_matching`. `process` returns
+# the disparity, the triangulated points and the `confidence` of the cost volume. The
+# matching and the reductions are the ones of `block_matching`, so the disparity is
+# equal to the one from `block_matching`, and the points are equal to the ones from
+# `triangulate_disparity` up to the interpolation of the camera vectors.
+
+# %%
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+
+import numpy as np
+from nptyping import Float32, Int32, NDArray, Shape
+
+from oaf_vision_3d._stereo_data_reader import StereoData
+from oaf_vision_3d.block_matching import (
+    CostFunction,
+    block_matching_cost_volume,
+    mask_disparity_border,
+)
+from oaf_vision_3d.cost_volume import CostVolume
+from oaf_vision_3d.instrumentation import instrument, stage
+from oaf_vision_3d.lens_model import LensModel
+from oaf_vision_3d.plane_sweeping import get_camera_vectors
+from oaf_vision_3d.transformation_matrix import TransformationMatrix
+
+
+@dataclass
+class StereoResult:
+    disparity: NDArray[Shape["H, W"], Float32]
+    xyz: NDArray[Shape["H, W, 3"], Float32]
+    confidence: NDArray[Shape["H, W"], Float32]
+
+
+@dataclass
+class StereoPipeline:
+    lens_model_0: LensModel
+    lens_model_1: LensModel
+    transformation_matrix: TransformationMatrix
+    width: int
+    height: int
+    disparity_range: NDArray[Shape["2"], Float32]
+    block_size: NDArray[Shape["[x, y]"], Int32] = field(
+        default_factory=lambda: np.array([11, 11], dtype=np.int32)
+    )
+    subpixel_fit: bool = True
+    cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE
+    _cost_volume: CostVolume = field(init=False, repr=False)
+    _camera_vectors_0: NDArray[Shape["H, W, 3"], Float32] = field(
+        init=False, repr=False
+    )
+    _camera_vectors_1: NDArray[Shape["H, W, 3"], Float32] = field(
+        init=False, repr=False
+    )
+    _baseline: NDArray[Shape["3"], Float32] = field(init=False, repr=False)
+    _a: NDArray[Shape["H, W"], Float32] = field(init=False, repr=False)
+    _d: NDArray[Shape["H, W"], Float32] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._cost_volume = CostVolume.empty(
+            values=np.arange(
+                self.disparity_range[0], self.disparity_range[1], dtype=np.int32
+            ).astype(np.float32),
+            height=self.height,
+            width=self.width,
+        )
+
+        shape = (self.height, self.width)
+        self._camera_vectors_0 = get_camera_vectors(
+            lens_model=self.lens_model_0, shape=shape
+        ).astype(np.float32)
+        self._camera_vectors_1 = self.transformation_matrix.rotate(
+            get_camera_vectors(lens_model=self.lens_model_1, shape=shape)
+        ).astype(np.float32)
+        self._baseline = -self.transformation_matrix.translation.astype(np.float32)
+        self._a = (self._camera_vectors_0 * self._camera_vectors_0).sum(axis=-1)
+        self._d = self._camera_vectors_0 @ self._baseline
+
+    @staticmethod
+    def from_stereo_data(
+        stereo_data: StereoData,
+        block_size: NDArray[Shape["[x, y]"], Int32] = np.array(
+            [11, 11], dtype=np.int32
+        ),
+        subpixel_fit: bool = True,
+        cost_function: CostFunction = CostFunction.SUM_OF_ABSOLUTE_DIFFERENCE,
+    ) -> StereoPipeline:
+        return StereoPipeline(
+            lens_model_0=stereo_data.lens_model_0,
+            lens_model_1=stereo_data.lens_model_1,
+            transformation_matrix=stereo_data.transformation_matrix,
+            width=stereo_data.width,
+            height=stereo_data.height,
+            disparity_range=stereo_data.expected_disparity,
+            block_size=block_size,
+            subpixel_fit=subpixel_fit,
+            cost_function=cost_function,
+        )
+
+    def match(
+        self,
+        image_0: NDArray[Shape["H, W, ..."], Float32],
+        image_1: NDArray[Shape["H, W, ..."], Float32],
+    ) -> tuple[NDArray[Shape["H, W"], Float32], NDArray[Shape["H, W"], Float32]]:
+        if image_0.shape[:2] != (self.height, self.width):
+            raise ValueError("Image size does not match the pipeline")
+        block_matching_cost_volume(
+            image_0=image_0,
+            image_1=image_1,
+            disparity_range=self.disparity_range,
+            block_size=self.block_size,
+            cost_function=self.cost_function,
+            output=self._cost_volume,
+        )
+
+        with stage("stereo_pipeline.subpixel_fit"):
+            disparity = mask_disparity_border(
+                disparity=self._cost_volume.best_values(subpixel_fit=self.subpixel_fit),
+                disparities=self._cost_volume.values,
+            )
+        confidence = self._cost_volume.confidence()
+        confidence[np.isnan(disparity)] = np.nan
+        return disparity, confidence
+
+    @instrument("stereo_pipeline.triangulate")
+    def triangulate(
+        self, disparity: NDArray[Shape["H, W"], Float32]
+    ) -> NDArray[Shape["H, W, 3"], Float32]:
+        x_1 = np.arange(self.width, dtype=np.float32)[None, :] - disparity
+        inside = (x_1 >= 0) & (x_1 <= self.width - 1)
+        x_1 = np.where(inside, x_1, 0)
+        left = np.minimum(x_1.astype(np.int32), self.width - 2)
+        fraction = (x_1 - left)[..., None]
+
+        rows = np.arange(self.height)[:, None]
+        v_1 = (1 - fraction) * self._camera_vectors_1[rows, left] + (
+            fraction * self._camera_vectors_1[rows, left + 1]
+        )
+        v_1[~inside] = np.nan
+
+        b = (self._camera_vectors_0 * v_1).sum(axis=-1)
+        c = (v_1 * v_1).sum(axis=-1)
+        e = v_1 @ self._baseline
+
+        t = (b * e - c * self._d) / (self._a * c - b * b)
+        return (self._camera_vectors_0 * t[..., None]).astype(np.float32)
+
+    def process(
+        self,
+        image_0: NDArray[Shape["H, W, ..."], Float32],
+        image_1: NDArray[Shape["H, W, ..."], Float32],
+    ) -> StereoResult:
+        disparity, confidence = self.match(image_0=image_0, image_1=image_1)
+        return StereoResult(
+            disparity=disparity,
+            xyz=self.triangulate(disparity=disparity),
+            confidence=confidence,
+        )
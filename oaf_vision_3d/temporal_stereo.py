@@ -0,0 +1,574 @@
+# %% [markdown]
+# # Temporal Stereo
+#
+# In a video the scene changes little between consecutive frames, so the disparity or
+# depth of most pixels is close to the one in the previous frame. `TemporalBlockMatching`
+# and `TemporalPlaneSweeping` keep the previous result and only search a narrow window
+# of `2 * search_radius + 1` candidates around it for every pixel:
+# - Block matching searches the integer disparities around the rounded previous
+#   disparity
+# - Plane sweeping searches the depths of the full range, in steps of `step_size`
+#   from the start of the range, around the previous depth
+#
+# The image is split into tiles of 64 x 64 pixels, and every tile is matched at the
+# disparities or depths in the window of any of its pixels. The costs are aggregated
+# with half a block around the tile, so the cost of every candidate is the one of the
+# full search, and the windows are fitted like in the full search. A tile with
+# several surfaces matches the windows of all of them.
+#
+# A pixel falls back to the full range, in order of priority, when:
+# 1. The image changed in its block by more than `motion_threshold` on average
+# 2. The best cost is at the edge of the window, so the minimum may be outside it, or
+#    the best cost increased by more than `cost_increase_tolerance` relative to the
+#    previous frame, or to the typical cost of the previous frame if that is larger
+# 3. Its previous result from the window is invalid. Invalid results from a full
+#    range search, like pixels that are not seen by the other camera, are kept
+#
+# The full range search uses the [region of interest](region_of_interest.py) of the
+# matcher on the selected pixels, grown by a block. The matcher searches the bounding
+# box of every connected region, with the halo it needs around it. The pixels with the
+# highest priority are selected first, as long as the area of these windows is at most
+# `max_full_range_fraction` of the image, and the rest keep the result from the
+# window. `full_range_fraction` is the area that was searched over the full range. The
+# first frame, and frames with a different size, are searched over the full range.
+#
+# In steady state the work per frame drops by about the ratio between the size of the
+# full range and the candidates per tile, which grow with the slope of the surfaces.
+
+# %%
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import numpy as np
+from nptyping import Bool, Float32, Int32, NDArray, Shape
+from scipy.ndimage import binary_dilation, uniform_filter1d
+
+from oaf_vision_3d.block_matching import CostFunction as BlockMatchingCostFunction
+from oaf_vision_3d.block_matching import (
+    block_matching,
+    block_matching_cost,
+    block_matching_halo,
+    mask_disparity_border,
+)
+from oaf_vision_3d.cost_precision import aggregate_cost_volume
+from oaf_vision_3d.instrumentation import stage
+from oaf_vision_3d.lens_model import LensModel, LensModelArray
+from oaf_vision_3d.plane_sweeping import CostFunction as PlaneSweepingCostFunction
+from oaf_vision_3d.plane_sweeping import (
+    get_camera_vectors,
+    plane_sweeping,
+    plane_sweeping_cost,
+    reproject_images_at_depth,
+)
+from oaf_vision_3d.poly_2_subvalue_fit import find_subvalue_poly_2
+from oaf_vision_3d.region_of_interest import Tile, region_of_interest_tiles
+from oaf_vision_3d.tiled_processing import make_tiles
+from oaf_vision_3d.transformation_matrix import TransformationMatrix
+
+_WINDOW_TILE_SIZE = np.array([64, 64], dtype=np.int32)
+_MOTION_PRIORITY = 3
+_DEGRADED_PRIORITY = 2
+_INVALID_PRIORITY = 1
+
+
+@dataclass
+class _WindowResult:
+    offset: NDArray[Shape["H, W"], Float32]
+    minimum_cost: NDArray[Shape["H, W"], Float32]
+    at_edge: NDArray[Shape["H, W"], Bool]
+
+
+PlaneCost = Callable[[int, Tile], NDArray[Shape["H, W"], Float32]]
+
+
+def _window_offsets(search_radius: int) -> NDArray[Shape["K"], Float32]:
+    return np.arange(-search_radius, search_radius + 1, dtype=np.float32)
+
+
+def _window_costs(
+    center: NDArray[Shape["H, W"], Int32],
+    search_radius: int,
+    block_size: NDArray[Shape["[x, y]"], Int32],
+    plane_cost: PlaneCost,
+) -> NDArray[Shape["K, H, W"], Float32]:
+    # Every candidate is aggregated at the same value for all pixels of the tile,
+    # and taken at its offset from the center of every pixel it is in the window of
+    height, width = center.shape
+    steps = np.arange(-search_radius, search_radius + 1, dtype=np.int32)
+    costs = np.empty((steps.shape[0], height, width), dtype=np.float32)
+    for tile in make_tiles(
+        height=height, width=width, tile_size=_WINDOW_TILE_SIZE, halo=block_size // 2
+    ):
+        tile_center = center[tile.core]
+        candidates = np.unique(np.unique(tile_center)[:, None] + steps[None, :])
+        tile_costs = np.stack(
+            [plane_cost(int(_candidate), tile) for _candidate in candidates]
+        ).astype(np.float32, copy=False)
+        aggregate_cost_volume(cost_volume=tile_costs, block_size=block_size)
+        costs[(slice(None), *tile.core)] = np.take_along_axis(
+            tile_costs[(slice(None), *tile.core_in_window)],
+            np.searchsorted(candidates, tile_center[None] + steps[:, None, None]),
+            axis=0,
+        )
+    return costs
+
+
+def _motion_mask(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    previous_image: NDArray[Shape["H, W, ..."], Float32],
+    block_size: NDArray[Shape["[x, y]"], Int32],
+    threshold: float,
+) -> NDArray[Shape["H, W"], Bool]:
+    change = np.abs(image - previous_image).reshape(*image.shape[:2], -1).mean(axis=-1)
+    block_change = uniform_filter1d(
+        uniform_filter1d(change, size=int(block_size[1]), axis=0, mode="nearest"),
+        size=int(block_size[0]),
+        axis=1,
+        mode="nearest",
+    )
+    return block_change > threshold
+
+
+def _reduce_window(
+    costs: NDArray[Shape["K, H, W"], Float32],
+    offsets: NDArray[Shape["K"], Float32],
+    subpixel_fit: bool,
+) -> _WindowResult:
+    index = np.argmin(costs, axis=0)
+    return _WindowResult(
+        offset=(
+            find_subvalue_poly_2(values=offsets, function_value=costs)
+            if subpixel_fit
+            else offsets[index]
+        ),
+        minimum_cost=np.take_along_axis(costs, index[None], axis=0)[0],
+        at_edge=(index == 0) | (index == offsets.shape[0] - 1),
+    )
+
+
+def _reference_cost(
+    previous_cost: NDArray[Shape["H, W"], Float32],
+) -> NDArray[Shape["H, W"], Float32]:
+    # Costs close to zero vary a lot relative to themselves, so the reference is at
+    # least the typical cost of the frame
+    has_cost = np.isfinite(previous_cost)
+    if not has_cost.any():
+        return previous_cost
+    return np.fmax(previous_cost, np.median(previous_cost[has_cost]))
+
+
+def _full_range_priority(
+    is_valid: NDArray[Shape["H, W"], Bool],
+    motion: NDArray[Shape["H, W"], Bool],
+    window: _WindowResult,
+    previous_cost: NDArray[Shape["H, W"], Float32],
+    cost_increase_tolerance: float,
+) -> NDArray[Shape["H, W"], Int32]:
+    # Pixels from a full range search have no previous cost, so only the edge counts
+    # for them, and invalid ones are not searched again unless they move
+    degraded = window.at_edge | (
+        window.minimum_cost
+        > (1 + cost_increase_tolerance) * _reference_cost(previous_cost)
+    )
+    priority = np.zeros(is_valid.shape, dtype=np.int32)
+    priority[~is_valid & np.isfinite(previous_cost)] = _INVALID_PRIORITY
+    priority[is_valid & degraded] = _DEGRADED_PRIORITY
+    priority[motion] = _MOTION_PRIORITY
+    return priority
+
+
+def _full_range_region(
+    selected: NDArray[Shape["H, W"], Bool], block_size: NDArray[Shape["[x, y]"], Int32]
+) -> NDArray[Shape["H, W"], Bool]:
+    # Scattered pixels are merged into larger regions, so there are fewer windows.
+    # The block is dilated along the rows and the columns separately
+    return np.asarray(
+        binary_dilation(
+            binary_dilation(
+                selected, structure=np.ones((int(block_size[1]), 1), dtype=bool)
+            ),
+            structure=np.ones((1, int(block_size[0])), dtype=bool),
+        ),
+        dtype=bool,
+    )
+
+
+def _region_area(
+    region: NDArray[Shape["H, W"], Bool], halo: NDArray[Shape["[x, y]"], Int32]
+) -> int:
+    return sum(
+        (rows.stop - rows.start) * (columns.stop - columns.start)
+        for rows, columns in (
+            tile.window
+            for tile in region_of_interest_tiles(
+                region_of_interest=region,
+                height=region.shape[0],
+                width=region.shape[1],
+                halo=halo,
+            )
+        )
+    )
+
+
+def _select_full_range(
+    priority: NDArray[Shape["H, W"], Int32],
+    block_size: NDArray[Shape["[x, y]"], Int32],
+    halo: NDArray[Shape["[x, y]"], Int32],
+    max_fraction: float,
+) -> tuple[NDArray[Shape["H, W"], Bool], NDArray[Shape["H, W"], Bool], int]:
+    # The pixels are taken in order of priority, and the most pixels whose region
+    # fits in the budget are found by bisection
+    candidates = np.flatnonzero(priority > 0)
+    candidates = candidates[np.argsort(-priority.ravel()[candidates], kind="stable")]
+    budget = max_fraction * priority.size
+
+    def _selection(
+        count: int,
+    ) -> tuple[NDArray[Shape["H, W"], Bool], NDArray[Shape["H, W"], Bool], int]:
+        selected = np.zeros(priority.size, dtype=bool)
+        selected[candidates[:count]] = True
+        selected = selected.reshape(priority.shape)
+        region = _full_range_region(selected, block_size=block_size)
+        return selected, region, _region_area(region, halo=halo)
+
+    selection = _selection(candidates.shape[0])
+    if selection[2] <= budget:
+        return selection
+
+    selection = _selection(0)
+    lower, upper = 0, candidates.shape[0]
+    while upper - lower > 1:
+        middle = (lower + upper) // 2
+        middle_selection = _selection(middle)
+        if middle_selection[2] <= budget:
+            lower, selection = middle, middle_selection
+        else:
+            upper = middle
+    return selection
+
+
+@dataclass
+class TemporalBlockMatching:
+    disparity_range: NDArray[Shape["2"], Float32]
+    block_size: NDArray[Shape["[x, y]"], Int32] = field(
+        default_factory=lambda: np.array([11, 11], dtype=np.int32)
+    )
+    subpixel_fit: bool = True
+    cost_function: BlockMatchingCostFunction = (
+        BlockMatchingCostFunction.SUM_OF_ABSOLUTE_DIFFERENCE
+    )
+    search_radius: int = 2
+    motion_threshold: float = 0.05
+    cost_increase_tolerance: float = 1.0
+    max_full_range_fraction: float = 0.25
+    full_range_fraction: float = field(init=False, default=1.0)
+    _previous_image: Optional[NDArray[Shape["H, W, ..."], Float32]] = field(
+        init=False, default=None, repr=False
+    )
+    _previous_disparity: NDArray[Shape["H, W"], Float32] = field(init=False, repr=False)
+    _previous_cost: NDArray[Shape["H, W"], Float32] = field(init=False, repr=False)
+
+    def reset(self) -> None:
+        self._previous_image = None
+        self.full_range_fraction = 1.0
+
+    def _disparities(self) -> NDArray[Shape["D"], Float32]:
+        return np.arange(
+            self.disparity_range[0], self.disparity_range[1], dtype=np.int32
+        ).astype(np.float32)
+
+    def _plane_cost(
+        self,
+        image_0: NDArray[Shape["H, W, ..."], Float32],
+        image_1: NDArray[Shape["H, W, ..."], Float32],
+        disparity: int,
+        tile: Tile,
+    ) -> NDArray[Shape["H, W"], Float32]:
+        # The columns wrap around like np.roll in block_matching
+        rows, columns = tile.window
+        return block_matching_cost(
+            image_0[tile.window],
+            np.take(
+                image_1[rows],
+                np.mod(
+                    np.arange(columns.start, columns.stop) - disparity, image_1.shape[1]
+                ),
+                axis=1,
+            ),
+            self.cost_function,
+        )
+
+    def _full_range(
+        self,
+        image_0: NDArray[Shape["H, W, ..."], Float32],
+        image_1: NDArray[Shape["H, W, ..."], Float32],
+        region: Optional[NDArray[Shape["H, W"], Bool]] = None,
+    ) -> NDArray[Shape["H, W"], Float32]:
+        return block_matching(
+            image_0=image_0,
+            image_1=image_1,
+            disparity_range=self.disparity_range,
+            block_size=self.block_size,
+            subpixel_fit=self.subpixel_fit,
+            cost_function=self.cost_function,
+            region_of_interest=region,
+        )
+
+    def process(
+        self,
+        image_0: NDArray[Shape["H, W, ..."], Float32],
+        image_1: NDArray[Shape["H, W, ..."], Float32],
+    ) -> NDArray[Shape["H, W"], Float32]:
+        if self._previous_image is None or self._previous_image.shape != image_0.shape:
+            with stage("temporal_stereo.full_range", pixels=image_0[..., 0].size):
+                disparity = self._full_range(image_0=image_0, image_1=image_1)
+            self._update(image_0, disparity, np.full(disparity.shape, np.nan))
+            self.full_range_fraction = 1.0
+            return disparity
+
+        disparities = self._disparities()
+        offsets = _window_offsets(self.search_radius)
+        is_valid = np.isfinite(self._previous_disparity)
+        center = np.round(np.where(is_valid, self._previous_disparity, 0)).astype(
+            np.int32
+        )
+        with stage("temporal_stereo.window", candidates=offsets.shape[0]):
+            window = _reduce_window(
+                costs=_window_costs(
+                    center=center,
+                    search_radius=self.search_radius,
+                    block_size=self.block_size,
+                    plane_cost=lambda disparity, tile: self._plane_cost(
+                        image_0=image_0, image_1=image_1, disparity=disparity, tile=tile
+                    ),
+                ),
+                offsets=offsets,
+                subpixel_fit=self.subpixel_fit,
+            )
+            disparity = np.where(is_valid, center + window.offset, np.nan).astype(
+                np.float32
+            )
+            disparity[disparity >= disparities.max()] = np.nan
+            disparity[disparity <= disparities.min()] = np.nan
+            mask_disparity_border(disparity=disparity, disparities=disparities)
+
+        priority = _full_range_priority(
+            is_valid=is_valid,
+            motion=_motion_mask(
+                image=image_0,
+                previous_image=self._previous_image,
+                block_size=self.block_size,
+                threshold=self.motion_threshold,
+            ),
+            window=window,
+            previous_cost=self._previous_cost,
+            cost_increase_tolerance=self.cost_increase_tolerance,
+        )
+        # The border columns are never valid, so they are never searched again
+        border = int(np.abs(disparities).max())
+        priority[:, :border] = 0
+        priority[:, -border:] = 0
+        selected, region, area = _select_full_range(
+            priority=priority,
+            block_size=self.block_size,
+            halo=block_matching_halo(
+                disparity_range=self.disparity_range, block_size=self.block_size
+            ),
+            max_fraction=self.max_full_range_fraction,
+        )
+
+        cost = window.minimum_cost
+        if selected.any():
+            with stage("temporal_stereo.full_range", pixels=area):
+                full_range_disparity = self._full_range(
+                    image_0=image_0, image_1=image_1, region=region
+                )
+            disparity[selected] = full_range_disparity[selected]
+            cost[selected] = np.nan
+
+        self._update(image_0, disparity, cost)
+        self.full_range_fraction = area / disparity.size
+        return disparity
+
+    def _update(
+        self,
+        image: NDArray[Shape["H, W, ..."], Float32],
+        disparity: NDArray[Shape["H, W"], Float32],
+        cost: NDArray[Shape["H, W"], Float32],
+    ) -> None:
+        self._previous_image = np.array(image, dtype=np.float32)
+        self._previous_disparity = disparity.copy()
+        self._previous_cost = cost.astype(np.float32)
+
+
+@dataclass
+class TemporalPlaneSweeping:
+    lens_model: LensModel
+    secondary_lens_models: list[LensModel]
+    secondary_transformation_matrices: list[TransformationMatrix]
+    depth_range: NDArray[Shape["2"], Float32]
+    step_size: float
+    block_size: NDArray[Shape["[x, y]"], Int32] = field(
+        default_factory=lambda: np.array([11, 11], dtype=np.int32)
+    )
+    subpixel_fit: bool = True
+    cost_function: PlaneSweepingCostFunction = (
+        PlaneSweepingCostFunction.SUM_OF_ABSOLUTE_DIFFERENCE
+    )
+    search_radius: int = 2
+    motion_threshold: float = 0.05
+    cost_increase_tolerance: float = 1.0
+    max_full_range_fraction: float = 0.25
+    full_range_fraction: float = field(init=False, default=1.0)
+    _previous_image: Optional[NDArray[Shape["H, W, ..."], Float32]] = field(
+        init=False, default=None, repr=False
+    )
+    _previous_depth: NDArray[Shape["H, W"], Float32] = field(init=False, repr=False)
+    _previous_cost: NDArray[Shape["H, W"], Float32] = field(init=False, repr=False)
+    _camera_vectors: NDArray[Shape["H, W, 3"], Float32] = field(init=False, repr=False)
+    _secondary_lens_model_array: LensModelArray = field(init=False, repr=False)
+    _inverse_transformation_matrices: list[TransformationMatrix] = field(
+        init=False, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        self._secondary_lens_model_array = LensModelArray.from_lens_models(
+            self.secondary_lens_models
+        )
+        self._inverse_transformation_matrices = [
+            _transformation_matrix.inverse()
+            for _transformation_matrix in self.secondary_transformation_matrices
+        ]
+
+    def reset(self) -> None:
+        self._previous_image = None
+        self.full_range_fraction = 1.0
+
+    def _plane_cost(
+        self,
+        image: NDArray[Shape["H, W, ..."], Float32],
+        secondary_images: list[NDArray[Shape["H, W, ..."], Float32]],
+        step: int,
+        tile: Tile,
+    ) -> NDArray[Shape["H, W"], Float32]:
+        return plane_sweeping_cost(
+            image_0=image[tile.window],
+            images=reproject_images_at_depth(
+                images=secondary_images,
+                camera_vectors=self._camera_vectors[tile.window],
+                depth=float(self.depth_range[0] + step * self.step_size),
+                lens_model_array=self._secondary_lens_model_array,
+                inverse_transformation_matrices=self._inverse_transformation_matrices,
+            ),
+            cost_function=self.cost_function,
+        )
+
+    def _full_range(
+        self,
+        image: NDArray[Shape["H, W, ..."], Float32],
+        secondary_images: list[NDArray[Shape["H, W, ..."], Float32]],
+        region: Optional[NDArray[Shape["H, W"], Bool]] = None,
+    ) -> NDArray[Shape["H, W"], Float32]:
+        return plane_sweeping(
+            image=image,
+            lens_model=self.lens_model,
+            secondary_images=secondary_images,
+            secondary_lens_models=self.secondary_lens_models,
+            secondary_transformation_matrices=self.secondary_transformation_matrices,
+            depth_range=self.depth_range,
+            step_size=self.step_size,
+            block_size=self.block_size,
+            subpixel_fit=self.subpixel_fit,
+            cost_function=self.cost_function,
+            region_of_interest=region,
+        )[..., 2]
+
+    def process(
+        self,
+        image: NDArray[Shape["H, W, ..."], Float32],
+        secondary_images: list[NDArray[Shape["H, W, ..."], Float32]],
+    ) -> NDArray[Shape["H, W, 3"], Float32]:
+        if self._previous_image is None or self._previous_image.shape != image.shape:
+            self._camera_vectors = get_camera_vectors(
+                lens_model=self.lens_model, shape=image.shape
+            )
+            with stage("temporal_stereo.full_range", pixels=image[..., 0].size):
+                depth = self._full_range(image=image, secondary_images=secondary_images)
+            self._update(image, depth, np.full(depth.shape, np.nan))
+            self.full_range_fraction = 1.0
+            return self._camera_vectors * depth[..., None]
+
+        offsets = _window_offsets(self.search_radius)
+        is_valid = np.isfinite(self._previous_depth)
+        # The windows are on the steps of the full range
+        center = np.round(
+            (
+                np.where(is_valid, self._previous_depth, self.depth_range[0])
+                - self.depth_range[0]
+            )
+            / self.step_size
+        ).astype(np.int32)
+        with stage("temporal_stereo.window", candidates=offsets.shape[0]):
+            window = _reduce_window(
+                costs=_window_costs(
+                    center=center,
+                    search_radius=self.search_radius,
+                    block_size=self.block_size,
+                    plane_cost=lambda step, tile: self._plane_cost(
+                        image=image,
+                        secondary_images=secondary_images,
+                        step=step,
+                        tile=tile,
+                    ),
+                ),
+                offsets=offsets,
+                subpixel_fit=self.subpixel_fit,
+            )
+            depth = np.where(
+                is_valid,
+                self.depth_range[0] + (center + window.offset) * self.step_size,
+                np.nan,
+            ).astype(np.float32)
+            depth[depth >= self.depth_range[1]] = np.nan
+            depth[depth <= self.depth_range[0]] = np.nan
+
+        selected, region, area = _select_full_range(
+            priority=_full_range_priority(
+                is_valid=is_valid,
+                motion=_motion_mask(
+                    image=image,
+                    previous_image=self._previous_image,
+                    block_size=self.block_size,
+                    threshold=self.motion_threshold,
+                ),
+                window=window,
+                previous_cost=self._previous_cost,
+                cost_increase_tolerance=self.cost_increase_tolerance,
+            ),
+            block_size=self.block_size,
+            halo=self.block_size // 2,
+            max_fraction=self.max_full_range_fraction,
+        )
+
+        cost = window.minimum_cost
+        if selected.any():
+            with stage("temporal_stereo.full_range", pixels=area):
+                full_range_depth = self._full_range(
+                    image=image, secondary_images=secondary_images, region=region
+                )
+            depth[selected] = full_range_depth[selected]
+            cost[selected] = np.nan
+
+        self._update(image, depth, cost)
+        self.full_range_fraction = area / depth.size
+        return self._camera_vectors * depth[..., None]
+
+    def _update(
+        self,
+        image: NDArray[Shape["H, W, ..."], Float32],
+        depth: NDArray[Shape["H, W"], Float32],
+        cost: NDArray[Shape["H, W"], Float32],
+    ) -> None:
+        self._previous_image = np.array(image, dtype=np.float32)
+        self._previous_depth = depth.copy()
+        self._previous_cost = cost.astype(np.float32)
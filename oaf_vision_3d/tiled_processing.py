@@ -0,0 +1,251 @@
+# %% [markdown]
+# # Tiled Processing
+#
+# `block_matching` and `plane_sweeping` hold the full images and the full cost volume
+# in memory, which does not fit for very large images. The functions in this module
+# split the reference image into tiles, run the existing functions on every tile and
+# write the results into one output array. Every tile is extended with a halo, so the
+# results are seamless:
+# - Block matching needs half a block for the aggregation, plus the largest disparity
+#   horizontally, as the second image is shifted by up to that many pixels and the
+#   function sets that many columns at the tile border to NaN
+# - Plane sweeping needs half a block for the aggregation. The principal point of the
+#   reference camera is moved to the tile, and every secondary image is cropped to the
+#   bounding box of the projected tile border at all depths, with its principal point
+#   moved accordingly.
+#
+# The tiles are the same as for a [region of interest](region_of_interest.py), they
+# just cover the full image.
+#
+# Every tile can search its own range, with a disparity or depth range per tile in a
+# grid of `tile_grid_shape`, for instance from the
+# [range estimation](range_estimation.py). The halo of block matching still follows
+# `disparity_range`, which must cover the ranges of all tiles. `tile_range_map` turns
+# the ranges per tile into a map per pixel, for the `disparity_bounds` of
+# `block_matching`.
+#
+# The inputs and the output can be `np.memmap` arrays, for instance from
+# `np.lib.format.open_memmap`. Only the tile being processed is read into memory, so
+# the peak memory is bounded by the tile size and not the image size. Tiles can be
+# processed in parallel threads with `number_of_workers`.
+#
+# For block matching the results are equal to processing the full image, except for
+# the pixels within half a block of the invalid image border, where the full image
+# result depends on pixels wrapped around from the other side of the image.
+
+# %%
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+import numpy as np
+from nptyping import Float32, Int32, NDArray, Shape
+
+from oaf_vision_3d.block_matching import CostFunction as BlockMatchingCostFunction
+from oaf_vision_3d.block_matching import block_matching_halo, block_matching_tile
+from oaf_vision_3d.cost_precision import CostPrecision
+from oaf_vision_3d.lens_model import LensModel
+from oaf_vision_3d.plane_sweeping import CostFunction as PlaneSweepingCostFunction
+from oaf_vision_3d.plane_sweeping import plane_sweeping_tile
+from oaf_vision_3d.region_of_interest import Tile, tile_with_halo
+from oaf_vision_3d.transformation_matrix import TransformationMatrix
+
+
+def tile_grid_shape(
+    height: int, width: int, tile_size: NDArray[Shape["[x, y]"], Int32]
+) -> tuple[int, int]:
+    return -(-height // int(tile_size[1])), -(-width // int(tile_size[0]))
+
+
+def tile_range_map(
+    ranges: NDArray[Shape["R, C, 2"], Float32],
+    height: int,
+    width: int,
+    tile_size: NDArray[Shape["[x, y]"], Int32],
+) -> NDArray[Shape["H, W, 2"], Float32]:
+    return np.repeat(
+        np.repeat(ranges, int(tile_size[1]), axis=0)[:height],
+        int(tile_size[0]),
+        axis=1,
+    )[:, :width]
+
+
+def make_tiles(
+    height: int,
+    width: int,
+    tile_size: NDArray[Shape["[x, y]"], Int32],
+    halo: NDArray[Shape["[x, y]"], Int32],
+) -> list[Tile]:
+    return [
+        tile_with_halo(
+            core=(
+                slice(row, min(row + int(tile_size[1]), height)),
+                slice(column, min(column + int(tile_size[0]), width)),
+            ),
+            halo=halo,
+            height=height,
+            width=width,
+        )
+        for row in range(0, height, int(tile_size[1]))
+        for column in range(0, width, int(tile_size[0]))
+    ]
+
+
+def _process_tiles(
+    function: Callable[[Tile], None], tiles: list[Tile], number_of_workers: int
+) -> None:
+    if number_of_workers > 1 and len(tiles) > 1:
+        with ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+            list(executor.map(function, tiles))
+    else:
+        for tile in tiles:
+            function(tile)
+
+
+def _tile_range(
+    tile: Tile,
+    tile_size: NDArray[Shape["[x, y]"], Int32],
+    ranges: Optional[NDArray[Shape["R, C, 2"], Float32]],
+    default_range: NDArray[Shape["2"], Float32],
+) -> NDArray[Shape["2"], Float32]:
+    if ranges is None:
+        return default_range
+    return ranges[
+        tile.core[0].start // int(tile_size[1]), tile.core[1].start // int(tile_size[0])
+    ]
+
+
+def _check_tile_ranges(
+    ranges: Optional[NDArray[Shape["R, C, 2"], Float32]],
+    height: int,
+    width: int,
+    tile_size: NDArray[Shape["[x, y]"], Int32],
+) -> None:
+    grid_shape = tile_grid_shape(height=height, width=width, tile_size=tile_size)
+    if ranges is not None and ranges.shape != (*grid_shape, 2):
+        raise ValueError(f"Tile ranges must have the shape {(*grid_shape, 2)}")
+
+
+def _prepare_output(
+    output: Optional[NDArray], shape: tuple[int, ...]
+) -> NDArray[Shape["H, W, ..."], Float32]:
+    if output is None:
+        return np.empty(shape, dtype=np.float32)
+    if output.shape != shape:
+        raise ValueError(f"Output must have the shape {shape}")
+    return output
+
+
+def tiled_block_matching(
+    image_0: NDArray[Shape["H, W, ..."], Float32],
+    image_1: NDArray[Shape["H, W, ..."], Float32],
+    disparity_range: NDArray[Shape["2"], Float32],
+    block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
+    subpixel_fit: bool = True,
+    cost_function: BlockMatchingCostFunction = (
+        BlockMatchingCostFunction.SUM_OF_ABSOLUTE_DIFFERENCE
+    ),
+    tile_size: NDArray[Shape["[x, y]"], Int32] = np.array([1024, 512], dtype=np.int32),
+    number_of_workers: int = 1,
+    output: Optional[NDArray[Shape["H, W"], Float32]] = None,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+    tile_disparity_ranges: Optional[NDArray[Shape["R, C, 2"], Float32]] = None,
+) -> NDArray[Shape["H, W"], Float32]:
+    disparity = _prepare_output(output=output, shape=image_0.shape[:2])
+    _check_tile_ranges(
+        ranges=tile_disparity_ranges,
+        height=image_0.shape[0],
+        width=image_0.shape[1],
+        tile_size=tile_size,
+    )
+
+    def _process(tile: Tile) -> None:
+        disparity[tile.core] = block_matching_tile(
+            tile=tile,
+            image_0=image_0,
+            image_1=image_1,
+            disparity_range=_tile_range(
+                tile=tile,
+                tile_size=tile_size,
+                ranges=tile_disparity_ranges,
+                default_range=disparity_range,
+            ),
+            block_size=block_size,
+            subpixel_fit=subpixel_fit,
+            cost_function=cost_function,
+            precision=precision,
+        )
+
+    _process_tiles(
+        function=_process,
+        tiles=make_tiles(
+            height=image_0.shape[0],
+            width=image_0.shape[1],
+            tile_size=tile_size,
+            halo=block_matching_halo(
+                disparity_range=disparity_range, block_size=block_size
+            ),
+        ),
+        number_of_workers=number_of_workers,
+    )
+    return disparity
+
+
+def tiled_plane_sweeping(
+    image: NDArray[Shape["H, W, ..."], Float32],
+    lens_model: LensModel,
+    secondary_images: list[NDArray[Shape["H, W, ..."], Float32]],
+    secondary_lens_models: list[LensModel],
+    secondary_transformation_matrices: list[TransformationMatrix],
+    depth_range: NDArray[Shape["2"], Float32],
+    step_size: float,
+    block_size: NDArray[Shape["[x, y]"], Int32] = np.array([11, 11], dtype=np.int32),
+    subpixel_fit: bool = True,
+    cost_function: PlaneSweepingCostFunction = (
+        PlaneSweepingCostFunction.SUM_OF_ABSOLUTE_DIFFERENCE
+    ),
+    tile_size: NDArray[Shape["[x, y]"], Int32] = np.array([512, 512], dtype=np.int32),
+    number_of_workers: int = 1,
+    output: Optional[NDArray[Shape["H, W, 3"], Float32]] = None,
+    precision: CostPrecision = CostPrecision.FLOAT32,
+    tile_depth_ranges: Optional[NDArray[Shape["R, C, 2"], Float32]] = None,
+) -> NDArray[Shape["H, W, 3"], Float32]:
+    xyz = _prepare_output(output=output, shape=(*image.shape[:2], 3))
+    _check_tile_ranges(
+        ranges=tile_depth_ranges,
+        height=image.shape[0],
+        width=image.shape[1],
+        tile_size=tile_size,
+    )
+
+    def _process(tile: Tile) -> None:
+        xyz[tile.core] = plane_sweeping_tile(
+            tile=tile,
+            image=image,
+            lens_model=lens_model,
+            secondary_images=secondary_images,
+            secondary_lens_models=secondary_lens_models,
+            secondary_transformation_matrices=secondary_transformation_matrices,
+            depth_range=_tile_range(
+                tile=tile,
+                tile_size=tile_size,
+                ranges=tile_depth_ranges,
+                default_range=depth_range,
+            ),
+            step_size=step_size,
+            block_size=block_size,
+            subpixel_fit=subpixel_fit,
+            cost_function=cost_function,
+            precision=precision,
+        )
+
+    _process_tiles(
+        function=_process,
+        tiles=make_tiles(
+            height=image.shape[0],
+            width=image.shape[1],
+            tile_size=tile_size,
+            halo=np.array([block_size[0] // 2, block_size[1] // 2], dtype=np.int32),
+        ),
+        number_of_workers=number_of_workers,
+    )
+    return xyz
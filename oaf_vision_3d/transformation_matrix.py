@@ -16,6 +16,9 @@
 #   transformations
 # - Convert to and from a dictionary
 # - Write to and read from a JSON file
+#
+# Importing `scipy.spatial` takes longer than the rest of the package together, so it
+# is imported when the first transformation is created and not with the module.
 
 # %%
 from __future__ import annotations
@@ -23,16 +26,25 @@ from __future__ import annotations
 import json
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import overload
+from typing import TYPE_CHECKING, overload
 
 import numpy as np
 from nptyping import Float32, NDArray, Shape
-from scipy.spatial.transform import Rotation
+
+if TYPE_CHECKING:
+    from scipy.spatial.transform import Rotation
+
+
+def _rotation() -> type[Rotation]:
+    # pylint: disable=import-outside-toplevel
+    from scipy.spatial.transform import Rotation
+
+    return Rotation
 
 
 @dataclass
 class TransformationMatrix:
-    rotation: Rotation = Rotation.identity()
+    rotation: Rotation = field(default_factory=lambda: _rotation().identity())
     translation: NDArray[Shape["3"], Float32] = field(
         default_factory=lambda: np.array([0, 0, 0], np.float32)
     )
@@ -46,7 +58,7 @@ class TransformationMatrix:
     @staticmethod
     def from_matrix(matrix: NDArray[Shape["4, 4"], Float32]) -> TransformationMatrix:
         return TransformationMatrix(
-            rotation=Rotation.from_matrix(matrix[:3, :3]), translation=matrix[:3, 3]
+            rotation=_rotation().from_matrix(matrix[:3, :3]), translation=matrix[:3, 3]
         )
 
     @staticmethod
@@ -54,7 +66,7 @@ class TransformationMatrix:
         rvec: NDArray[Shape["3"], Float32], tvec: NDArray[Shape["3"], Float32]
     ) -> TransformationMatrix:
         return TransformationMatrix(
-            rotation=Rotation.from_rotvec(rvec), translation=tvec
+            rotation=_rotation().from_rotvec(rvec), translation=tvec
         )
 
     def inverse(self) -> TransformationMatrix:
@@ -103,7 +115,9 @@ class TransformationMatrix:
     @staticmethod
     def from_dict(data: dict) -> TransformationMatrix:
         return TransformationMatrix(
-            rotation=Rotation.from_quat(np.array(data["rotation"], dtype=np.float32)),
+            rotation=_rotation().from_quat(
+                np.array(data["rotation"], dtype=np.float32)
+            ),
             translation=np.array(data["translation"], dtype=np.float32),
         )
 
@@ -11,10 +11,12 @@
 import numpy as np
 from nptyping import Float32, NDArray, Shape
 
+from oaf_vision_3d.instrumentation import instrument, stage
 from oaf_vision_3d.lens_model import LensModel
 from oaf_vision_3d.transformation_matrix import TransformationMatrix
 
 
+@instrument("triangulation.triangulate_points")
 def triangulate_points(
     undistorted_normalized_pixels_0: NDArray[Shape["H, W, 2"], Float32],
     undistorted_normalized_pixels_1: NDArray[Shape["H, W, 2"], Float32],
@@ -51,12 +53,13 @@ def triangulate_disparity(
     pixels_0 = np.stack([x, y], axis=-1)
     pixels_1 = np.stack([x - disparity, y], axis=-1)
 
-    undistortied_normalized_pixels_0 = lens_model_0.undistort_pixels(
-        normalized_pixels=lens_model_0.normalize_pixels(pixels=pixels_0)
-    )
-    undistortied_normalized_pixels_1 = lens_model_1.undistort_pixels(
-        normalized_pixels=lens_model_1.normalize_pixels(pixels=pixels_1)
-    )
+    with stage("triangulation.undistortion", pixels=2 * disparity.size):
+        undistortied_normalized_pixels_0 = lens_model_0.undistort_pixels(
+            normalized_pixels=lens_model_0.normalize_pixels(pixels=pixels_0)
+        )
+        undistortied_normalized_pixels_1 = lens_model_1.undistort_pixels(
+            normalized_pixels=lens_model_1.normalize_pixels(pixels=pixels_1)
+        )
 
     return triangulate_points(
         undistorted_normalized_pixels_0=undistortied_normalized_pixels_0,
@@ -0,0 +1,265 @@
+# %% [markdown]
+# # TSDF Fusion
+#
+# A single stereo frame gives a noisy point cloud. With several frames of the same
+# scene and known poses, the frames can be fused into one truncated signed distance
+# function (TSDF) volume, where every voxel holds a weighted average of its signed
+# distance to the observed surface, truncated to `[-1, 1]` outside of
+# `truncation_distance`.
+#
+# The volume is sparse. Voxels are grouped in blocks of `block_size^3` voxels, and a
+# block is only allocated when an observed point is within `truncation_distance` of it.
+# The blocks are found through a sorted array of `int64` block keys, so memory scales
+# with the observed surface and not with the bounding box of the scene.
+#
+# Every frame is integrated in one batch:
+# 1. Transform the points from `triangulate_disparity` or `plane_sweeping` to world
+#    coordinates and allocate the blocks around them
+# 2. Project the centers of all voxels in these blocks into the frame with
+#    `project_points`
+# 3. Update the running average of every voxel in front of, or just behind, the
+#    observed depth
+#
+# The fused point cloud is extracted from the zero crossings between neighbouring
+# voxels, interpolated linearly along the voxel grid.
+
+# %%
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+from nptyping import Float32, Int64, NDArray, Shape
+
+from oaf_vision_3d.lens_model import LensModel
+from oaf_vision_3d.project_points import project_points
+from oaf_vision_3d.transformation_matrix import TransformationMatrix
+
+_KEY_BITS = 21
+_KEY_OFFSET = 1 << (_KEY_BITS - 1)
+
+
+def _block_keys(
+    block_coordinates: NDArray[Shape["N, 3"], Int64],
+) -> NDArray[Shape["N"], Int64]:
+    shifted = block_coordinates + _KEY_OFFSET
+    if shifted.size and (shifted.min() < 0 or shifted.max() >= 1 << _KEY_BITS):
+        raise ValueError("Block coordinates are out of range for int64 keys")
+    return (
+        (shifted[:, 0] << 2 * _KEY_BITS) | (shifted[:, 1] << _KEY_BITS) | shifted[:, 2]
+    )
+
+
+def _block_coordinates_from_keys(
+    keys: NDArray[Shape["N"], Int64],
+) -> NDArray[Shape["N, 3"], Int64]:
+    mask = (1 << _KEY_BITS) - 1
+    return (
+        np.stack(
+            [keys >> 2 * _KEY_BITS, (keys >> _KEY_BITS) & mask, keys & mask], axis=-1
+        )
+        - _KEY_OFFSET
+    )
+
+
+@dataclass
+class TSDFVolume:
+    voxel_size: float
+    truncation_distance: float
+    block_size: int = 8
+    max_weight: float = 64.0
+    _block_coordinates: NDArray[Shape["N, 3"], Int64] = field(init=False, repr=False)
+    _sorted_keys: NDArray[Shape["N"], Int64] = field(init=False, repr=False)
+    _sorted_order: NDArray[Shape["N"], Int64] = field(init=False, repr=False)
+    _tsdf: NDArray[Shape["N, B, B, B"], Float32] = field(init=False, repr=False)
+    _weight: NDArray[Shape["N, B, B, B"], Float32] = field(init=False, repr=False)
+    _local_coordinates: NDArray[Shape["V, 3"], Int64] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.voxel_size <= 0 or self.truncation_distance <= 0:
+            raise ValueError("Voxel size and truncation distance must be positive")
+        size = self.block_size
+        self._block_coordinates = np.empty((0, 3), dtype=np.int64)
+        self._sorted_keys = np.empty(0, dtype=np.int64)
+        self._sorted_order = np.empty(0, dtype=np.int64)
+        self._tsdf = np.empty((0, size, size, size), dtype=np.float32)
+        self._weight = np.empty((0, size, size, size), dtype=np.float32)
+        self._local_coordinates = np.indices((size, size, size)).reshape(3, -1).T
+
+    @property
+    def number_of_blocks(self) -> int:
+        return self._block_coordinates.shape[0]
+
+    @property
+    def block_extent(self) -> float:
+        return self.voxel_size * self.block_size
+
+    def _find_blocks(
+        self, keys: NDArray[Shape["N"], Int64]
+    ) -> NDArray[Shape["N"], Int64]:
+        if self._sorted_keys.shape[0] == 0:
+            return np.full(keys.shape, -1, dtype=np.int64)
+        position = np.searchsorted(self._sorted_keys, keys)
+        position = np.minimum(position, self._sorted_keys.shape[0] - 1)
+        found = self._sorted_keys[position] == keys
+        return np.where(found, self._sorted_order[position], -1)
+
+    def _allocate_blocks(
+        self, points: NDArray[Shape["N, 3"], Float32]
+    ) -> NDArray[Shape["M"], Int64]:
+        keys = np.unique(
+            _block_keys(np.floor(points / self.block_extent).astype(np.int64))
+        )
+
+        # Dilate in block space so every voxel within the truncation distance exists.
+        # The keys are linear in the coordinates, so offsets can be added to the keys.
+        radius = int(np.ceil(self.truncation_distance / self.block_extent))
+        offsets = np.indices((2 * radius + 1,) * 3).reshape(3, -1).T - radius
+        offset_keys = _block_keys(offsets) - _block_keys(np.zeros((1, 3), np.int64))
+        keys = np.unique((keys[:, None] + offset_keys[None, :]).reshape(-1))
+        block_coordinates = _block_coordinates_from_keys(keys)
+
+        indices = self._find_blocks(keys)
+        new = indices < 0
+        number_of_new_blocks = int(new.sum())
+        if number_of_new_blocks:
+            size = self.block_size
+            indices[new] = self.number_of_blocks + np.arange(number_of_new_blocks)
+            self._block_coordinates = np.concatenate(
+                [self._block_coordinates, block_coordinates[new]]
+            )
+            self._tsdf = np.concatenate(
+                [
+                    self._tsdf,
+                    np.ones((number_of_new_blocks, size, size, size), np.float32),
+                ]
+            )
+            self._weight = np.concatenate(
+                [
+                    self._weight,
+                    np.zeros((number_of_new_blocks, size, size, size), np.float32),
+                ]
+            )
+            all_keys = _block_keys(self._block_coordinates)
+            self._sorted_order = np.argsort(all_keys)
+            self._sorted_keys = all_keys[self._sorted_order]
+        return indices
+
+    def _voxel_coordinates(
+        self, block_indices: NDArray[Shape["M"], Int64]
+    ) -> NDArray[Shape["M, V, 3"], Int64]:
+        return (
+            self._block_coordinates[block_indices, None, :] * self.block_size
+            + self._local_coordinates[None, :, :]
+        )
+
+    def integrate(
+        self,
+        xyz: NDArray[Shape["H, W, 3"], Float32],
+        lens_model: LensModel,
+        transformation_matrix: Optional[TransformationMatrix] = None,
+    ) -> None:
+        if transformation_matrix is None:
+            transformation_matrix = TransformationMatrix()
+        depth = xyz[..., 2]
+        valid = np.isfinite(xyz).all(axis=-1) & (depth > 0)
+        if not valid.any():
+            return
+
+        world_points = (transformation_matrix @ xyz[valid][None, ...])[0]
+        block_indices = self._allocate_blocks(points=world_points)
+
+        voxel_centers = (
+            ((self._voxel_coordinates(block_indices) + 0.5) * self.voxel_size)
+            .reshape(-1, 3)
+            .astype(np.float32)
+        )
+        world_to_camera = transformation_matrix.inverse()
+        voxel_depth = (
+            voxel_centers @ world_to_camera.rotation.as_matrix()[2]
+            + world_to_camera.translation[2]
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pixels = np.round(
+                project_points(
+                    points=voxel_centers,
+                    lens_model=lens_model,
+                    transformation_matrix=world_to_camera,
+                )
+            )
+
+        height, width = depth.shape
+        in_view = (
+            (voxel_depth > 0)
+            & (pixels[:, 0] >= 0)
+            & (pixels[:, 0] < width)
+            & (pixels[:, 1] >= 0)
+            & (pixels[:, 1] < height)
+        )
+        voxels = np.flatnonzero(in_view)
+        observed_depth = np.where(valid, depth, np.nan)[
+            pixels[voxels, 1].astype(np.int64), pixels[voxels, 0].astype(np.int64)
+        ]
+        signed_distance = observed_depth - voxel_depth[voxels]
+        # Voxels far behind the surface are occluded and carry no information
+        update = np.isfinite(signed_distance) & (
+            signed_distance >= -self.truncation_distance
+        )
+        voxels = voxels[update]
+        tsdf = np.minimum(signed_distance[update] / self.truncation_distance, 1.0)
+
+        size = self.block_size**3
+        flat_tsdf = self._tsdf.reshape(-1)
+        flat_weight = self._weight.reshape(-1)
+        flat_indices = block_indices[voxels // size] * size + voxels % size
+        weight = flat_weight[flat_indices]
+        flat_tsdf[flat_indices] = (flat_tsdf[flat_indices] * weight + tsdf) / (
+            weight + 1
+        )
+        flat_weight[flat_indices] = np.minimum(weight + 1, self.max_weight)
+
+    def extract_point_cloud(
+        self, minimum_weight: float = 1.0
+    ) -> NDArray[Shape["N, 3"], Float32]:
+        size = self.block_size
+        tsdf = self._tsdf.reshape(self.number_of_blocks, -1)
+        observed = self._weight.reshape(self.number_of_blocks, -1) >= minimum_weight
+        voxel_coordinates = self._voxel_coordinates(np.arange(self.number_of_blocks))
+
+        points = []
+        for axis in range(3):
+            step = np.zeros(3, dtype=np.int64)
+            step[axis] = 1
+            neighbour_blocks = self._find_blocks(
+                _block_keys(self._block_coordinates + step)
+            )
+
+            # The neighbour is in the same block, except on the last layer of voxels
+            local = self._local_coordinates[:, axis]
+            stride = size ** (2 - axis)
+            inside = local < size - 1
+            neighbour_block = np.where(
+                inside[None, :], np.arange(self.number_of_blocks)[:, None], -1
+            )
+            neighbour_block[:, ~inside] = neighbour_blocks[:, None]
+            neighbour_voxel = np.where(
+                inside, np.arange(size**3) + stride, np.arange(size**3) - stride * local
+            )
+
+            has_neighbour = observed & (neighbour_block >= 0)
+            block, voxel = np.nonzero(has_neighbour)
+            tsdf_0 = tsdf[block, voxel]
+            tsdf_1 = tsdf[neighbour_block[block, voxel], neighbour_voxel[voxel]]
+            crossing = (
+                observed[neighbour_block[block, voxel], neighbour_voxel[voxel]]
+                & (np.sign(tsdf_0) != np.sign(tsdf_1))
+                & (np.abs(tsdf_0) < 1)
+                & (np.abs(tsdf_1) < 1)
+            )
+
+            fraction = tsdf_0[crossing] / (tsdf_0[crossing] - tsdf_1[crossing])
+            positions = voxel_coordinates[block[crossing], voxel[crossing]] + 0.5
+            positions = positions.astype(np.float32)
+            positions[:, axis] += fraction
+            points.append(positions * self.voxel_size)
+
+        return np.concatenate(points).astype(np.float32)
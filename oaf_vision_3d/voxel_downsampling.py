@@ -0,0 +1,134 @@
+# %% [markdown]
+# # Voxel Downsampling
+#
+# A full resolution depth map gives millions of points, far more than most consumers
+# need. This module reduces a point cloud to at most one point per voxel, using only
+# numpy. It works directly on the `H x W x 3` maps from `triangulate_disparity` and
+# `plane_sweeping`, or on `N x 3` point lists.
+#
+# The process is:
+# 1. Quantize the coordinates to integer voxel indices
+# 2. Hash the three voxel indices into a single `int64` key
+# 3. Sort the points by key, so every voxel becomes a contiguous segment
+# 4. Reduce the positions (and colors) of each segment
+#
+# The reduction can be the centroid of the voxel, the first point in the voxel (in
+# input order) or the per-axis median of the voxel.
+
+# %%
+from enum import Enum
+from typing import Optional
+
+import numpy as np
+from nptyping import Float32, Int64, NDArray, Shape
+
+
+class VoxelReduction(Enum):
+    CENTROID = 0
+    FIRST = 1
+    MEDIAN = 2
+
+
+def voxel_keys(
+    points: NDArray[Shape["N, 3"], Float32], voxel_size: float
+) -> NDArray[Shape["N"], Int64]:
+    voxel_indices = np.floor(points / voxel_size).astype(np.int64)
+    if voxel_indices.shape[0] == 0:
+        return np.empty(0, dtype=np.int64)
+    voxel_indices -= voxel_indices.min(axis=0)
+    extent = voxel_indices.max(axis=0) + 1
+
+    if np.prod(extent.astype(np.float64)) >= np.iinfo(np.int64).max:
+        raise ValueError("Voxel grid is too large for int64 keys")
+
+    x_index, y_index, z_index = voxel_indices.T
+    return (x_index * extent[1] + y_index) * extent[2] + z_index
+
+
+def _segment_median(
+    values: NDArray[Shape["N, C"], Float32],
+    keys: NDArray[Shape["N"], Int64],
+    starts: NDArray[Shape["M"], Int64],
+    counts: NDArray[Shape["M"], Int64],
+) -> NDArray[Shape["M, C"], Float32]:
+    lower = starts + (counts - 1) // 2
+    upper = starts + counts // 2
+
+    medians = np.empty((starts.shape[0], values.shape[1]), dtype=np.float32)
+    for channel in range(values.shape[1]):
+        sorted_values = values[np.lexsort((values[:, channel], keys)), channel]
+        medians[:, channel] = 0.5 * (sorted_values[lower] + sorted_values[upper])
+    return medians
+
+
+def _reduce_segments(
+    values: NDArray[Shape["N, C"], Float32],
+    keys: NDArray[Shape["N"], Int64],
+    order: NDArray[Shape["N"], Int64],
+    starts: NDArray[Shape["M"], Int64],
+    counts: NDArray[Shape["M"], Int64],
+    reduction: VoxelReduction,
+) -> NDArray[Shape["M, C"], Float32]:
+    match reduction:
+        case VoxelReduction.CENTROID:
+            sums = np.add.reduceat(values[order].astype(np.float64), starts, axis=0)
+            return (sums / counts[:, None]).astype(np.float32)
+        case VoxelReduction.FIRST:
+            return values[order[starts]].astype(np.float32)
+        case VoxelReduction.MEDIAN:
+            return _segment_median(
+                values=values.astype(np.float32),
+                keys=keys,
+                starts=starts,
+                counts=counts,
+            )
+        case _:
+            raise ValueError("Invalid voxel reduction")
+
+
+def voxel_downsample(
+    xyz: NDArray[Shape["*, ..."], Float32],
+    voxel_size: float,
+    rgb: Optional[NDArray[Shape["*, ..."], Float32]] = None,
+    reduction: VoxelReduction = VoxelReduction.CENTROID,
+) -> tuple[NDArray[Shape["M, 3"], Float32], Optional[NDArray[Shape["M, 3"], Float32]]]:
+    if voxel_size <= 0:
+        raise ValueError("Voxel size must be positive")
+
+    points = xyz.reshape(-1, 3)
+    valid = ~np.isnan(points).any(axis=1)
+    points = points[valid]
+    colors = None if rgb is None else rgb.reshape(-1, rgb.shape[-1])[valid]
+
+    if points.shape[0] == 0:
+        empty = np.empty((0, 3), dtype=np.float32)
+        return empty, None if colors is None else empty
+
+    keys = voxel_keys(points=points, voxel_size=voxel_size)
+    # A stable sort keeps the input order inside every voxel, needed for FIRST
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    counts = np.diff(np.r_[starts, sorted_keys.shape[0]])
+
+    downsampled_points = _reduce_segments(
+        values=points,
+        keys=keys,
+        order=order,
+        starts=starts,
+        counts=counts,
+        reduction=reduction,
+    )
+    downsampled_colors = (
+        None
+        if colors is None
+        else _reduce_segments(
+            values=colors,
+            keys=keys,
+            order=order,
+            starts=starts,
+            counts=counts,
+            reduction=reduction,
+        )
+    )
+    return downsampled_points, downsampled_colors
@@ -23,5 +23,11 @@ setup(
     description="OAF 3D Vision Pipeline Workshop",
     packages=find_packages(),
     install_requires=_requirements(),
+    entry_points={
+        "console_scripts": [
+            "oaf-reconstruct=oaf_vision_3d.batch_reconstruction:main",
+            "oaf-depth-service=oaf_vision_3d.depth_service:main",
+        ],
+    },
     python_requires=">=3.10",
 )